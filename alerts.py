@@ -0,0 +1,263 @@
+"""
+基金上涨、下跌预警。
+
+预警按基金分组保存在有序数组中，每次实时估值刷新只检查估值发生变化的基金，
+用二分查找取出本次涨跌穿过的阈值区间，不需要遍历所有预警。
+"""
+import asyncio
+import bisect
+import datetime
+import math
+from collections import defaultdict
+
+from sqlalchemy import select, update
+
+from commands import fetch_and_update_fund_data, parse_growth
+from config import load_config
+from db import async_session
+from delivery import get_delivery_queue
+from models import FundDetail, PriceAlert
+
+config = load_config("config.yml")
+ALERT_CONFIG = config.get("alerts", {})
+
+KINDS = ("growth", "worth")
+DIRECTIONS = ("above", "below")
+
+
+def parse_alert_rule(rule):
+    """
+    解析预警规则。
+
+    ``+3%`` / ``-2%`` 表示预估涨跌达到该百分比，``>1.52`` / ``<1.4`` 表示预估净值达到该值。
+
+    :return: (kind, direction, threshold)
+    :raise ValueError: 规则格式不正确，或阈值不是有限的数（nan、inf 会打乱有序的阈值索引）
+    """
+    rule = rule.strip()
+    if rule.endswith("%"):
+        kind, direction, threshold = "growth", "below" if rule.startswith("-") else "above", float(rule[:-1])
+    elif rule[:1] in (">", "<"):
+        kind, direction, threshold = "worth", "above" if rule[0] == ">" else "below", float(rule.lstrip("<>="))
+    else:
+        raise ValueError(rule)
+    if not math.isfinite(threshold):
+        raise ValueError(rule)
+    return kind, direction, threshold
+
+
+def describe_alert(kind, direction, threshold):
+    if kind == "growth":
+        return f"预估涨跌{'≥' if direction == 'above' else '≤'}{threshold}%"
+    return f"预估净值{'≥' if direction == 'above' else '≤'}{threshold}"
+
+
+class AlertIndex:
+    """
+    按 (基金, 类型, 方向) 分组的有序阈值索引。
+    """
+
+    def __init__(self):
+        # {(code, kind, direction): ([阈值...], [预警ID...])}，两个列表按阈值升序对齐
+        self._thresholds = {}
+        self._alerts = {}
+        # 每个基金上一次的 {kind: 值} 和估值日期，用来计算本次穿过的区间
+        self._last_values = {}
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def add(self, alert_id, user_id, code, kind, direction, threshold):
+        thresholds, ids = self._thresholds.setdefault((code, kind, direction), ([], []))
+        position = bisect.bisect_right(thresholds, threshold)
+        thresholds.insert(position, threshold)
+        ids.insert(position, alert_id)
+        self._alerts[alert_id] = (user_id, code, kind, direction, threshold)
+
+    def remove(self, alert_id):
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return
+        _, code, kind, direction, threshold = alert
+        thresholds, ids = self._thresholds[(code, kind, direction)]
+        position = bisect.bisect_left(thresholds, threshold)
+        while ids[position] != alert_id:
+            position += 1
+        del thresholds[position]
+        del ids[position]
+
+    def replace(self, alerts):
+        """
+        用新的预警列表替换整个索引，保留各基金上一次的估值。
+        """
+        self._thresholds = {}
+        self._alerts = {}
+        for alert in alerts:
+            self.add(*alert)
+
+    def get(self, alert_id):
+        return self._alerts.get(alert_id)
+
+    def codes(self):
+        return {code for _, code, _, _, _ in self._alerts.values()}
+
+    def crossed(self, code, kind, previous, current):
+        """
+        取出从 previous 变到 current 时穿过的预警。上涨预警阈值落在 (previous, current]，
+        下跌预警阈值落在 [current, previous)；previous 为空时取所有已满足的预警。
+        """
+        fired = []
+        if previous is None or current > previous:
+            entry = self._thresholds.get((code, kind, "above"))
+            if entry:
+                start = 0 if previous is None else bisect.bisect_right(entry[0], previous)
+                fired.extend(entry[1][start:bisect.bisect_right(entry[0], current)])
+        if previous is None or current < previous:
+            entry = self._thresholds.get((code, kind, "below"))
+            if entry:
+                end = len(entry[0]) if previous is None else bisect.bisect_left(entry[0], previous)
+                fired.extend(entry[1][bisect.bisect_left(entry[0], current):end])
+        return fired
+
+    def evaluate(self, quotes):
+        """
+        检查一批实时估值，返回被触发的预警ID。
+
+        :param quotes: 实时估值数据列表，估值或涨跌为空、无法解析（例如 "--"）的跳过
+        :return: [(预警ID, 当前值), ...]
+        """
+        fired = []
+        for quote in quotes:
+            code = quote["fundcode"]
+            growth, worth = parse_growth(quote.get("gszzl")), parse_growth(quote.get("gsz"))
+            if growth is None or worth is None:
+                continue
+            day = (quote.get("gztime") or "")[:10] or datetime.date.today().isoformat()
+            values = {"growth": float(growth), "worth": float(worth), "day": day}
+            previous = self._last_values.get(code, {})
+            if previous == values:
+                continue
+            if previous.get("day") != day:
+                # 涨跌每个交易日从 0 开始，不和前一个交易日最后的涨跌比较；净值是连续的，仍然比较
+                previous = {"worth": previous.get("worth")}
+            self._last_values[code] = values
+            for kind in KINDS:
+                fired.extend((alert_id, values[kind])
+                             for alert_id in self.crossed(code, kind, previous.get(kind), values[kind]))
+        return fired
+
+
+alert_index = AlertIndex()
+# {预警ID: 上次触发时间}，加载预警时用数据库中的 last_fired_at 补齐，重启或切换 leader 后冷却时间仍然有效
+_fired_at = {}
+
+
+async def load_alerts():
+    """
+    把数据库中的有效预警加载到内存索引，已有的索引整体替换，可以重复调用以同步其他节点的修改。
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(PriceAlert.id, PriceAlert.user_id, PriceAlert.fund_code, PriceAlert.kind,
+                   PriceAlert.direction, PriceAlert.threshold, PriceAlert.last_fired_at).
+            where(PriceAlert.deleted_at.is_(None))
+        )
+        rows = result.all()
+    # 读完再一次性替换，替换过程中不会有其他协程看到不完整的索引
+    alert_index.replace(row[:6] for row in rows)
+    for row in rows:
+        if row.last_fired_at is not None and row.last_fired_at > _fired_at.get(row.id, datetime.datetime.min):
+            _fired_at[row.id] = row.last_fired_at
+    return len(alert_index)
+
+
+async def add_alert(user_id, fund_code, rule):
+    try:
+        kind, direction, threshold = parse_alert_rule(rule)
+    except ValueError:
+        return "预警格式不正确，例如：+3% 、-2% 、>1.52 、<1.40"
+    async with async_session() as session:
+        result = await session.execute(
+            select(PriceAlert.id).where(
+                PriceAlert.user_id == user_id, PriceAlert.fund_code == fund_code, PriceAlert.kind == kind,
+                PriceAlert.direction == direction, PriceAlert.threshold == threshold,
+                PriceAlert.deleted_at.is_(None))
+        )
+        if result.first():
+            return "相同的预警已存在。"
+        alert = PriceAlert(user_id=user_id, fund_code=fund_code, kind=kind, direction=direction,
+                           threshold=threshold)
+        session.add(alert)
+        await session.commit()
+        tracked = await session.execute(select(FundDetail.code).where(FundDetail.code == fund_code))
+        if not tracked.first():
+            # 实时刷新只覆盖 fund_details 中的基金
+            asyncio.ensure_future(fetch_and_update_fund_data(fund_code))
+    alert_index.add(alert.id, user_id, fund_code, kind, direction, threshold)
+    return f"已设置预警 #{alert.id}：{fund_code} {describe_alert(kind, direction, threshold)}"
+
+
+async def list_alerts(user_id):
+    async with async_session() as session:
+        result = await session.execute(
+            select(PriceAlert).where(PriceAlert.user_id == user_id, PriceAlert.deleted_at.is_(None)).
+            order_by(PriceAlert.fund_code, PriceAlert.id)
+        )
+        alerts = result.scalars().all()
+    if not alerts:
+        return "您当前没有设置任何预警。"
+    message = "您当前的预警：\n"
+    for alert in alerts:
+        message += f"#{alert.id} {alert.fund_code} {describe_alert(alert.kind, alert.direction, alert.threshold)}\n"
+    return message
+
+
+async def remove_alert(user_id, alert_id):
+    async with async_session() as session:
+        result = await session.execute(
+            update(PriceAlert).
+            where(PriceAlert.id == alert_id, PriceAlert.user_id == user_id, PriceAlert.deleted_at.is_(None)).
+            values(deleted_at=datetime.datetime.now())
+        )
+        if result.rowcount == 0:
+            return f"未找到编号为 {alert_id} 的预警。"
+        await session.commit()
+    alert_index.remove(alert_id)
+    _fired_at.pop(alert_id, None)
+    return f"已删除预警 #{alert_id}。"
+
+
+async def notify_alerts(quotes):
+    """
+    检查一批实时估值并通过发送队列推送触发的预警。
+
+    同一个预警在冷却时间内只推送一次，同一用户本次触发的多个预警合并成一条消息。
+
+    :param quotes: 实时估值数据列表
+    :return: 推送的预警数
+    """
+    cooldown = datetime.timedelta(seconds=ALERT_CONFIG.get("cooldown", 4 * 3600))
+    now = datetime.datetime.now()
+    messages = defaultdict(list)
+    fired_ids = []
+    names = {quote["fundcode"]: quote.get("name", "") for quote in quotes}
+    for alert_id, value in alert_index.evaluate(quotes):
+        last_fired = _fired_at.get(alert_id)
+        if last_fired is not None and now - last_fired < cooldown:
+            continue
+        _fired_at[alert_id] = now
+        fired_ids.append(alert_id)
+        user_id, code, kind, direction, threshold = alert_index.get(alert_id)
+        current = f"{value}%" if kind == "growth" else f"{value}"
+        messages[user_id].append(f"{names.get(code, '')}({code}) {describe_alert(kind, direction, threshold)}，"
+                                 f"当前{current}")
+
+    if not fired_ids:
+        return 0
+    async with async_session() as session:
+        await session.execute(update(PriceAlert).where(PriceAlert.id.in_(fired_ids)).values(last_fired_at=now))
+        await session.commit()
+    queue = get_delivery_queue()
+    for user_id, lines in messages.items():
+        await queue.put(user_id, "基金预警：\n" + "\n".join(lines))
+    return len(fired_ids)
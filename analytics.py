@@ -0,0 +1,199 @@
+"""
+基金风险分析：最大回撤、回撤持续时间、收益回撤比、波动率和极限套牢。
+
+晚间基金详情刷新后，对净值日期有更新的基金用 NumPy 计算一次并写入 fund_analytics 表，
+/risk 命令只读取一行结果，不再扫描净值序列。净值使用单位净值，分红会被视为下跌。
+"""
+import asyncio
+import datetime
+import math
+
+import numpy as np
+from sqlalchemy import func, select
+
+import history
+from config import load_config
+from db import async_session
+from models import FundAnalytics, FundDetail, FundNetWorth
+
+config = load_config("config.yml")
+ANALYTICS_CONFIG = config.get("analytics", {})
+# 分析最近多少天的净值
+WINDOW_DAYS = ANALYTICS_CONFIG.get("window_days", 1095)
+# 极限套牢统计的持有交易日数
+HOLDING_WINDOWS = ANALYTICS_CONFIG.get("holding_windows", [60, 250])
+MIN_POINTS = ANALYTICS_CONFIG.get("min_points", 20)
+CHUNK_SIZE = ANALYTICS_CONFIG.get("chunk_size", 200)
+TRADING_DAYS_PER_YEAR = 250
+
+
+def _date(value):
+    return value.astype(datetime.date)
+
+
+def compute_metrics(dates, worth, holding_windows=HOLDING_WINDOWS):
+    """
+    计算一个基金的风险指标。
+
+    :param dates: datetime64[D] 日期数组，升序
+    :param worth: float64 单位净值数组
+    :return: FundAnalytics 字段字典，有效净值少于 min_points 个时为 None
+    """
+    valid = np.isfinite(worth) & (worth > 0)
+    dates, worth = dates[valid], worth[valid]
+    if len(worth) < MIN_POINTS:
+        return None
+
+    peak = np.maximum.accumulate(worth)
+    drawdown = worth / peak - 1
+    trough = int(np.argmin(drawdown))
+    # 最大回撤的起点是低点之前最后一次创出前高的日期
+    peak_index = int(np.flatnonzero(worth[:trough + 1] == peak[trough])[-1])
+    recovered = np.flatnonzero(worth[trough:] >= peak[trough])
+    max_drawdown = float(drawdown[trough])
+
+    # 水下期：净值低于前高的连续区间，从前高日期算到重新回到前高的日期（未回到时算到最后一天）
+    edges = np.diff(np.concatenate(([0], (worth < peak).astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    underwater = {"underwater_days": 0, "underwater_start": None, "underwater_end": None}
+    if len(starts):
+        peak_dates = dates[starts - 1]
+        end_dates = dates[np.minimum(ends, len(dates) - 1)]
+        durations = (end_dates - peak_dates).astype(np.int64)
+        longest = int(np.argmax(durations))
+        underwater = {
+            "underwater_days": int(durations[longest]),
+            "underwater_start": _date(peak_dates[longest]),
+            "underwater_end": _date(end_dates[longest]) if ends[longest] < len(dates) else None,
+        }
+
+    years = int((dates[-1] - dates[0]).astype(np.int64)) / 365
+    annual_return = float((worth[-1] / worth[0]) ** (1 / years) - 1) if years > 0 else 0.0
+    log_returns = np.diff(np.log(worth))
+    volatility = float(np.std(log_returns, ddof=1) * math.sqrt(TRADING_DAYS_PER_YEAR)) if len(log_returns) > 1 else 0.0
+
+    # 极限套牢：任意一天买入、持有固定交易日数后的最差收益
+    worst_holding = {}
+    for window in holding_windows:
+        if len(worth) <= window:
+            continue
+        returns = worth[window:] / worth[:-window] - 1
+        start = int(np.argmin(returns))
+        worst_holding[str(window)] = [float(returns[start]), _date(dates[start]).isoformat(),
+                                      _date(dates[start + window]).isoformat()]
+
+    return {
+        "as_of": _date(dates[-1]),
+        "start_date": _date(dates[0]),
+        "points": len(worth),
+        "annual_return": annual_return,
+        "volatility": volatility,
+        "max_drawdown": max_drawdown,
+        "drawdown_peak_date": _date(dates[peak_index]),
+        "drawdown_trough_date": _date(dates[trough]),
+        "drawdown_recovery_date": _date(dates[trough + int(recovered[0])]) if len(recovered) else None,
+        "return_drawdown_ratio": annual_return / -max_drawdown if max_drawdown < 0 else None,
+        **underwater,
+        "worst_holding": worst_holding,
+    }
+
+
+async def _stale_codes(codes=None):
+    """
+    :return: [(基金代码, 最新净值日期), ...]，最新净值日期晚于已有分析结果的基金
+    """
+    latest = select(FundNetWorth.code, func.max(FundNetWorth.worth_date).label("latest")).group_by(FundNetWorth.code)
+    if codes is not None:
+        latest = latest.where(FundNetWorth.code.in_(codes))
+    latest = latest.subquery()
+    async with async_session() as session:
+        result = await session.execute(
+            select(latest.c.code, latest.c.latest).
+            outerjoin(FundAnalytics, FundAnalytics.code == latest.c.code).
+            where((FundAnalytics.as_of.is_(None)) | (FundAnalytics.as_of < latest.c.latest))
+        )
+        return [tuple(row) for row in result]
+
+
+def insufficient(analytics):
+    """
+    :return: 是否是历史净值不足、只记录了净值日期的结果
+    """
+    return analytics.max_drawdown is None
+
+
+def _compute_chunk(histories):
+    return {code: compute_metrics(dates, worth) for code, (dates, worth) in histories.items()}
+
+
+async def refresh_analytics(codes=None):
+    """
+    重新计算净值有更新的基金，同一个净值日期只计算一次。
+
+    历史净值不足的基金也写入一行，只记录最新净值日期和净值个数，有新的净值之前不再读取和计算。
+
+    :param codes: 只计算这些基金，为空时检查所有有历史净值的基金
+    :return: 算出风险指标的基金数
+    """
+    stale = await _stale_codes(codes)
+    start_date = datetime.date.today() - datetime.timedelta(days=WINDOW_DAYS)
+    loop = asyncio.get_running_loop()
+    updated = 0
+    for i in range(0, len(stale), CHUNK_SIZE):
+        chunk = stale[i:i + CHUNK_SIZE]
+        histories = await history.load_histories([code for code, _ in chunk], start_date)
+        # NumPy 计算放到线程中，不阻塞命令处理
+        results = await loop.run_in_executor(None, _compute_chunk, histories)
+        async with async_session() as session:
+            for code, latest in chunk:
+                metrics = results.get(code)
+                if metrics is None:
+                    metrics = {"as_of": latest, "points": len(histories[code][1]) if code in histories else 0}
+                else:
+                    updated += 1
+                await session.merge(FundAnalytics(code=code, computed_at=datetime.datetime.now(), **metrics))
+            await session.commit()
+    print(f"Refreshed risk analytics for {updated}/{len(stale)} funds at {datetime.datetime.now()}")
+    return updated
+
+
+def _percent(value):
+    return f"{value * 100:.2f}%"
+
+
+def render_analytics(analytics, name=None):
+    message = (
+        f"{name or analytics.code}({analytics.code}) 风险分析\n"
+        f"区间：{analytics.start_date} ~ {analytics.as_of}（{analytics.points} 个净值）\n"
+        "---------------------\n"
+        f"年化收益：{_percent(analytics.annual_return)}\n"
+        f"年化波动率：{_percent(analytics.volatility)}\n"
+        f"最大回撤：{_percent(analytics.max_drawdown)}"
+        f"（{analytics.drawdown_peak_date} ~ {analytics.drawdown_trough_date}，"
+        f"{'已于 ' + str(analytics.drawdown_recovery_date) + ' 修复' if analytics.drawdown_recovery_date else '尚未修复'}）\n"
+    )
+    if analytics.return_drawdown_ratio is not None:
+        message += f"收益回撤比：{analytics.return_drawdown_ratio:.2f}\n"
+    if analytics.underwater_days:
+        message += (f"最长回撤持续：{analytics.underwater_days} 天"
+                    f"（{analytics.underwater_start} ~ {analytics.underwater_end or '至今'}）\n")
+    for window, (worst, bought, sold) in sorted((analytics.worst_holding or {}).items(), key=lambda item: int(item[0])):
+        message += f"极限套牢（持有 {window} 个交易日）：{_percent(worst)}，{bought} 买入 {sold} 卖出\n"
+    return message
+
+
+async def get_fund_risk(fund_code):
+    """
+    读取基金的风险分析结果；还没有计算过的基金现场计算一次并缓存，历史净值不足的结果同样缓存。
+    """
+    async with async_session() as session:
+        analytics = await session.get(FundAnalytics, fund_code)
+    if analytics is None:
+        await refresh_analytics([fund_code])
+        async with async_session() as session:
+            analytics = await session.get(FundAnalytics, fund_code)
+    if analytics is None or insufficient(analytics):
+        return f"暂时没有 {fund_code} 足够的历史净值，无法分析。"
+    async with async_session() as session:
+        name = (await session.execute(select(FundDetail.name).where(FundDetail.code == fund_code))).scalar()
+    return render_analytics(analytics, name)
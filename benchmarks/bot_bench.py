@@ -0,0 +1,285 @@
+"""
+离线基准测试：在本地假服务（基金接口、实时估值、Telegram）和 SQLite 上运行 bot 的主要路径。
+
+场景：
+    details    晚间基金详情任务 update_fund_details
+    realtime   盘中实时估值任务 update_realtime_fund_details（每次迭代 tick 加一，部分基金估值变化）
+    broadcast  14:00 每日报告广播 send_daily_report_to_subscribers
+    search     并发 /search（本地基金目录）
+    repo       并发 /repo（get_daily_report）
+
+用法：python benchmarks/bot_bench.py [场景 ...] [--users 10000 --funds-per-user 20 ...] [--output result.json]
+      [--baseline result.json]
+
+同样的参数和 seed 生成完全相同的数据；结果输出每个场景的吞吐量和 p50/p99，指定 --baseline 时同时输出变化百分比。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dataset import Dataset  # noqa: E402
+from fakes import FakeServers, LatencyModel  # noqa: E402
+
+SCENARIOS = ("details", "realtime", "broadcast", "search", "repo")
+BENCH_TOKEN = "123456:bench"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help="要运行的场景，默认全部")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--funds", type=int, default=2000, help="基金总数")
+    parser.add_argument("--funds-per-user", type=int, default=20)
+    # 真实的详情接口返回多年的历史净值，天数太少会掩盖批量写入历史的问题
+    parser.add_argument("--history-days", type=int, default=750, help="详情接口返回的历史净值天数（约三年的交易日）")
+    parser.add_argument("--changed-ratio", type=float, default=0.5, help="每次实时刷新估值发生变化的基金比例")
+    parser.add_argument("--iterations", type=int, default=3, help="定时任务类场景的运行次数")
+    parser.add_argument("--requests", type=int, default=2000, help="命令类场景的请求总数")
+    parser.add_argument("--concurrency", type=int, default=50, help="命令类场景的并发数")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="基金接口延迟（秒）")
+    parser.add_argument("--quote-latency", type=float, default=0.02, help="实时估值接口延迟（秒）")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="Telegram 接口延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="基金接口和实时估值接口的错误率")
+    parser.add_argument("--no-charts", action="store_true", help="广播时不渲染图表，只测查询、计算和发送")
+    parser.add_argument("--telegram-limits", action="store_true", help="使用 config.yml 中真实的 Telegram 限速")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录（数据库和配置）")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def write_config(workdir, args, servers):
+    """
+    以仓库的 config.yml 为基础，把数据库和所有上游地址指向本地。
+    """
+    with open(os.path.join(ROOT, "config.yml"), "r", encoding="utf-8") as file:
+        config = yaml.safe_load(file)
+    config["database"].update(url=f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}", echo=False,
+                              ssl_ca=None)
+    config["telegram_bot"]["token"] = BENCH_TOKEN
+    config["fund_api"]["base_url"] = servers.fund_api.url
+    config.setdefault("realtime_quote", {})["url"] = servers.quotes.url + "/js/{code}.js"
+    config.setdefault("catalog", {})["path"] = os.path.join(workdir, "fund_catalog.json")
+    config.setdefault("metrics", {})["enabled"] = False
+    config.setdefault("trading_calendar", {})["holidays_path"] = os.path.join(workdir, "trading_holidays.txt")
+    if not args.telegram_limits:
+        # 默认只测 bot 自身的开销，不受 Telegram 每秒 30 条的限制
+        config.setdefault("delivery", {}).update(global_rate=100000, per_chat_rate=1000)
+    with open(os.path.join(workdir, "config.yml"), "w", encoding="utf-8") as file:
+        yaml.safe_dump(config, file, allow_unicode=True)
+    shutil.copy(os.path.join(ROOT, "trading_holidays.txt"), workdir)
+
+
+class AlwaysOpen:
+    """
+    基准测试不受运行时刻是否为交易时段的影响。
+    """
+
+    def is_open(self, moment=None):
+        return True
+
+
+async def no_chart(report):
+    return None
+
+
+def summarize(name, latencies, ops, elapsed, **extra):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    return {
+        "scenario": name,
+        "ops": ops,
+        "seconds": round(elapsed, 4),
+        "throughput": round(ops / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 2),
+        **extra,
+    }
+
+
+async def timed_runs(iterations, func, before=None):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        if before is not None:
+            before(i)
+        run_started = time.perf_counter()
+        await func()
+        latencies.append(time.perf_counter() - run_started)
+    return latencies, time.perf_counter() - started
+
+
+async def concurrent_requests(func, arguments, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(argument):
+        async with semaphore:
+            started = time.perf_counter()
+            await func(argument)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(argument) for argument in arguments))
+    return latencies, time.perf_counter() - started
+
+
+async def seed_database(dataset):
+    from sqlalchemy import insert
+
+    import commands
+    import db
+    import history
+    from models import FundDetail, UserFund
+
+    await db.create_tables()
+    async with db.async_session() as session:
+        details = [dataset.detail(fund["code"]) for fund in dataset.funds]
+        for start in range(0, len(details), 500):
+            chunk = details[start:start + 500]
+            await session.execute(insert(FundDetail), [
+                dict(code=data["code"], expect_worth=data["expectWorth"], expect_growth=data["expectGrowth"],
+                     **commands.fund_detail_values(data)) for data in chunk])
+            await history.append_history(session, {data["code"]: data["netWorthData"] for data in chunk})
+        for start in range(0, len(dataset.holdings), 5000):
+            await session.execute(insert(UserFund), [
+                dict(user_id=user_id, fund_code=code, shares=shares, fund_name=dataset.by_code[code]["name"])
+                for user_id, code, shares in dataset.holdings[start:start + 5000]])
+        await session.commit()
+
+
+async def run(args, dataset, servers):
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    import catalog
+    import charts
+    import commands
+    import delivery
+    import quotes
+    import tasks
+
+    started = time.perf_counter()
+    await seed_database(dataset)
+    print(f"Seeded {len(dataset.funds)} funds and {len(dataset.holdings)} holdings "
+          f"in {time.perf_counter() - started:.2f}s")
+
+    tasks.trading_calendar = AlwaysOpen()
+    if args.no_charts:
+        charts.render_fund_growth = no_chart
+    # 与 ApplicationBuilder 一样给发送队列足够的连接数
+    bot = Bot(BENCH_TOKEN, base_url=servers.telegram.url + "/bot",
+              request=HTTPXRequest(connection_pool_size=delivery.DELIVERY_CONFIG.get("concurrency", 32)))
+    await bot.initialize()
+    delivery.bind_bot(bot)
+    rng = random.Random(args.seed)
+    results = []
+    try:
+        for name in args.scenarios:
+            requests_before = servers.fund_api.requests + servers.quotes.requests + servers.telegram.requests
+            if name == "details":
+                latencies, elapsed = await timed_runs(args.iterations, tasks.update_fund_details)
+                result = summarize(name, latencies, len(dataset.funds) * args.iterations, elapsed, unit="funds")
+            elif name == "realtime":
+                latencies, elapsed = await timed_runs(args.iterations, tasks.update_realtime_fund_details,
+                                                      before=lambda i: servers.set_tick(i + 1))
+                targets = len({code for _, code, _ in dataset.holdings})
+                result = summarize(name, latencies, targets * args.iterations, elapsed, unit="quotes")
+            elif name == "broadcast":
+                messages_before = servers.telegram.messages
+                latencies, elapsed = await timed_runs(args.iterations, tasks.send_daily_report_to_subscribers)
+                result = summarize(name, latencies, len(dataset.user_ids) * args.iterations, elapsed, unit="users",
+                                   telegram_messages=servers.telegram.messages - messages_before)
+            elif name == "search":
+                await catalog.refresh_catalog()
+                keywords = [rng.choice(dataset.keywords) for _ in range(args.requests)]
+                latencies, elapsed = await concurrent_requests(catalog.search_funds_locally, keywords,
+                                                               args.concurrency)
+                result = summarize(name, latencies, len(keywords), elapsed, unit="requests")
+            else:
+                # 冷缓存开始，第一次请求某个基金时会访问实时估值接口
+                quotes.quote_cache.invalidate()
+                user_ids = [rng.choice(dataset.user_ids) for _ in range(args.requests)]
+                latencies, elapsed = await concurrent_requests(
+                    lambda user_id: commands.get_daily_report(user_id, False), user_ids, args.concurrency)
+                result = summarize(name, latencies, len(user_ids), elapsed, unit="requests")
+            result["upstream_requests"] = (servers.fund_api.requests + servers.quotes.requests
+                                           + servers.telegram.requests - requests_before)
+            results.append(result)
+            print(format_result(result))
+    finally:
+        await delivery.get_delivery_queue().stop()
+        await quotes.close_http_client()
+        await bot.shutdown()
+        charts.shutdown()
+    return results
+
+
+def format_result(result, baseline=None):
+    line = (f"{result['scenario']:<10} {result['ops']:>8} {result['unit']:<8} {result['seconds']:>9.3f}s "
+            f"{result['throughput']:>10.1f}/s  p50 {result['p50_ms']:>9.2f}ms  p99 {result['p99_ms']:>9.2f}ms")
+    if baseline:
+        changes = []
+        for key in ("throughput", "p50_ms", "p99_ms"):
+            if baseline.get(key):
+                changes.append(f"{key} {(result[key] - baseline[key]) / baseline[key] * 100:+.1f}%")
+        line += "  (" + ", ".join(changes) + ")"
+    return line
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    dataset = Dataset(funds=args.funds, users=args.users, funds_per_user=args.funds_per_user,
+                      history_days=args.history_days, changed_ratio=args.changed_ratio, seed=args.seed)
+    servers = FakeServers(
+        dataset,
+        api_latency=LatencyModel(args.api_latency, error_rate=args.error_rate, seed=args.seed),
+        quote_latency=LatencyModel(args.quote_latency, error_rate=args.error_rate, seed=args.seed + 1),
+        telegram_latency=LatencyModel(args.telegram_latency, seed=args.seed + 2),
+    ).start()
+    workdir = tempfile.mkdtemp(prefix="fund-bot-bench-")
+    try:
+        write_config(workdir, args, servers)
+        # 各模块在导入时读取当前目录下的 config.yml
+        os.chdir(workdir)
+        results = asyncio.run(run(args, dataset, servers))
+    finally:
+        os.chdir(ROOT)
+        servers.stop()
+        if args.keep:
+            print(f"Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = {item["scenario"]: item for item in json.load(file)["results"]}
+        print("\nCompared with", args.baseline)
+        for result in results:
+            print(format_result(result, baseline.get(result["scenario"])))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"args": vars(args), "results": results}, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
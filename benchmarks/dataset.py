@@ -0,0 +1,132 @@
+"""
+基准测试用的合成数据：基金列表、基金详情、实时估值和用户持仓。
+
+同一个 seed 生成的数据完全相同，实时估值随 tick 变化，changed_ratio 控制每个 tick 有多少基金的估值发生变化。
+"""
+import datetime
+import random
+
+FUND_TYPES = ["混合型", "股票型", "债券型", "指数型", "QDII", "货币型"]
+NAME_PARTS = ["华夏", "易方达", "招商", "天弘", "中欧", "广发", "南方", "嘉实", "富国", "汇添富"]
+NAME_THEMES = ["成长", "蓝筹精选", "中证白酒", "医疗健康", "新能源", "消费升级", "科技创新", "稳健收益", "沪深300", "红利"]
+NAME_PINYIN = {
+    "华夏": "huaxia", "易方达": "yifangda", "招商": "zhaoshang", "天弘": "tianhong", "中欧": "zhongou",
+    "广发": "guangfa", "南方": "nanfang", "嘉实": "jiashi", "富国": "fuguo", "汇添富": "huitianfu",
+    "成长": "chengzhang", "蓝筹精选": "lanchoujingxuan", "中证白酒": "zhongzhengbaijiu", "医疗健康": "yiliaojiankang",
+    "新能源": "xinnengyuan", "消费升级": "xiaofeishengji", "科技创新": "kejichuangxin", "稳健收益": "wenjianshouyi",
+    "沪深300": "hushen300", "红利": "hongli",
+}
+
+
+class Dataset:
+    def __init__(self, funds=2000, users=1000, funds_per_user=20, history_days=30, changed_ratio=0.5, seed=42):
+        self.seed = seed
+        self.changed_ratio = changed_ratio
+        self.history_days = history_days
+        rng = random.Random(seed)
+        self.funds = []
+        for i in range(funds):
+            company, theme = rng.choice(NAME_PARTS), rng.choice(NAME_THEMES)
+            share_class = rng.choice(["A", "C", ""])
+            pinyin = NAME_PINYIN[company] + NAME_PINYIN[theme] + share_class.lower()
+            abbr = "".join(word[0] for word in (NAME_PINYIN[company], NAME_PINYIN[theme])) + share_class.lower()
+            self.funds.append({
+                "code": f"{100000 + i:06d}",
+                "name": f"{company}{theme}{share_class}",
+                "abbr": abbr.upper(),
+                "pinyin": pinyin.upper(),
+                "type": rng.choice(FUND_TYPES),
+                "net_worth": round(rng.uniform(0.5, 8), 4),
+                "day_growth": round(rng.uniform(-5, 5), 2),
+            })
+        self.by_code = {fund["code"]: fund for fund in self.funds}
+
+        codes = [fund["code"] for fund in self.funds]
+        per_user = min(funds_per_user, len(codes))
+        self.holdings = []
+        for user_id in range(1, users + 1):
+            for code in rng.sample(codes, per_user):
+                self.holdings.append((user_id, code, f"{rng.randrange(100, 10 ** 6) / 100:.2f}"))
+        self.user_ids = list(range(1, users + 1))
+        self.keywords = self._keywords(rng)
+
+    def _keywords(self, rng):
+        # 混合代码、代码前缀、简拼、名称片段和全拼，与真实搜索的分布大致相当
+        keywords = []
+        for _ in range(1000):
+            fund = rng.choice(self.funds)
+            kind = rng.randrange(5)
+            if kind == 0:
+                keywords.append(fund["code"])
+            elif kind == 1:
+                keywords.append(fund["code"][:4])
+            elif kind == 2:
+                keywords.append(fund["abbr"][:3].lower())
+            elif kind == 3:
+                keywords.append(fund["name"][2:4])
+            else:
+                keywords.append(fund["pinyin"][:6].lower())
+        return keywords
+
+    def catalog(self, keyword=None):
+        rows = [[fund["code"], fund["abbr"], fund["name"], fund["type"], fund["pinyin"]] for fund in self.funds]
+        if keyword:
+            keyword = keyword.lower()
+            rows = [row for row in rows if any(keyword in str(value).lower() for value in row)]
+        return rows
+
+    def detail(self, code, today=None):
+        fund = self.by_code[code]
+        today = today or datetime.date(2024, 1, 5)
+        rng = random.Random(f"{self.seed}:{code}:history")
+        worth = fund["net_worth"]
+        history = []
+        for days in range(self.history_days, 0, -1):
+            growth = rng.uniform(-3, 3)
+            worth = max(0.1, worth * (1 + growth / 100))
+            history.append([(today - datetime.timedelta(days=days)).isoformat(), f"{worth:.4f}", f"{growth:.2f}", ""])
+        history.append([today.isoformat(), f"{fund['net_worth']:.4f}", f"{fund['day_growth']:.2f}", ""])
+        return {
+            "code": code,
+            "name": fund["name"],
+            "type": fund["type"],
+            "netWorth": fund["net_worth"],
+            "expectWorth": fund["net_worth"],
+            "totalWorth": round(fund["net_worth"] * 1.5, 4),
+            "expectGrowth": "0",
+            "dayGrowth": f"{fund['day_growth']:.2f}",
+            "lastWeekGrowth": "1.23",
+            "lastMonthGrowth": "-2.34",
+            "lastThreeMonthsGrowth": "3.45",
+            "lastSixMonthsGrowth": "-4.56",
+            "lastYearGrowth": "5.67",
+            "buyMin": "10",
+            "buySourceRate": "1.5",
+            "buyRate": "0.15",
+            "manager": "张三",
+            "fundScale": "12.34亿",
+            "netWorthDate": today.isoformat(),
+            "netWorthData": history,
+        }
+
+    def quote(self, code, tick):
+        """
+        第 tick 次刷新时的实时估值，只有被选中变化的基金的估值时间和估值会改变。
+        """
+        fund = self.by_code[code]
+        # 找到该基金最近一次变化的 tick，估值由它决定
+        changed_at = tick
+        while changed_at > 0 and random.Random(f"{self.seed}:{code}:{changed_at}").random() >= self.changed_ratio:
+            changed_at -= 1
+        rng = random.Random(f"{self.seed}:{code}:{changed_at}:quote")
+        growth = rng.uniform(-4, 4)
+        gztime = datetime.datetime(2024, 1, 5, 9, 30) + datetime.timedelta(minutes=changed_at)
+        return {
+            "fundcode": code,
+            "name": fund["name"],
+            "jzrq": "2024-01-04",
+            "dwjz": f"{fund['net_worth']:.4f}",
+            "gsz": f"{fund['net_worth'] * (1 + growth / 100):.4f}",
+            "gszzl": f"{growth:.2f}",
+            "gztime": gztime.strftime("%Y-%m-%d %H:%M"),
+        }
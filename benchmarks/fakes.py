@@ -0,0 +1,184 @@
+"""
+基准测试用的本地假服务：基金接口（/all、/detail/list）、天天基金实时估值 JSONP 和 Telegram Bot API。
+
+服务运行在独立线程的事件循环里，不占用被测代码的事件循环；每个请求按配置的延迟等待，并按错误率返回 5xx。
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class LatencyModel:
+    """
+    请求延迟和错误注入：延迟在 [latency * (1 - jitter), latency * (1 + jitter)] 内均匀分布（秒）。
+    """
+
+    def __init__(self, latency=0.0, jitter=0.5, error_rate=0.0, seed=42):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+
+    async def wait(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * self._rng.uniform(1 - self.jitter, 1 + self.jitter))
+        return self._rng.random() < self.error_rate
+
+
+class FakeHttpServer:
+    """
+    最小的 HTTP/1.1 服务，支持 keep-alive；子类实现 handle(method, path, query, body) 返回 (状态码, 类型, 内容)。
+    """
+
+    def __init__(self, latency=None):
+        self.latency = latency or LatencyModel()
+        self.requests = 0
+        self.errors = 0
+        self.port = None
+        self._server = None
+
+    def handle(self, method, path, query, body):
+        raise NotImplementedError
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests += 1
+                url = urlsplit(target)
+                if await self.latency.wait():
+                    self.errors += 1
+                    status, content_type, content = 502, "text/plain", b"injected error"
+                else:
+                    status, content_type, content = self.handle(method, unquote(url.path), parse_qs(url.query),
+                                                                body)
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(content)}\r\n\r\n".encode("latin-1") + content)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1"):
+        self._server = await asyncio.start_server(self._serve, host, 0, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+
+def _json(data, status=200):
+    return status, "application/json", json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+class FakeFundApi(FakeHttpServer):
+    """
+    基金接口和实时估值接口，数据来自 Dataset；tick 每加一实时估值按 changed_ratio 变化一次。
+    """
+
+    def __init__(self, dataset, latency=None):
+        super().__init__(latency)
+        self.dataset = dataset
+        self.tick = 0
+
+    def handle(self, method, path, query, body):
+        if path == "/all":
+            return _json({"data": self.dataset.catalog(query.get("keyWord", [None])[0])})
+        if path == "/detail/list":
+            codes = [code for code in query.get("code", [""])[0].split(",") if code in self.dataset.by_code]
+            return _json({"data": [self.dataset.detail(code) for code in codes]})
+        match = re.fullmatch(r"/js/(\d+)\.js", path)
+        if match and match.group(1) in self.dataset.by_code:
+            quote = json.dumps(self.dataset.quote(match.group(1), self.tick), ensure_ascii=False)
+            return 200, "application/javascript", f"jsonpgz({quote});".encode("utf-8")
+        if match:
+            return 200, "application/javascript", b"jsonpgz();"
+        return 404, "text/plain", b"not found"
+
+
+class FakeTelegram(FakeHttpServer):
+    """
+    Telegram Bot API：getMe、sendMessage、sendPhoto 直接返回成功。
+    """
+
+    def __init__(self, latency=None):
+        super().__init__(latency)
+        self.messages = 0
+        self.photos = 0
+        self._message_id = 0
+
+    def handle(self, method, path, query, body):
+        bot_method = path.rsplit("/", 1)[-1]
+        if bot_method == "getMe":
+            return _json({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench",
+                                                 "username": "bench_bot"}})
+        if bot_method in ("sendMessage", "sendPhoto"):
+            match = re.search(rb'chat_id"?\s*(?:=|:|\r\n\r\n)\s*"?(-?\d+)', body)
+            chat_id = int(match.group(1)) if match else 0
+            self._message_id += 1
+            message = {"message_id": self._message_id, "date": int(time.time()),
+                       "chat": {"id": chat_id, "type": "private"}}
+            if bot_method == "sendMessage":
+                self.messages += 1
+                message["text"] = "ok"
+            else:
+                self.photos += 1
+                message["photo"] = []
+            return _json({"ok": True, "result": message})
+        return _json({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+
+
+class FakeServers:
+    """
+    在后台线程中启动所有假服务。
+    """
+
+    def __init__(self, dataset, api_latency=None, quote_latency=None, telegram_latency=None):
+        self.fund_api = FakeFundApi(dataset, api_latency)
+        # 实时估值和基金接口是不同的上游，各自一个端口以便分别设置延迟
+        self.quotes = FakeFundApi(dataset, quote_latency)
+        self.telegram = FakeTelegram(telegram_latency)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="fake-servers", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        for server in (self.fund_api, self.quotes, self.telegram):
+            asyncio.run_coroutine_threadsafe(server.start(), self._loop).result()
+        return self
+
+    def set_tick(self, tick):
+        self.quotes.tick = tick
+
+    async def _shutdown(self):
+        for server in (self.fund_api, self.quotes, self.telegram):
+            server._server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
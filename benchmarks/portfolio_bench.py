@@ -0,0 +1,71 @@
+"""
+对比 Decimal 逐条计算与 portfolio NumPy 批量计算的耗时，并校验两者结果逐位一致。
+
+用法：python benchmarks/portfolio_bench.py [持仓数，默认 100000]
+"""
+import os
+import random
+import sys
+import time
+from decimal import Decimal, ROUND_DOWN
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import portfolio  # noqa: E402
+
+QUANT = Decimal('0.0001')
+
+
+def scalar_change_amount(shares, worth, growth):
+    # 与 get_daily_report 中的计算过程相同
+    worth = Decimal(str(worth))
+    growth = Decimal(str(growth)) / 100
+    yesterday_worth = (worth / (1 + growth)).quantize(QUANT, rounding=ROUND_DOWN)
+    growth_value = (yesterday_worth * growth).quantize(QUANT, rounding=ROUND_DOWN)
+    return (shares * growth_value).quantize(QUANT, rounding=ROUND_DOWN)
+
+
+def make_holdings(count, users=5000, funds=3000, seed=42):
+    rng = random.Random(seed)
+    fund_worth = [round(rng.uniform(0.5, 8), 4) for _ in range(funds)]
+    fund_growth = [f"{rng.uniform(-5, 5):.2f}" for _ in range(funds)]
+    fund_expect_worth = [round(w * rng.uniform(0.97, 1.03), 4) for w in fund_worth]
+    fund_expect_growth = [f"{rng.uniform(-5, 5):.2f}" for _ in range(funds)]
+    user_ids, shares, net_worth, day_growth, expect_worth, expect_growth = [], [], [], [], [], []
+    for _ in range(count):
+        fund = rng.randrange(funds)
+        user_ids.append(rng.randrange(users))
+        shares.append(Decimal(rng.randrange(1, 10 ** 8)) / 100)
+        net_worth.append(fund_worth[fund])
+        day_growth.append(fund_growth[fund])
+        expect_worth.append(fund_expect_worth[fund])
+        expect_growth.append(fund_expect_growth[fund])
+    return user_ids, shares, net_worth, day_growth, expect_worth, expect_growth
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    user_ids, shares, net_worth, day_growth, expect_worth, expect_growth = make_holdings(count)
+
+    started = time.perf_counter()
+    scalar = [(scalar_change_amount(s, w, g), scalar_change_amount(s, ew, eg))
+              for s, w, g, ew, eg in zip(shares, net_worth, day_growth, expect_worth, expect_growth)]
+    scalar_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    result = portfolio.compute_portfolio(user_ids, shares, net_worth, day_growth, expect_worth, expect_growth)
+    vector_elapsed = time.perf_counter() - started
+
+    changes = portfolio.to_decimals(result.change_amount, result.change_negative)
+    expect_changes = portfolio.to_decimals(result.expect_change_amount, result.expect_change_negative)
+    mismatches = sum(1 for (a, b), c, d in zip(scalar, changes, expect_changes) if str(a) != str(c) or str(b) != str(d))
+
+    print(f"holdings={count} users={len(result.user_ids)}")
+    print(f"decimal scalar: {scalar_elapsed * 1000:.1f}ms")
+    print(f"numpy vector:   {vector_elapsed * 1000:.1f}ms ({scalar_elapsed / vector_elapsed:.1f}x)")
+    print(f"mismatches={mismatches} inexact={int((~result.exact).sum())}")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+本地基金目录，/search 直接在内存索引中查询，不再访问上游接口。
+
+目录定时从基金接口的 /all 拉取并保存到本地文件，启动时先从文件加载。
+"""
+import bisect
+import json
+import logging
+import os
+
+from sqlalchemy import select
+
+from commands import AsyncFundApi
+from config import load_config
+from db import async_session
+from models import FundDetail
+from quotes import quote_cache
+
+config = load_config("config.yml")
+CATALOG_CONFIG = config.get("catalog", {})
+
+logger = logging.getLogger(__name__)
+
+# 排名：代码完全匹配 > 代码前缀 > 简拼前缀 > 名称前缀 > 全拼前缀 > 名称包含，同一类按键的字典序
+RANK_CODE, RANK_CODE_PREFIX, RANK_ABBR_PREFIX, RANK_NAME_PREFIX, RANK_PINYIN_PREFIX, RANK_NAME_CONTAINS = range(6)
+
+
+class FundCatalog:
+    """
+    基金目录的内存索引：代码字典、按代码/简拼/名称/全拼分别排序的前缀索引，以及名称的 n-gram 倒排索引。
+    """
+
+    def __init__(self, funds=()):
+        self.funds = []
+        self.by_code = {}
+        self._code_index = {}
+        # {排名: ([键...], [基金下标...])}，按键排序，前缀匹配是一段连续区间
+        self._prefixes = {}
+        self._ngrams = {}
+        self.load(funds)
+
+    def __len__(self):
+        return len(self.funds)
+
+    def load(self, funds):
+        """
+        :param funds: /all 接口返回的数据 [[代码, 简拼, 名称, 类型, 全拼], ...]
+        """
+        entries = []
+        for fund in funds:
+            fund = list(fund) + [""] * (5 - len(fund))
+            code, abbr, name, fund_type, pinyin = (str(value or "") for value in fund[:5])
+            if code:
+                entries.append((code, abbr.lower(), name, fund_type, pinyin.lower()))
+        entries.sort()
+
+        prefixes = {RANK_CODE_PREFIX: [], RANK_ABBR_PREFIX: [], RANK_NAME_PREFIX: [], RANK_PINYIN_PREFIX: []}
+        ngrams = {}
+        for i, (code, abbr, name, _, pinyin) in enumerate(entries):
+            for rank, key in ((RANK_CODE_PREFIX, code), (RANK_ABBR_PREFIX, abbr), (RANK_NAME_PREFIX, name.lower()),
+                              (RANK_PINYIN_PREFIX, pinyin)):
+                if key:
+                    prefixes[rank].append((key, i))
+            # 单字和双字索引，用于名称中间的匹配
+            lowered = name.lower()
+            for n in (1, 2):
+                for start in range(len(lowered) - n + 1):
+                    ngrams.setdefault(lowered[start:start + n], []).append(i)
+
+        self.funds = entries
+        self.by_code = {entry[0]: entry for entry in entries}
+        self._code_index = {entry[0]: i for i, entry in enumerate(entries)}
+        self._prefixes = {}
+        for rank, keys in prefixes.items():
+            keys.sort()
+            self._prefixes[rank] = ([key for key, _ in keys], [i for _, i in keys])
+        # 下标按加入顺序递增，同一个名称里重复的字只保留一次
+        self._ngrams = {gram: list(dict.fromkeys(ids)) for gram, ids in ngrams.items()}
+
+    def search(self, keyword, limit=None):
+        """
+        按代码、简拼、名称或全拼搜索基金。
+
+        :param keyword: 搜索关键字
+        :param limit: 最多返回的数量，默认读取 catalog.limit
+        :return: [(代码, 名称, 类型), ...]，按匹配程度排序
+        """
+        limit = limit or CATALOG_CONFIG.get("limit", 10)
+        keyword = keyword.strip().lower()
+        if not keyword:
+            return []
+        found = []
+        if keyword in self._code_index:
+            found.append(self._code_index[keyword])
+
+        # 每类前缀索引只取区间开头的 limit 个，凑够数量就停止
+        for rank in (RANK_CODE_PREFIX, RANK_ABBR_PREFIX, RANK_NAME_PREFIX, RANK_PINYIN_PREFIX):
+            if len(found) >= limit:
+                break
+            keys, ids = self._prefixes[rank]
+            position = bisect.bisect_left(keys, keyword)
+            while position < len(keys) and len(found) < limit and keys[position].startswith(keyword):
+                if ids[position] not in found:
+                    found.append(ids[position])
+                position += 1
+
+        if len(found) < limit:
+            for i in self._name_contains(keyword):
+                if i not in found:
+                    found.append(i)
+                    if len(found) >= limit:
+                        break
+        return [(self.funds[i][0], self.funds[i][2], self.funds[i][3]) for i in found[:limit]]
+
+    def _name_contains(self, keyword):
+        # 从最稀有的 n-gram 的倒排列表开始逐个校验
+        n = min(len(keyword), 2)
+        postings = [self._ngrams.get(keyword[start:start + n], ()) for start in range(len(keyword) - n + 1)]
+        for i in min(postings, key=len):
+            if keyword in self.funds[i][2].lower():
+                yield i
+
+    def to_json(self):
+        return [[code, abbr, name, fund_type, pinyin] for code, abbr, name, fund_type, pinyin in self.funds]
+
+
+fund_catalog = FundCatalog()
+
+
+def catalog_path():
+    return CATALOG_CONFIG.get("path", "fund_catalog.json")
+
+
+def load_catalog_file():
+    """
+    启动时从本地文件加载目录，文件不存在时目录为空。
+    """
+    path = catalog_path()
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r', encoding='utf-8') as file:
+        fund_catalog.load(json.load(file))
+    logger.info("Loaded %d funds from %s", len(fund_catalog), path)
+    return len(fund_catalog)
+
+
+async def refresh_catalog():
+    """
+    从上游拉取完整的基金列表，更新内存索引并保存到本地文件。
+    """
+    funds = await AsyncFundApi().get_all_funds()
+    if not funds:
+        return 0
+    fund_catalog.load(funds)
+    path = catalog_path()
+    # 先写临时文件再替换，避免中途失败留下不完整的文件
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        json.dump(fund_catalog.to_json(), file, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+    logger.info("Refreshed fund catalog with %d funds", len(fund_catalog))
+    return len(fund_catalog)
+
+
+async def search_funds_locally(keyword):
+    """
+    在本地基金目录中搜索，净值取自 FundDetail 或实时估值缓存，不访问上游接口。
+
+    :param keyword: 搜索关键字
+    :return: 与基金详情接口字段相同的列表；目录尚未加载时返回 None
+    """
+    if not len(fund_catalog):
+        return None
+    matches = fund_catalog.search(keyword)
+    if not matches:
+        return []
+    codes = [code for code, _, _ in matches]
+    async with async_session() as session:
+        result = await session.execute(
+            select(FundDetail.code, FundDetail.net_worth, FundDetail.expect_growth).where(FundDetail.code.in_(codes)))
+        details = {row.code: row for row in result}
+    funds = []
+    for code, name, fund_type in matches:
+        detail = details.get(code)
+        quote = quote_cache.peek(code)
+        funds.append({
+            "code": code,
+            "name": name,
+            "type": fund_type,
+            "netWorth": detail.net_worth if detail else (quote["dwjz"] if quote else "-"),
+            "expectGrowth": quote["gszzl"] if quote else (detail.expect_growth if detail else "0"),
+        })
+    return funds
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from config import load_config
+from metrics import Histogram, timed
+
+config = load_config("config.yml")
+CHART_CONFIG = config.get("charts", {})
+
+render_latency = Histogram("chart_render_seconds", "日报图表渲染耗时（含进程池排队）", ("outcome",))
+
+# 选择一个支持中文的字体
+FONTS = ['Microsoft YaHei', 'Heiti TC', 'PingFang SC']
+
+_executor = None
+# 以下变量只在绘图子进程中使用
+_figure = None
+
+
+def _init_worker():
+    """
+    绘图子进程初始化：使用 Agg 后端，配置字体，并预先创建一个复用的画布。
+    """
+    global _figure
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    matplotlib.rcParams['font.sans-serif'] = FONTS  # 尝试使用不同的字体
+    matplotlib.rcParams['axes.unicode_minus'] = False  # 确保负号 '-' 正确显示
+    _figure = Figure(figsize=(10, 10))
+    FigureCanvasAgg(_figure)
+
+
+def _draw_fund_growth(fund_pic_data):
+    """
+    在子进程中绘制涨跌排名图。
+
+    :param fund_pic_data: [{"name", "fund_expect_growth", "fund_change_amount"}, ...]
+    :return: PNG 图片字节
+    """
+    # 复用同一个画布，绘制前清空上一次的内容，内存不会随报告数增长
+    _figure.clear()
+    axes = _figure.subplots(2, 1)
+
+    # 按预计涨跌排序
+    fund_pic_data.sort(key=lambda x: x['fund_expect_growth'], reverse=False)
+
+    # 提取数据用于绘图
+    funds_names = [fund['name'] for fund in fund_pic_data]
+    fund_expect_growths = [fund['fund_expect_growth'] for fund in fund_pic_data]
+
+    # 子图 1：预计涨跌
+    axes[0].barh(funds_names, fund_expect_growths, color=['r' if x >= 0 else 'g' for x in fund_expect_growths])
+    axes[0].set_title('预计涨跌')
+    axes[0].set_xlabel('涨跌 (%)')
+    axes[0].set_ylabel('基金')
+
+    # 添加数据标签
+    for i, v in enumerate(fund_expect_growths):
+        axes[0].text(v, i, f"{v}%", va='center', color='black')
+
+    # 按实际涨跌排序
+    fund_pic_data.sort(key=lambda x: x['fund_change_amount'], reverse=False)
+
+    # 提取数据用于绘图
+    funds_names = [fund['name'] for fund in fund_pic_data]
+    fund_change_amounts = [fund['fund_change_amount'] for fund in fund_pic_data]
+
+    # 子图 2：实际涨跌
+    axes[1].barh(funds_names, fund_change_amounts, color=['r' if x >= 0 else 'g' for x in fund_change_amounts])
+    axes[1].set_title('预计涨跌金额')
+    axes[1].set_xlabel('涨跌 (元)')
+
+    # 添加数据标签
+    for i, v in enumerate(fund_change_amounts):
+        axes[1].text(v, i, f"{v}元", va='center', color='black')
+
+    _figure.tight_layout()
+    buffer = io.BytesIO()
+    _figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # 使用 spawn 避免 fork 继承事件循环和调度线程的状态
+        _executor = ProcessPoolExecutor(max_workers=CHART_CONFIG.get("workers", 2),
+                                        mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def render_fund_growth(report):
+    """
+    在绘图进程池中渲染报告的涨跌排名图，不阻塞事件循环。
+
+    :param report: 报告条目列表
+    :return: PNG 图片字节
+    """
+    fund_pic_data = [{
+        "name": item["fund_name"],
+        "fund_expect_growth": item["expect_growth"],
+        "fund_change_amount": item["expect_change_amount"]} for item in report]
+    loop = asyncio.get_running_loop()
+    with timed(render_latency):
+        return await loop.run_in_executor(get_executor(), _draw_fund_growth, fund_pic_data)
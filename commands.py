@@ -1,34 +1,35 @@
 import asyncio
 import datetime
 import decimal
-import json
-import re
-import ssl
+import functools
+import logging
+import time
 from decimal import Decimal, ROUND_DOWN
 
-import requests
-import matplotlib.pyplot as plt
-from sqlalchemy import NullPool, and_, distinct, or_, select, update
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
-from telegram import Bot, InputFile
+import httpx
+from sqlalchemy import and_, distinct, or_, select, update
 
+import charts
+import history
+import resilience
+import snapshots
 from config import load_config
+from db import async_session, db_config, upsert
+from delivery import get_delivery_queue
+from metrics import Counter, Histogram, timed
 from models import FundDetail, UserFund
+from quotes import (
+    HEADERS, QUOTE_CONFIG, REALTIME_URL, api_latency, get_http_client, get_quote_client, parse_jsonp, quote_cache)
 
 config = load_config("config.yml")
-db_config = config['database']
 bot_config = config['telegram_bot']
 TOKEN = bot_config['token']
 API = config["fund_api"]
 
-DATABASE_URL = db_config['url']
-# SSL参数
-ssl_args = {
-    'ssl': ssl.create_default_context(cafile='cacert.pem')
-}
-engine = create_async_engine(DATABASE_URL, connect_args=ssl_args, echo=True, poolclass=NullPool)
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+logger = logging.getLogger(__name__)
+
+detail_chunk_latency = Histogram("fund_api_detail_chunk_seconds", "基金详情分块请求耗时（含重试）", ("outcome",))
+detail_chunk_failures = Counter("fund_api_detail_chunk_failures_total", "基金详情分块请求失败次数", ("final",))
 
 
 class FundApi:
@@ -42,7 +43,9 @@ class FundApi:
         :param keyword: 用于搜索基金的关键字
         :return: API响应的JSON数据
         """
-        response = requests.get(f"{FundApi.BASE_URL}/all", params={"keyWord": keyword})
+        import requests
+
+        response = requests.get(f"{FundApi.BASE_URL}/all", params={"keyWord": keyword}, timeout=API.get("timeout", 10))
         if response.status_code == 200:
             return response.json()
         else:
@@ -64,7 +67,9 @@ class FundApi:
         if end_date:
             params["endDate"] = end_date
 
-        response = requests.get(f"{FundApi.BASE_URL}/detail/list", params=params)
+        import requests
+
+        response = requests.get(f"{FundApi.BASE_URL}/detail/list", params=params, timeout=API.get("timeout", 10))
         if response.status_code == 200:
             return response.json()["data"]
         else:
@@ -72,60 +77,201 @@ class FundApi:
 
     @staticmethod
     def get_real_time_fund(codes):
+        """
+        同步获取基金实时估值，批量场景请使用 quotes.RealtimeQuoteClient。
+
+        :param codes: 基金代码列表
+        :return: 估值数据列表
+        """
+        import requests
+
         res_data = []
         for code in codes:
-            url = f"http://fundgz.1234567.com.cn/js/{code}.js"
-            # 浏览器头
-            headers = {'content-type': 'application/json',
-                       'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:22.0) Gecko/20100101 Firefox/22.0'}
-
-            r = requests.get(url, headers=headers)
-            # 返回信息
-            content = r.text
-            # 正则表达式
-            pattern = r'^jsonpgz\((.*)\)'
-            # 查找结果
-            search = re.findall(pattern, content)
-            # 遍历结果
-            print(search)
-            if len(search) > 0 and search[0] != "":
-                data = json.loads(search[0])
+            try:
+                r = _realtime_session().get(REALTIME_URL.format(code=code), headers=HEADERS,
+                                          timeout=QUOTE_CONFIG.get("timeout", 5))
+            except requests.RequestException:
+                continue
+            data = parse_jsonp(r.text)
+            if data:
                 res_data.append(data)
         return res_data
 
 
+@functools.lru_cache(maxsize=None)
+def _realtime_session():
+    # 复用连接，避免每次请求都重新握手；requests 只有同步接口用到，按需导入
+    import requests
+
+    return requests.Session()
+
+
+class AsyncFundApi:
+    """
+    FundApi 的异步版本，所有请求共用当前事件循环的 httpx 连接池并设置超时，不阻塞命令处理。
+
+    每个接口经过 resilience 中对应端点的截止时间和熔断器，熔断打开时直接抛出 resilience.CircuitOpen。
+    """
+    BASE_URL = API["base_url"]
+
+    def __init__(self, client=None, timeout=None):
+        self.client = client or get_http_client()
+        self.timeout = httpx.Timeout(timeout or API.get("timeout", 10))
+
+    async def search_funds(self, keyword):
+        """
+        使用关键字搜索基金。
+
+        :param keyword: 用于搜索基金的关键字
+        :return: API响应的JSON数据
+        """
+        async def request():
+            response = await self.client.get(f"{self.BASE_URL}/all", params={"keyWord": keyword},
+                                             timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+
+        with timed(api_latency, "search"):
+            return await resilience.call("search", request)
+
+    async def get_all_funds(self):
+        """
+        获取完整的基金列表，用于本地基金目录。
+
+        :return: [[代码, 简拼, 名称, 类型, 全拼], ...]
+        """
+        async def request():
+            response = await self.client.get(f"{self.BASE_URL}/all", timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()["data"]
+
+        with timed(api_latency, "all"):
+            return await resilience.call("all", request)
+
+    async def get_fund_details(self, codes, start_date=None, end_date=None):
+        """
+        获取一个或多个基金的详细信息。
+
+        :param codes: 基金代码列表
+        :param start_date: 开始日期（可选）
+        :param end_date: 结束日期（可选）
+        :return: API响应的JSON数据
+        """
+        params = {"code": ",".join(codes)}
+        if start_date:
+            params["startDate"] = start_date
+        if end_date:
+            params["endDate"] = end_date
+
+        async def request():
+            response = await self.client.get(f"{self.BASE_URL}/detail/list", params=params, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()["data"]
+
+        with timed(api_latency, "detail"):
+            return await resilience.call("detail", request)
+
+    async def iter_fund_details(self, codes, chunk_size=None, concurrency=None, retries=None):
+        """
+        把基金代码分块并发获取详情，每块返回后立即逐条产出，不等待全部完成。
+
+        单块失败时只重试该块，重试耗尽后跳过该块；统计信息保存在 self.batch_stats。
+
+        :param codes: 基金代码列表
+        :param chunk_size: 每块代码数，默认读取 fund_api.detail_chunk_size
+        :param concurrency: 同时进行的请求数，默认读取 fund_api.detail_concurrency
+        :param retries: 每块的重试次数，默认读取 fund_api.detail_retries
+        :return: 异步生成器，产出单个基金的详情数据
+        """
+        chunk_size = chunk_size or API.get("detail_chunk_size", 50)
+        retries = retries if retries is not None else API.get("detail_retries", 2)
+        semaphore = asyncio.Semaphore(concurrency or API.get("detail_concurrency", 4))
+        chunks = [codes[i:i + chunk_size] for i in range(0, len(codes), chunk_size)]
+        self.batch_stats = {"chunks": len(chunks), "failed_chunks": 0, "retries": 0, "funds": 0,
+                            "failed_codes": []}
+
+        async def fetch_chunk(chunk):
+            started = time.perf_counter()
+            for attempt in range(retries + 1):
+                try:
+                    async with semaphore:
+                        data = await self.get_fund_details(chunk)
+                except (httpx.HTTPError, ValueError, KeyError) as e:
+                    if attempt < retries:
+                        self.batch_stats["retries"] += 1
+                        detail_chunk_failures.inc(1, "no")
+                        logger.warning("Fund detail chunk of %d codes failed (attempt %d): %r", len(chunk),
+                                       attempt + 1, e)
+                        # 退避时不占用并发名额
+                        await asyncio.sleep(min(2 ** attempt, 30))
+                        continue
+                    elapsed = time.perf_counter() - started
+                    detail_chunk_latency.observe(elapsed, "failed")
+                    detail_chunk_failures.inc(1, "yes")
+                    self.batch_stats["failed_chunks"] += 1
+                    self.batch_stats["failed_codes"].extend(chunk)
+                    logger.error("Giving up fund detail chunk %s..%s after %d attempts in %.3fs: %r", chunk[0],
+                                 chunk[-1], attempt + 1, elapsed, e)
+                    return []
+                elapsed = time.perf_counter() - started
+                detail_chunk_latency.observe(elapsed, "ok")
+                logger.info("Fetched %d fund details in %.3fs", len(data), elapsed)
+                return data
+
+        tasks = [asyncio.ensure_future(fetch_chunk(chunk)) for chunk in chunks]
+        try:
+            for future in asyncio.as_completed(tasks):
+                for data in await future:
+                    self.batch_stats["funds"] += 1
+                    yield data
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_real_time_fund(self, codes):
+        """
+        并发获取基金实时估值。
+
+        :param codes: 基金代码列表
+        :return: 估值数据列表
+        """
+        return await get_quote_client().fetch_many(codes)
+
+
 async def subscribe_user_fund(user_id, fund_code, shares):
     async with async_session() as session:
-        # 检查用户是否已订阅该基金
-        stmt = select(UserFund).where(UserFund.user_id == user_id, UserFund.fund_code == fund_code)
+        # 检查用户是否已订阅该基金，只用于决定提示语
+        stmt = select(UserFund.id).where(UserFund.user_id == user_id, UserFund.fund_code == fund_code)
         result = await session.execute(stmt)
-        user_fund = result.scalar_one_or_none()
-
-        if user_fund:
-            # 如果用户已订阅，更新份数
+        message = "份数已更新" if result.first() is not None else "订阅成功"
+
+        # (user_id, fund_code) 唯一，同时订阅同一基金也只会写入一行；已有的订阅更新份数并恢复订阅
+        row = {"user_id": user_id, "fund_code": fund_code, "shares": shares, "unsubscribed_at": None}
+        stmt = upsert(UserFund, [row], ["user_id", "fund_code"])
+        if stmt is not None:
+            await session.execute(stmt)
+        elif message == "份数已更新":
             await session.execute(
                 update(UserFund).
                 where(and_(UserFund.user_id == user_id, UserFund.fund_code == fund_code)).
                 values(shares=shares, unsubscribed_at=None)
             )
-            message = "份数已更新"
         else:
-            # 如果用户未订阅，创建新的订阅记录
-            new_subscription = UserFund(user_id=user_id, fund_code=fund_code, shares=shares)
-            session.add(new_subscription)
-            message = "订阅成功"
+            session.add(UserFund(**row))
 
         await session.commit()
 
-        # 异步获取基金数据并更新FundDetail表
-        asyncio.ensure_future(fetch_and_update_fund_data(fund_code))
+    # 份数变化立即反映到快照；新基金的详情拉取完成后会再重建一次
+    await rebuild_report_snapshots(user_id)
+    # 异步获取基金数据并更新FundDetail表
+    asyncio.ensure_future(fetch_and_update_fund_data(fund_code, user_id))
 
-        return message
+    return message
 
 
-async def fetch_and_update_fund_data(fund_code):
-    fund_api = FundApi()
-    fund_data = fund_api.get_fund_details([fund_code])  # 假设get_fund_data是异步的并返回基金数据
+async def fetch_and_update_fund_data(fund_code, user_id=None):
+    fund_api = AsyncFundApi()
+    fund_data = await fund_api.get_fund_details([fund_code])
     data = fund_data[0]
     async with async_session() as session:
         # 更新或插入基金数据到FundDetail表
@@ -156,6 +302,7 @@ async def fetch_and_update_fund_data(fund_code):
         # 在这里你可能需要一个更复杂的逻辑来处理数据更新
         # 例如，如果数据已存在，你可能想更新它而不是插入一个新的记录
         await session.merge(fund_detail)  # 使用merge来处理可能的更新
+        await history.append_history(session, {data["code"]: data.get("netWorthData")})
         # 更新UserFund表中的fund_name字段
         await session.execute(
             update(UserFund).
@@ -164,149 +311,282 @@ async def fetch_and_update_fund_data(fund_code):
             values(fund_name=data["name"])
         )
         await session.commit()
+    if user_id is not None:
+        await rebuild_report_snapshots(user_id)
 
 
-async def get_daily_report(user_id, need_diagram=False):
-    async with async_session() as session:
-        # 获取用户订阅的基金
-        subscribed_funds = await session.execute(
-            select(UserFund.fund_code, UserFund.shares).where(
-                UserFund.user_id == user_id, UserFund.unsubscribed_at.is_(None))
-        )
-        subscribed_funds_list = subscribed_funds.all()
-
-        report = []
-        total_amount = 0
-        total_expect_change_amount = 0
-        fund_pic_data = []
-        if len(subscribed_funds_list) == 0:
-            return "您当前没有订阅任何基金。", None
-
-        # 获取基金详情并计算涨跌金额
-        for fund in subscribed_funds_list:
-            fund_code, shares = fund
-            fund_detail = await session.execute(
-                select(FundDetail.code,
+FUND_REPORT_COLUMNS = (FundDetail.code,
                        FundDetail.name,
                        FundDetail.net_worth,
                        FundDetail.expect_worth,
                        FundDetail.expect_growth,
-                       FundDetail.day_growth).where(FundDetail.code == fund_code)
-            )
-            fund_detail = fund_detail.first()
-            if not fund_detail:
-                continue
-            data = FundApi().get_real_time_fund([fund_code])
-
-            # 计算估计的涨跌金额
-            if len(data) > 0:
-                expect_worth = Decimal(str(data[0]["gsz"]))
-                expect_growth = Decimal(str(data[0]["gszzl"])) / 100
-                expect_growth_str = str(data[0]["gszzl"])
-            else:
-                expect_worth = Decimal(str(fund_detail.expect_worth))
-                expect_growth = Decimal(str(fund_detail.expect_growth)) / 100
-                expect_growth_str = str(fund_detail.expect_growth)
-
-            expect_yesterday_worth = (expect_worth / (1 + expect_growth)).quantize(Decimal('0.0001'),
-                                                                                   rounding=ROUND_DOWN)
-            expect_growth_value = (expect_yesterday_worth * expect_growth).quantize(Decimal('0.0001'),
-                                                                                    rounding=ROUND_DOWN)
-            expect_change_amount = (shares * expect_growth_value).quantize(Decimal('0.0001'), rounding=ROUND_DOWN)
-            # 计算实际的涨跌金额
-            net_worth = Decimal(str(fund_detail.net_worth))
-            day_growth = Decimal(str(fund_detail.day_growth)) / decimal.Decimal(100)
-            yesterday_worth = (net_worth / (1 + day_growth)).quantize(Decimal('0.0001'), rounding=ROUND_DOWN)
-            real_growth_value = (yesterday_worth * day_growth).quantize(Decimal('0.0001'), rounding=ROUND_DOWN)
-            change_amount = (shares * real_growth_value).quantize(Decimal('0.0001'), rounding=ROUND_DOWN)
-
-            if need_diagram:
-                fund_pic_data.append({
-                    "name": fund_detail.name,
-                    "fund_expect_growth": expect_growth * 100,
-                    "fund_change_amount": expect_change_amount})
-
-            # 添加到报告中
-            report.append({
-                "fund_code": fund.fund_code,
-                "fund_name": fund_detail.name,
-                "change_amount": change_amount,
-                "expect_change_amount": expect_change_amount,
-                "shares": shares,
-                "expect_growth": expect_growth * 100,
-                "expect_worth": expect_growth_str,
-                "net_worth": fund_detail.net_worth,
-            })
-
-            # 计算总金额
-            total_amount += change_amount
-            total_expect_change_amount += expect_change_amount
-        # 格式化报告并返回给用户
-        message = "日报：\n---------------------\n"
-        for item in report:
-            message += (
-                f"{item['fund_name']}({item['fund_code']}): \n"
-                f"实际涨跌金额={item['change_amount']}元, \n"
-                f"预估涨跌金额={item['expect_change_amount']}元, \n"
-                f"预估涨跌百分比={item['expect_growth']}%, \n"
-                f"持有份数={item['shares']}, \n"
-                f"预估净值={item['expect_worth']}, \n"
-                f"实际净值={item['net_worth']}\n"
-                "---------------------\n"
-            )
-        message += f"总金额：{total_amount}元\n"
-        message += f"预估总金额：{total_expect_change_amount}元\n"
-        filename = None
-        if need_diagram:
-            # 按预计涨跌排序
-            fund_pic_data.sort(key=lambda x: x['fund_expect_growth'], reverse=False)
-
-            # 提取数据用于绘图
-            funds_names = [fund['name'] for fund in fund_pic_data]
-            fund_expect_growths = [fund['fund_expect_growth'] for fund in fund_pic_data]
-
-            # 创建一个 1x2 的子图网格（1行，2列）
-            fig, axes = plt.subplots(2, 1, figsize=(10, 10))
-
-            # 选择一个支持中文的字体
-            plt.rcParams['font.sans-serif'] = ['Microsoft YaHei', 'Heiti TC', 'PingFang SC']  # 尝试使用不同的字体
-            plt.rcParams['axes.unicode_minus'] = False  # 确保负号 '-' 正确显示
-
-            # 子图 1：预计涨跌
-            axes[0].barh(funds_names, fund_expect_growths, color=['r' if x >= 0 else 'g' for x in fund_expect_growths])
-            axes[0].set_title('预计涨跌')
-            axes[0].set_xlabel('涨跌 (%)')
-            axes[0].set_ylabel('基金')
-
-            # 添加数据标签
-            for i, v in enumerate(fund_expect_growths):
-                axes[0].text(v, i, f"{v}%", va='center', color='black')
-
-            # 按实际涨跌排序
-            fund_pic_data.sort(key=lambda x: x['fund_change_amount'], reverse=False)
-
-            # 提取数据用于绘图
-            funds_names = [fund['name'] for fund in fund_pic_data]
-            fund_change_amounts = [fund['fund_change_amount'] for fund in fund_pic_data]
-
-            # 子图 2：实际涨跌
-            axes[1].barh(funds_names, fund_change_amounts, color=['r' if x >= 0 else 'g' for x in fund_change_amounts])
-            axes[1].set_title('预计涨跌金额')
-            axes[1].set_xlabel('涨跌 (元)')
-
-            # 添加数据标签
-            for i, v in enumerate(fund_change_amounts):
-                axes[1].text(v, i, f"{v}元", va='center', color='black')
+                       FundDetail.day_growth,
+                       FundDetail.expect_worth_date)
+
+
+def compute_fund_change(fund_detail, quote):
+    """
+    计算单个基金每份的预估涨跌和实际涨跌，与持有份数无关，同一基金只需计算一次。
+
+    :param fund_detail: 包含 FUND_REPORT_COLUMNS 字段的查询结果
+    :param quote: 实时估值数据，没有时使用数据库中的估值
+    :return: 每份涨跌数据字典，stale 表示估值来自过期缓存，或实时估值接口熔断时改用了数据库中的估值
+    """
+    # 计算估计的涨跌金额
+    if quote:
+        expect_worth = Decimal(str(quote["gsz"]))
+        expect_growth = Decimal(str(quote["gszzl"])) / 100
+        expect_growth_str = str(quote["gszzl"])
+        estimated_at = datetime.datetime.strptime(quote["gztime"], "%Y-%m-%d %H:%M") if quote.get("gztime") else None
+        stale = quote.get("stale", False)
+    else:
+        expect_worth = Decimal(str(fund_detail.expect_worth))
+        # 上游返回 "--" 等无法解析的涨跌时保存为空，按 0 计算，不影响其他基金和用户
+        expect_growth = (fund_detail.expect_growth or 0) / Decimal(100)
+        expect_growth_str = str(fund_detail.expect_growth or 0)
+        estimated_at = fund_detail.expect_worth_date
+        stale = resilience.get_breaker("realtime").state != resilience.CLOSED
+
+    expect_yesterday_worth = (expect_worth / (1 + expect_growth)).quantize(Decimal('0.0001'),
+                                                                           rounding=ROUND_DOWN)
+    expect_growth_value = (expect_yesterday_worth * expect_growth).quantize(Decimal('0.0001'),
+                                                                            rounding=ROUND_DOWN)
+    # 计算实际的涨跌金额
+    net_worth = Decimal(str(fund_detail.net_worth))
+    day_growth = (fund_detail.day_growth or 0) / Decimal(100)
+    yesterday_worth = (net_worth / (1 + day_growth)).quantize(Decimal('0.0001'), rounding=ROUND_DOWN)
+    real_growth_value = (yesterday_worth * day_growth).quantize(Decimal('0.0001'), rounding=ROUND_DOWN)
+    return {
+        "fund_code": fund_detail.code,
+        "fund_name": fund_detail.name,
+        "expect_growth": expect_growth * 100,
+        "expect_worth": expect_growth_str,
+        "expect_growth_value": expect_growth_value,
+        "real_growth_value": real_growth_value,
+        "net_worth": fund_detail.net_worth,
+        "estimated_at": estimated_at,
+        "stale": stale,
+    }
+
+
+def build_report_item(fund_change, shares):
+    """
+    根据每份涨跌和持有份数计算单个持仓的报告条目。
+    """
+    change_amount = (shares * fund_change["real_growth_value"]).quantize(Decimal('0.0001'), rounding=ROUND_DOWN)
+    expect_change_amount = (shares * fund_change["expect_growth_value"]).quantize(Decimal('0.0001'),
+                                                                                 rounding=ROUND_DOWN)
+    return {
+        "fund_code": fund_change["fund_code"],
+        "fund_name": fund_change["fund_name"],
+        "change_amount": change_amount,
+        "expect_change_amount": expect_change_amount,
+        "shares": shares,
+        "expect_growth": fund_change["expect_growth"],
+        "expect_worth": fund_change["expect_worth"],
+        "net_worth": fund_change["net_worth"],
+        "estimated_at": fund_change["estimated_at"],
+        "stale": fund_change["stale"],
+    }
+
+
+def render_report(report):
+    """
+    把报告条目格式化为消息文本。
+    """
+    total_amount = 0
+    total_expect_change_amount = 0
+    # 格式化报告并返回给用户
+    message = "日报：\n---------------------\n"
+    for item in report:
+        message += (
+            f"{item['fund_name']}({item['fund_code']}){'*' if item.get('stale') else ''}: \n"
+            f"实际涨跌金额={item['change_amount']}元, \n"
+            f"预估涨跌金额={item['expect_change_amount']}元, \n"
+            f"预估涨跌百分比={item['expect_growth']}%, \n"
+            f"持有份数={item['shares']}, \n"
+            f"预估净值={item['expect_worth']}, \n"
+            f"实际净值={item['net_worth']}\n"
+            "---------------------\n"
+        )
+        # 计算总金额
+        total_amount += item['change_amount']
+        total_expect_change_amount += item['expect_change_amount']
+    message += f"总金额：{total_amount}元\n"
+    message += f"预估总金额：{total_expect_change_amount}元\n"
+    # 估值时间取自实时估值，各基金的估值时间不同时给出范围
+    estimated = sorted({item["estimated_at"] for item in report if item.get("estimated_at")})
+    if estimated:
+        times = [moment.strftime("%Y-%m-%d %H:%M") for moment in (estimated[0], estimated[-1])]
+        message += f"估值时间：{times[0] if times[0] == times[1] else ' ~ '.join(times)}\n"
+    if any(item.get("stale") for item in report):
+        message += "* 实时估值暂时不可用，使用的是最近一次保存的估值\n"
+    return message
 
-            # 调整子图之间的间距
-            plt.tight_layout(pad=4.0)
 
-            current_date = datetime.datetime.now().strftime("%Y%m%d")
-            filename = f"{user_id}_{current_date}_fund_growth.png"
-            # 保存图表为文件
-            plt.tight_layout()
-            plt.savefig(filename)
-        return message, filename
+async def get_daily_report(user_id, need_diagram=False):
+    # 优先读取刷新任务生成的快照，还没有快照时现场计算并补上
+    report = await snapshots.load_snapshot(user_id)
+    if not report:
+        report = await rebuild_report_snapshots(user_id)
+    if not report:
+        return "您当前没有订阅任何基金。", None
+    if any(item.get("stale") for item in report) and not resilience.get_breaker("realtime").is_open:
+        # 快照用的是过期估值，先返回，后台用新的估值重建
+        _revalidate_snapshot(user_id)
+
+    image = await charts.render_fund_growth(report) if need_diagram else None
+    return render_report(report), image
+
+
+# 正在后台重建快照的用户
+_revalidating = set()
+
+
+def _revalidate_snapshot(user_id):
+    if user_id in _revalidating:
+        return
+    _revalidating.add(user_id)
+
+    async def revalidate():
+        try:
+            await rebuild_report_snapshots(user_id)
+        except Exception:
+            logger.exception("Failed to revalidate report snapshot for user %s", user_id)
+        finally:
+            _revalidating.discard(user_id)
+
+    asyncio.ensure_future(revalidate())
+
+
+def build_report_items(holdings):
+    """
+    用 NumPy 批量计算多个持仓的报告条目，结果与逐条调用 build_report_item 完全一致。
+
+    :param holdings: [(每份涨跌数据, 持有份数), ...]
+    :return: 报告条目列表
+    """
+    if not holdings:
+        return []
+    # NumPy 只在批量生成日报时用到，按需导入以加快启动
+    import numpy as np
+
+    import portfolio
+
+    fund_index = {}
+    fund_changes = []
+    holding_funds = []
+    for fund_change, _ in holdings:
+        index = fund_index.get(id(fund_change))
+        if index is None:
+            index = fund_index[id(fund_change)] = len(fund_changes)
+            fund_changes.append(fund_change)
+        holding_funds.append(index)
+    holding_funds = np.asarray(holding_funds)
+
+    shares, shares_negative, exact = portfolio.to_fixed([shares for _, shares in holdings], portfolio.SHARES_SCALE)
+    amounts = {}
+    for key, growth_key in (("change_amount", "real_growth_value"), ("expect_change_amount", "expect_growth_value")):
+        # 每份涨跌已经是 4 位小数，可以无损转换为定点数
+        growth_value = np.asarray([int(fc[growth_key].scaleb(4)) for fc in fund_changes], dtype=np.int64)
+        growth_negative = np.asarray([fc[growth_key].is_signed() for fc in fund_changes])
+        amounts[key] = portfolio.to_decimals(
+            portfolio.change_amounts(shares, growth_value[holding_funds]),
+            shares_negative ^ growth_negative[holding_funds])
+
+    items = []
+    for i, (fund_change, holding_shares) in enumerate(holdings):
+        if not exact[i]:
+            # 份数超出定点精度时逐条计算
+            items.append(build_report_item(fund_change, holding_shares))
+            continue
+        items.append({
+            "fund_code": fund_change["fund_code"],
+            "fund_name": fund_change["fund_name"],
+            "change_amount": amounts["change_amount"][i],
+            "expect_change_amount": amounts["expect_change_amount"][i],
+            "shares": holding_shares,
+            "expect_growth": fund_change["expect_growth"],
+            "expect_worth": fund_change["expect_worth"],
+            "net_worth": fund_change["net_worth"],
+            "estimated_at": fund_change["estimated_at"],
+            "stale": fund_change["stale"],
+        })
+    return items
+
+
+def _active_holdings(user_id=None):
+    active = and_(UserFund.unsubscribed_at.is_(None), UserFund.fund_code == FundDetail.code)
+    if user_id is not None:
+        active = and_(active, UserFund.user_id == user_id)
+    return active
+
+
+def user_reports_query(user_id=None):
+    """
+    日报读取有效订阅及基金详情的查询，user_funds 一侧只用到 ix_user_funds_user_active 中的列（和主键）。
+    """
+    return (
+        select(UserFund.user_id, UserFund.shares, *FUND_REPORT_COLUMNS).
+        where(_active_holdings(user_id)).
+        order_by(UserFund.user_id, UserFund.id)
+    )
+
+
+async def iter_user_reports(user_id=None):
+    """
+    以基金为中心批量计算用户的报告条目。
+
+    一次流式查询读出全部有效订阅及基金详情，每个基金的每份涨跌只计算一次，
+    所有持仓的涨跌金额用 NumPy 一次算出，再按用户分组。
+
+    :param user_id: 只计算该用户，为空时计算所有订阅用户
+    :return: 异步生成器，逐个产出 (用户ID, 报告条目列表)
+    """
+    async with async_session() as session:
+        # 先并发取回所有涉及基金的实时估值
+        result = await session.execute(select(distinct(FundDetail.code)).where(_active_holdings(user_id)))
+        fund_codes = [row[0] for row in result]
+        quotes = await quote_cache.get_many(fund_codes)
+
+        stmt = user_reports_query(user_id)
+        fund_changes = {}
+        user_ids = []
+        holdings = []
+        rows = await session.stream(stmt)
+        async for row in rows:
+            fund_change = fund_changes.get(row.code)
+            if fund_change is None:
+                fund_change = fund_changes[row.code] = compute_fund_change(row, quotes.get(row.code))
+            user_ids.append(row.user_id)
+            holdings.append((fund_change, row.shares))
+
+    items = build_report_items(holdings)
+    start = 0
+    for end in range(1, len(items) + 1):
+        if end == len(items) or user_ids[end] != user_ids[start]:
+            yield user_ids[start], items[start:end]
+            start = end
+
+
+async def rebuild_report_snapshots(user_id=None):
+    """
+    重新计算并替换日报快照。
+
+    :param user_id: 只重建该用户的快照，为空时重建所有用户
+    :return: 指定用户时返回该用户的报告条目列表，否则返回写入快照的用户数
+    """
+    generation = snapshots.begin_rebuild(user_id)
+    if user_id is None:
+        return await snapshots.replace_snapshots(iter_user_reports(), generation=generation)
+    reports = [item async for item in iter_user_reports(user_id)]
+
+    async def user_reports():
+        for item in reports:
+            yield item
+
+    await snapshots.replace_snapshots(user_reports(), user_id, generation)
+    return reports[0][1] if reports else []
 
 
 async def get_all_fund_codes_from_db():
@@ -318,35 +598,92 @@ async def get_all_fund_codes_from_db():
     return fund_codes
 
 
+async def get_realtime_targets():
+    """
+    获取实时估值刷新的目标基金，有订阅用户的基金排在前面。
+
+    :return: [(基金代码, 是否有订阅, 已保存的估值时间, 已保存的估值), ...]
+    """
+    subscribed = (
+        select(UserFund.fund_code).
+        where(UserFund.fund_code == FundDetail.code, UserFund.unsubscribed_at.is_(None)).
+        exists()
+    )
+    async with async_session() as session:
+        stmt = (
+            select(FundDetail.code, subscribed, FundDetail.expect_worth_date, FundDetail.expect_worth).
+            where(FundDetail.deleted_at.is_(None))
+        )
+        result = await session.execute(stmt)
+        targets = [tuple(row) for row in result]
+    # sort 是稳定排序，同一组内保持原顺序
+    targets.sort(key=lambda target: not target[1])
+    return targets
+
+
+def parse_growth(value):
+    """
+    把接口返回的涨跌百分比转换为 Decimal，空值或无法解析（例如 "--"）时为 None。
+    """
+    if value is None or value == "":
+        return None
+    try:
+        growth = Decimal(str(value))
+    except decimal.InvalidOperation:
+        return None
+    return growth if growth.is_finite() else None
+
+
+def fund_detail_values(fund_data):
+    """
+    把基金详情接口返回的数据转换为 FundDetail 的字段。
+    """
+    return dict(
+        name=fund_data["name"],
+        type=fund_data["type"],
+        net_worth=fund_data["netWorth"],
+        total_worth=fund_data["totalWorth"],
+        day_growth=parse_growth(fund_data["dayGrowth"]),
+        last_week_growth=parse_growth(fund_data["lastWeekGrowth"]),
+        last_month_growth=parse_growth(fund_data["lastMonthGrowth"]),
+        last_three_months_growth=parse_growth(fund_data["lastThreeMonthsGrowth"]),
+        last_six_months_growth=parse_growth(fund_data["lastSixMonthsGrowth"]),
+        last_year_growth=parse_growth(fund_data["lastYearGrowth"]),
+        buy_min=float(fund_data.get("buyMin", "0")) if fund_data.get("buyMin") else None,
+        buy_source_rate=float(fund_data.get("buySourceRate", "0")) if fund_data.get("buySourceRate") else None,
+        buy_rate=float(fund_data.get("buyRate", "0")) if fund_data.get("buyRate") else None,
+        manager=fund_data["manager"],
+        fund_scale=fund_data["fundScale"],
+        worth_date=datetime.datetime.strptime(fund_data["netWorthDate"], "%Y-%m-%d"),
+        # 历史净值单独追加到 fund_net_worth_history，不再整块重写 history_data
+        # 如果API返回其他日期字段，也按照上面的方式处理
+    )
+
+
+def fund_realtime_values(fund_data):
+    """
+    把实时估值接口返回的数据转换为 FundDetail 的字段。
+    """
+    values = dict(
+        expect_worth=fund_data["gsz"],
+        expect_growth=parse_growth(fund_data["gszzl"]),
+    )
+    if fund_data.get("gztime"):
+        values["expect_worth_date"] = datetime.datetime.strptime(fund_data["gztime"], "%Y-%m-%d %H:%M")
+    return values
+
+
 async def update_fund_detail_in_db(fund_data):
     async with async_session() as session:
         # 构建更新语句
         stmt = (
             update(FundDetail).
             where(FundDetail.code == fund_data["code"]).
-            values(
-                name=fund_data["name"],
-                type=fund_data["type"],
-                net_worth=fund_data["netWorth"],
-                total_worth=fund_data["totalWorth"],
-                day_growth=fund_data["dayGrowth"],
-                last_week_growth=fund_data["lastWeekGrowth"],
-                last_month_growth=fund_data["lastMonthGrowth"],
-                last_three_months_growth=fund_data["lastThreeMonthsGrowth"],
-                last_six_months_growth=fund_data["lastSixMonthsGrowth"],
-                last_year_growth=fund_data["lastYearGrowth"],
-                buy_min=float(fund_data.get("buyMin", "0")) if fund_data.get("buyMin") else None,
-                buy_source_rate=float(fund_data.get("buySourceRate", "0")) if fund_data.get("buySourceRate") else None,
-                buy_rate=float(fund_data.get("buyRate", "0")) if fund_data.get("buyRate") else None,
-                manager=fund_data["manager"],
-                fund_scale=fund_data["fundScale"],
-                worth_date=datetime.datetime.strptime(fund_data["netWorthDate"], "%Y-%m-%d"),
-                history_data=fund_data["netWorthData"],
-                # 如果API返回其他日期字段，也按照上面的方式处理
-            )
+            values(**fund_detail_values(fund_data))
         )
         # 执行更新语句
         await session.execute(stmt)
+        await history.append_history(session, {fund_data["code"]: fund_data.get("netWorthData")})
         # 提交事务
         await session.commit()
 
@@ -357,10 +694,7 @@ async def update_fund_realtime_in_db(fund_data):
         stmt = (
             update(FundDetail).
             where(FundDetail.code == fund_data["fundcode"]).
-            values(
-                expect_worth=fund_data["gsz"],
-                expect_growth=fund_data["gszzl"],
-            )
+            values(**fund_realtime_values(fund_data))
         )
         # 执行更新语句
         await session.execute(stmt)
@@ -368,6 +702,69 @@ async def update_fund_realtime_in_db(fund_data):
         await session.commit()
 
 
+async def _iter_chunks(payloads, chunk_size):
+    chunk = []
+    if hasattr(payloads, "__aiter__"):
+        async for payload in payloads:
+            chunk.append(payload)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    else:
+        for payload in payloads:
+            chunk.append(payload)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+async def bulk_write_fund_details(payloads, to_values, code_key, chunk_size=None, on_chunk=None):
+    """
+    按块批量写入基金数据，每块一条多行 upsert 语句、一个事务。
+
+    :param payloads: 接口返回数据的可迭代对象或异步可迭代对象
+    :param to_values: 把单条数据转换为 FundDetail 字段的函数
+    :param code_key: 单条数据中基金代码的键名
+    :param chunk_size: 每块行数，默认读取 database.bulk_chunk_size
+    :param on_chunk: 可选的 async 回调 (session, chunk)，与该块在同一事务中执行
+    :return: 每块的统计信息列表
+    """
+    chunk_size = chunk_size or db_config.get("bulk_chunk_size", 500)
+    stats = []
+    async with async_session() as session:
+        async for chunk in _iter_chunks(payloads, chunk_size):
+            started = time.perf_counter()
+            # 同一块内重复的代码只保留最后一条
+            rows = list({data[code_key]: dict(code=data[code_key], **to_values(data)) for data in chunk}.values())
+            stmt = upsert(FundDetail, rows, ["code"])
+            if stmt is not None:
+                result = await session.execute(stmt)
+                affected = result.rowcount
+            else:
+                await session.execute(update(FundDetail), rows)
+                affected = len(rows)
+            if on_chunk is not None:
+                await on_chunk(session, chunk)
+            await session.commit()
+            elapsed = time.perf_counter() - started
+            stats.append({"rows": len(rows), "affected": affected, "elapsed": elapsed})
+            logger.info("Bulk wrote %d fund rows (%d affected) in %.3fs", len(rows), affected, elapsed)
+    return stats
+
+
+async def bulk_update_fund_details(payloads, chunk_size=None):
+    async def append_history(session, chunk):
+        await history.append_history(session, {data["code"]: data.get("netWorthData") for data in chunk})
+
+    return await bulk_write_fund_details(payloads, fund_detail_values, "code", chunk_size, append_history)
+
+
+async def bulk_update_fund_realtime(payloads, chunk_size=None):
+    return await bulk_write_fund_details(payloads, fund_realtime_values, "fundcode", chunk_size)
+
+
 async def get_subscribers():
     async with async_session() as session:
         # 查询所有不同的用户ID
@@ -376,20 +773,30 @@ async def get_subscribers():
         return subscribers
 
 
-async def send_message_to_user(user_id, message, image_path):
-    bot = Bot(token=TOKEN)  # 使用你的 Telegram bot token
+async def send_message_to_user(user_id, message, image):
+    """
+    把消息和图片放入共享发送队列，由队列负责限速和重试。
+    """
+    await get_delivery_queue().put(user_id, message, image)
+
 
-    await bot.send_message(chat_id=user_id, text=message)
-    with open(image_path, 'rb') as image_file:
-        await bot.send_photo(chat_id=user_id, photo=InputFile(image_file))
+def subscriptions_query(user_id):
+    """
+    /list 读取用户有效订阅的查询：user_funds 一侧只用到 ix_user_funds_user_active 中的列，基金名称按主键读取。
+    """
+    return (
+        select(UserFund.fund_code, FundDetail.name.label("fund_name"), UserFund.shares).
+        outerjoin(FundDetail, FundDetail.code == UserFund.fund_code).
+        where(UserFund.user_id == user_id, UserFund.unsubscribed_at.is_(None)).
+        order_by(UserFund.fund_code)
+    )
 
 
 async def list_subscriptions_for_user(user_id):
     async with async_session() as session:
         # 查询用户订阅的所有基金
-        stmt = select(UserFund).where(UserFund.user_id == user_id, UserFund.unsubscribed_at.is_(None))
-        result = await session.execute(stmt)
-        subscriptions = result.scalars().all()
+        result = await session.execute(subscriptions_query(user_id))
+        subscriptions = result.all()
 
         if not subscriptions:
             return "您当前没有订阅任何基金。"
@@ -416,4 +823,5 @@ async def unsubscribe_user_fund(user_id, fund_code):
             return f"未找到代码为 {fund_code} 的订阅。"
 
         await session.commit()
-        return f"已取消订阅代码为 {fund_code} 的基金。"
+    await rebuild_report_snapshots(user_id)
+    return f"已取消订阅代码为 {fund_code} 的基金。"
@@ -1,7 +1,17 @@
+import functools
+import os
+
 import yaml
 
 
+@functools.lru_cache(maxsize=None)
+def _load(path):
+    with open(path, 'r') as file:
+        return yaml.safe_load(file)
+
+
 def load_config(file_path):
-    with open(file_path, 'r') as file:
-        config = yaml.safe_load(file)
-    return config
\ No newline at end of file
+    """
+    读取配置文件，同一个文件在进程内只解析一次，各模块共用同一个字典，不要修改它。
+    """
+    return _load(os.path.abspath(file_path))
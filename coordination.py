@@ -0,0 +1,370 @@
+"""
+多进程部署时基于数据库的协调：leader 租约和可认领的工作批次。
+
+多个进程共用同一个数据库（SQLite 或 MySQL）：
+- 只有持有 scheduler 租约的进程运行定时任务，leader 退出或失联后租约过期，由其他进程接替；
+- 广播和基金详情刷新由 leader 拆成批次写入 work_batches 表，所有进程认领处理，
+  处理中定期续约，进程崩溃后批次租约过期，由其他进程重新认领；
+- 广播的每个会话送达后写入 delivery_records，批次被接手时跳过已送达的会话。
+
+广播是至少一次送达，不保证恰好一次：会话在送达之后才写入记录，批次被接手时，原进程已经交给发送队列、
+但还没有写入记录的消息仍会发出，接手的进程也会再发一次；进程在发送和写入记录之间崩溃时同样会重复。
+
+所有认领都是带条件的 UPDATE，只依赖受影响行数判断是否成功，不需要行锁；
+租约时间使用各进程的本地时钟，多台机器部署时需要同步时间。
+"""
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import socket
+
+from sqlalchemy import and_, delete, distinct, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from config import load_config
+from db import async_session
+from delivery import set_active_nodes
+from metrics import Counter, Gauge
+from models import DeliveryRecord, Lease, WorkBatch
+
+config = load_config("config.yml")
+COORDINATION_CONFIG = config.get("coordination", {})
+ENABLED = COORDINATION_CONFIG.get("enabled", False)
+NODE_ID = COORDINATION_CONFIG.get("node_id") or f"{socket.gethostname()}:{os.getpid()}"
+
+LEASE_TTL = COORDINATION_CONFIG.get("lease_ttl", 30)
+RENEW_INTERVAL = COORDINATION_CONFIG.get("renew_interval", 10)
+BATCH_LEASE_TTL = COORDINATION_CONFIG.get("batch_lease_ttl", 120)
+POLL_INTERVAL = COORDINATION_CONFIG.get("poll_interval", 5)
+MAX_ATTEMPTS = COORDINATION_CONFIG.get("max_attempts", 3)
+RUN_TIMEOUT = COORDINATION_CONFIG.get("run_timeout", 3600)
+BROADCAST_BATCH_SIZE = COORDINATION_CONFIG.get("broadcast_batch_size", 200)
+DETAILS_BATCH_SIZE = COORDINATION_CONFIG.get("details_batch_size", 500)
+# 每个进程的存活租约，租约名有长度限制，使用节点名的摘要
+NODE_LEASE_PREFIX = "node:"
+NODE_LEASE = NODE_LEASE_PREFIX + hashlib.sha1(NODE_ID.encode()).hexdigest()
+# 每次认领时最多尝试的候选批次数，多个进程同时认领时不会都争抢第一个
+CLAIM_CANDIDATES = 5
+
+logger = logging.getLogger(__name__)
+
+is_leader = Gauge("coordination_is_leader", "本进程是否持有 leader 租约")
+batches_total = Counter("coordination_batches_total", "本进程处理的批次数", ("job", "outcome"))
+
+# {任务名: 协程函数(run_id, payload)}
+_handlers = {}
+
+
+def register_handler(job, handler):
+    """
+    注册批次处理函数，认领到该任务的批次时调用 handler(run_id, payload)。
+    """
+    _handlers[job] = handler
+
+
+async def acquire_lease(name, holder=NODE_ID, ttl=LEASE_TTL):
+    """
+    获取或续约租约：租约不存在、已过期或本来就由 holder 持有时成功。
+
+    :return: 是否持有租约
+    """
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    async with async_session() as session:
+        result = await session.execute(
+            update(Lease).
+            where(Lease.name == name, or_(Lease.holder == holder, Lease.expires_at < now)).
+            values(holder=holder, expires_at=expires_at)
+        )
+        if result.rowcount == 0:
+            # 租约由其他进程持有且未过期
+            if (await session.execute(select(Lease.name).where(Lease.name == name))).first() is not None:
+                return False
+            # 租约还不存在时插入，其他进程同时插入会违反主键约束
+            session.add(Lease(name=name, holder=holder, expires_at=expires_at))
+        try:
+            await session.commit()
+        except IntegrityError:
+            return False
+    return True
+
+
+async def count_active_nodes():
+    """
+    :return: 存活租约未过期的进程数
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(func.count()).select_from(Lease).
+            where(Lease.name.like(f"{NODE_LEASE_PREFIX}%"), Lease.expires_at >= datetime.datetime.now())
+        )
+        return result.scalar()
+
+
+async def release_lease(name, holder=NODE_ID):
+    """
+    主动释放租约，其他进程下一次续约时即可接替，不用等待过期。
+    """
+    async with async_session() as session:
+        await session.execute(
+            update(Lease).
+            where(Lease.name == name, Lease.holder == holder).
+            values(expires_at=datetime.datetime.now())
+        )
+        await session.commit()
+
+
+async def create_run(run_id, job, payloads):
+    """
+    把一次任务拆成批次写入，同一个 run_id 只会创建一次。
+
+    :param run_id: 运行ID，例如 broadcast:2025-01-02，重复触发同一次运行时不会重复创建
+    :param job: 任务名，对应 register_handler 注册的处理函数
+    :param payloads: 每个批次的内容
+    :return: 是否新创建了这次运行
+    """
+    async with async_session() as session:
+        result = await session.execute(select(WorkBatch.id).where(WorkBatch.run_id == run_id).limit(1))
+        if result.first() is not None:
+            return False
+        rows = [{"run_id": run_id, "job": job, "seq": seq, "payload": payload, "status": "pending", "attempts": 0}
+                for seq, payload in enumerate(payloads)]
+        if rows:
+            await session.execute(insert(WorkBatch), rows)
+        try:
+            await session.commit()
+        except IntegrityError:
+            return False
+    return True
+
+
+async def run_status(run_id):
+    """
+    :return: {状态: 批次数}
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(WorkBatch.status, func.count()).where(WorkBatch.run_id == run_id).group_by(WorkBatch.status))
+        return dict(result.all())
+
+
+async def wait_run(run_id, timeout=RUN_TIMEOUT):
+    """
+    等待一次运行的所有批次完成或失败，超时后返回当前状态。
+
+    :return: {状态: 批次数}
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        status = await run_status(run_id)
+        if not status.get("pending") and not status.get("claimed"):
+            return status
+        if asyncio.get_running_loop().time() > deadline:
+            logger.warning("Run %s not finished after %ss: %s", run_id, timeout, status)
+            return status
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def _claimable(now):
+    return or_(WorkBatch.status == "pending",
+               and_(WorkBatch.status == "claimed", WorkBatch.lease_expires_at < now))
+
+
+async def claim_batch(jobs, holder=NODE_ID, ttl=BATCH_LEASE_TTL):
+    """
+    认领一个待处理或租约已过期的批次。
+
+    :param jobs: 本进程能处理的任务名
+    :return: 认领到的 WorkBatch，没有可认领的批次时为 None
+    """
+    now = datetime.datetime.now()
+    async with async_session() as session:
+        # 尝试次数用完仍未完成的批次不再认领
+        await session.execute(
+            update(WorkBatch).
+            where(WorkBatch.status == "claimed", WorkBatch.lease_expires_at < now,
+                  WorkBatch.attempts >= MAX_ATTEMPTS).
+            values(status="failed", finished_at=now)
+        )
+        await session.commit()
+        result = await session.execute(
+            select(WorkBatch.id).
+            where(WorkBatch.job.in_(jobs), _claimable(now)).
+            order_by(WorkBatch.id).
+            limit(CLAIM_CANDIDATES)
+        )
+        for batch_id in result.scalars().all():
+            claimed = await session.execute(
+                update(WorkBatch).
+                where(WorkBatch.id == batch_id, _claimable(now)).
+                values(status="claimed", claimed_by=holder, attempts=WorkBatch.attempts + 1,
+                       lease_expires_at=now + datetime.timedelta(seconds=ttl))
+            )
+            await session.commit()
+            if claimed.rowcount == 1:
+                return await session.get(WorkBatch, batch_id)
+    return None
+
+
+async def renew_batch(batch_id, holder=NODE_ID, ttl=BATCH_LEASE_TTL):
+    """
+    :return: 是否仍然持有该批次
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            update(WorkBatch).
+            where(WorkBatch.id == batch_id, WorkBatch.claimed_by == holder, WorkBatch.status == "claimed").
+            values(lease_expires_at=datetime.datetime.now() + datetime.timedelta(seconds=ttl))
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def finish_batch(batch_id, status="done", holder=NODE_ID):
+    """
+    结束批次：status 为 done 表示完成，pending 表示放回等待重新认领，failed 表示放弃。
+    """
+    async with async_session() as session:
+        await session.execute(
+            update(WorkBatch).
+            where(WorkBatch.id == batch_id, WorkBatch.claimed_by == holder, WorkBatch.status == "claimed").
+            values(status=status, lease_expires_at=None,
+                   finished_at=datetime.datetime.now() if status != "pending" else None)
+        )
+        await session.commit()
+
+
+async def delivered_chat_ids(run_id, chat_ids):
+    """
+    :return: 这次运行中已经处理过（送达或写入死信）的会话ID集合
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(DeliveryRecord.chat_id).
+            where(DeliveryRecord.run_id == run_id, DeliveryRecord.chat_id.in_(chat_ids))
+        )
+        return set(result.scalars().all())
+
+
+async def record_delivery(run_id, chat_id, outcome):
+    async with async_session() as session:
+        session.add(DeliveryRecord(run_id=run_id, chat_id=chat_id, outcome=outcome))
+        try:
+            await session.commit()
+        except IntegrityError:
+            # 同一个会话已经记录过
+            pass
+
+
+async def prune_runs(days=7):
+    """
+    删除 days 天前创建的批次和送达记录。
+    """
+    before = datetime.datetime.now() - datetime.timedelta(days=days)
+    async with async_session() as session:
+        result = await session.execute(select(distinct(WorkBatch.run_id)).where(WorkBatch.created_at < before))
+        run_ids = set(result.scalars().all())
+        if run_ids:
+            await session.execute(delete(DeliveryRecord).where(DeliveryRecord.run_id.in_(run_ids)))
+            await session.execute(delete(WorkBatch).where(WorkBatch.run_id.in_(run_ids)))
+            await session.commit()
+    return len(run_ids)
+
+
+async def _process(batch):
+    """
+    处理一个已认领的批次，处理期间定期续约；续约失败说明批次已被其他进程接手，停止处理。
+    已经交给发送队列的消息不会撤回，可能与接手的进程重复发送（至少一次送达）。
+    """
+    work = asyncio.ensure_future(_handlers[batch.job](batch.run_id, batch.payload))
+    while True:
+        done, _ = await asyncio.wait({work}, timeout=BATCH_LEASE_TTL / 3)
+        if done:
+            break
+        if not await renew_batch(batch.id):
+            logger.warning("Lost claim on batch %s of %s, stopping", batch.id, batch.run_id)
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+            batches_total.inc(1, batch.job, "lost")
+            return
+    try:
+        work.result()
+    except Exception:
+        logger.exception("Batch %s of %s failed (attempt %d)", batch.id, batch.run_id, batch.attempts)
+        await finish_batch(batch.id, "pending" if batch.attempts < MAX_ATTEMPTS else "failed")
+        batches_total.inc(1, batch.job, "error")
+        return
+    await finish_batch(batch.id)
+    batches_total.inc(1, batch.job, "ok")
+
+
+async def work_loop():
+    """
+    不断认领并处理批次，没有可认领的批次时每 poll_interval 秒检查一次。
+    """
+    while True:
+        try:
+            batch = await claim_batch(list(_handlers))
+            if batch is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            await _process(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Work loop error")
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+class Coordinator:
+    """
+    在当前事件循环上运行 leader 选举和批次处理。
+
+    成为 leader 时调用 on_elected，失去租约（包括无法续约）时调用 on_demoted。
+    """
+
+    def __init__(self, on_elected, on_demoted, lease="scheduler"):
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.lease = lease
+        self.leader = False
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._elect()), asyncio.ensure_future(work_loop())]
+        return self
+
+    async def _elect(self):
+        while True:
+            try:
+                acquired = await acquire_lease(self.lease)
+            except Exception:
+                # 无法确认租约时当作已经失去，避免与新的 leader 同时运行定时任务
+                logger.exception("Failed to renew lease %s", self.lease)
+                acquired = False
+            if acquired != self.leader:
+                self.leader = acquired
+                is_leader.set(1 if acquired else 0)
+                logger.info("%s %s lease %s", NODE_ID, "acquired" if acquired else "lost", self.lease)
+                (self.on_elected if acquired else self.on_demoted)()
+            try:
+                # 所有进程共用 Telegram 的全局发送上限，按存活的进程数平分
+                await acquire_lease(NODE_LEASE)
+                set_active_nodes(await count_active_nodes())
+            except Exception:
+                logger.exception("Failed to renew node lease")
+            await asyncio.sleep(RENEW_INTERVAL)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.leader:
+            self.leader = False
+            is_leader.set(0)
+            self.on_demoted()
+            await release_lease(self.lease)
+        await release_lease(NODE_LEASE)
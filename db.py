@@ -0,0 +1,142 @@
+import logging
+import ssl
+import time
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from config import load_config
+from metrics import Histogram, current_command
+from models import Base
+
+config = load_config("config.yml")
+db_config = config['database']
+
+DATABASE_URL = db_config['url']
+
+logger = logging.getLogger(__name__)
+
+query_latency = Histogram("db_query_seconds", "数据库语句耗时", ("command", "kind"))
+
+
+def _engine_options():
+    options = {
+        # SQL 日志只在需要排查时打开
+        "echo": db_config.get("echo", False),
+    }
+    if DATABASE_URL.startswith("mysql"):
+        # SSL参数
+        ca_file = db_config.get("ssl_ca", "cacert.pem")
+        if ca_file:
+            options["connect_args"] = {'ssl': ssl.create_default_context(cafile=ca_file)}
+    if not DATABASE_URL.startswith("sqlite"):
+        pool_config = db_config.get("pool", {})
+        options.update(
+            pool_size=pool_config.get("size", 5),
+            max_overflow=pool_config.get("max_overflow", 10),
+            pool_recycle=pool_config.get("recycle", 1800),
+            pool_pre_ping=pool_config.get("pre_ping", True),
+        )
+    return options
+
+
+_engine = None
+_session_factory = None
+
+
+def get_engine():
+    """
+    第一次使用时才创建引擎，导入本模块不会加载数据库驱动或创建 SSL 上下文。
+    """
+    global _engine, _session_factory
+    if _engine is None:
+        _engine = create_async_engine(DATABASE_URL, **_engine_options())
+        event.listen(_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+        _session_factory = sessionmaker(_engine, expire_on_commit=False, class_=AsyncSession)
+    return _engine
+
+
+def async_session():
+    if _session_factory is None:
+        get_engine()
+    return _session_factory()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "-"
+    query_latency.observe(elapsed, current_command.get(), kind)
+
+
+def latency_summary():
+    """
+    按命令和语句类型汇总数据库耗时。
+
+    :return: 每行一个 "命令 类型 次数 p50 p99" 的文本
+    """
+    lines = []
+    for (command, kind), stats in sorted(query_latency.summary().items()):
+        lines.append(f"{command} {kind} count={stats['count']} "
+                     f"p50={stats['p50'] * 1000:.1f}ms p99={stats['p99'] * 1000:.1f}ms")
+    return "\n".join(lines)
+
+
+def upsert(model, rows, keys, update=True):
+    """
+    构建多行 upsert 语句，不支持的数据库返回 None，由调用方退回普通的更新或插入。
+
+    :param keys: 主键或唯一索引的字段名
+    :param update: keys 冲突时是否用新行更新其余字段，为 False 时保留已有的行
+    """
+    columns = [key for key in rows[0] if key not in keys] if update else []
+    dialect = get_engine().dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(model).values(rows)
+        # 不更新时把主键赋值为自身，冲突的行保持不变
+        return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in columns or keys[:1]})
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(model).values(rows)
+        index_elements = [getattr(model, key) for key in keys]
+        if not columns:
+            return stmt.on_conflict_do_nothing(index_elements=index_elements)
+        return stmt.on_conflict_do_update(index_elements=index_elements,
+                                          set_={column: stmt.excluded[column] for column in columns})
+    return None
+
+
+def _add_missing_columns(conn):
+    """
+    给已有的表补上模型中新增的可空列，旧数据中这些列为空；列类型、索引和约束的变化由 migrations.py 完成。
+    """
+    inspector = inspect(conn)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or column.primary_key or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            logger.info("Added column %s.%s", table.name, column.name)
+
+
+async def create_tables():
+    """
+    创建尚不存在的表，并给已有的表补上新增的可空列，已有的列不会被修改。
+    """
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import time
+import weakref
+from dataclasses import dataclass
+
+from telegram import Bot, InputFile
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+
+from config import load_config
+from db import async_session
+from metrics import Counter, Gauge, Histogram, timed
+from models import DeliveryDeadLetter
+
+config = load_config("config.yml")
+TOKEN = config['telegram_bot']['token']
+DELIVERY_CONFIG = config.get("delivery", {})
+
+logger = logging.getLogger(__name__)
+
+delivered_total = Counter("delivery_sent_total", "成功送达的消息数")
+failed_total = Counter("delivery_failed_total", "重试后仍失败、进入死信的消息数")
+retries_total = Counter("delivery_retries_total", "发送重试次数", ("reason",))
+queue_depth = Gauge("delivery_queue_depth", "待发送的消息数")
+send_latency = Histogram("telegram_send_seconds", "Telegram 接口调用耗时（不含限速等待）", ("method", "outcome"))
+
+
+class TokenBucket:
+    """
+    令牌桶限速，rate 为每秒补充的令牌数，capacity 为允许的突发量。
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self._tokens = min(self._tokens, self.capacity)
+
+
+@dataclass
+class Delivery:
+    chat_id: int
+    text: str
+    image: bytes = None
+    attempts: int = 0
+    text_sent: bool = False
+    # 送达或放弃后调用 on_done(结果)，结果为 sent 或 dead_letter
+    on_done: object = None
+
+
+class DeliveryQueue:
+    """
+    共用一个 Bot 客户端的并发发送队列。
+
+    全局令牌桶对应 Telegram 每秒的发送上限，同一个会话之间保持最小间隔；多个进程共用同一个 bot 时，
+    上限按存活的进程数平分（见 set_active_nodes），进程数变化后的一个续约间隔内总速率可能短暂超出；
+    遇到 RetryAfter 时整个队列暂停相应时间，网络错误有限次重试，仍失败的写入死信表。
+    """
+
+    def __init__(self, bot=None, concurrency=None, global_rate=None, per_chat_rate=None, max_retries=None,
+                 maxsize=None):
+        self.concurrency = concurrency or DELIVERY_CONFIG.get("concurrency", 32)
+        # Bot 默认的连接池只有 1 个连接，会把并发的 worker 串行化
+        self.bot = bot or Bot(token=TOKEN, request=HTTPXRequest(connection_pool_size=self.concurrency))
+        self.max_retries = max_retries if max_retries is not None else DELIVERY_CONFIG.get("max_retries", 3)
+        self.global_rate = global_rate or DELIVERY_CONFIG.get("global_rate", 30)
+        self._bucket = TokenBucket(self.global_rate / _active_nodes)
+        self._per_chat_interval = 1 / (per_chat_rate or DELIVERY_CONFIG.get("per_chat_rate", 1))
+        self._chat_next_send = {}
+        self._paused_until = 0
+        # 有界队列，图表渲染快于发送时反压生产者，避免图片堆积在内存里
+        self._queue = asyncio.Queue(maxsize or DELIVERY_CONFIG.get("queue_size", 1000))
+        self._workers = []
+        self.sent = 0
+        self.dead_letters = 0
+        self._started_at = None
+
+    def set_active_nodes(self, nodes):
+        self._bucket.set_rate(self.global_rate / nodes)
+
+    def start(self):
+        if not self._workers:
+            self._started_at = time.monotonic()
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def put(self, chat_id, text, image=None, on_done=None):
+        self.start()
+        await self._queue.put(Delivery(chat_id, text, image, on_done=on_done))
+        queue_depth.set(self._queue.qsize())
+
+    async def join(self):
+        await self._queue.join()
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "dead_letters": self.dead_letters,
+            "throughput": self.sent / elapsed if elapsed else 0.0,
+        }
+
+    async def _wait_turn(self, chat_id):
+        # 全局暂停（RetryAfter）、单会话间隔、全局令牌桶依次满足后才能发送
+        while True:
+            now = time.monotonic()
+            wait = max(self._paused_until, self._chat_next_send.get(chat_id, 0)) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._chat_next_send[chat_id] = time.monotonic() + self._per_chat_interval
+        await self._bucket.acquire()
+
+    async def _send(self, delivery):
+        if not delivery.text_sent:
+            await self._wait_turn(delivery.chat_id)
+            with timed(send_latency, "send_message"):
+                await self.bot.send_message(chat_id=delivery.chat_id, text=delivery.text)
+            # 图片失败重试时不再重复发送文字
+            delivery.text_sent = True
+        if delivery.image:
+            await self._wait_turn(delivery.chat_id)
+            with timed(send_latency, "send_photo"):
+                await self.bot.send_photo(chat_id=delivery.chat_id,
+                                          photo=InputFile(delivery.image, filename="fund_growth.png"))
+
+    async def _worker(self):
+        while True:
+            delivery = await self._queue.get()
+            queue_depth.set(self._queue.qsize())
+            try:
+                await self._deliver(delivery)
+            finally:
+                self._queue.task_done()
+                self._prune_chats()
+
+    async def _deliver(self, delivery):
+        while True:
+            try:
+                await self._send(delivery)
+            except RetryAfter as e:
+                # 触发限流时整个队列一起等待，不计入重试次数
+                retries_total.inc(1, "retry_after")
+                self._paused_until = max(self._paused_until, time.monotonic() + _seconds(e.retry_after))
+                continue
+            except (Forbidden, BadRequest) as e:
+                # 用户屏蔽了 bot 或会话不存在，重试没有意义
+                await self._dead_letter(delivery, repr(e))
+                return
+            except (TimedOut, NetworkError) as e:
+                delivery.attempts += 1
+                if delivery.attempts > self.max_retries:
+                    await self._dead_letter(delivery, repr(e))
+                    return
+                retries_total.inc(1, "network")
+                await asyncio.sleep(min(2 ** delivery.attempts, 30))
+                continue
+            except Exception as e:
+                logger.exception("Unexpected error delivering to %s", delivery.chat_id)
+                await self._dead_letter(delivery, repr(e))
+                return
+            self.sent += 1
+            delivered_total.inc()
+            await self._done(delivery, "sent")
+            return
+
+    async def _dead_letter(self, delivery, reason):
+        self.dead_letters += 1
+        failed_total.inc()
+        logger.warning("Giving up delivery to %s after %d attempts: %s", delivery.chat_id, delivery.attempts, reason)
+        try:
+            async with async_session() as session:
+                session.add(DeliveryDeadLetter(chat_id=delivery.chat_id, reason=reason[:255],
+                                               message=delivery.text, attempts=delivery.attempts))
+                await session.commit()
+        except Exception:
+            logger.exception("Failed to record dead letter for %s", delivery.chat_id)
+        await self._done(delivery, "dead_letter")
+
+    @staticmethod
+    async def _done(delivery, outcome):
+        if delivery.on_done is None:
+            return
+        try:
+            await delivery.on_done(outcome)
+        except Exception:
+            logger.exception("Delivery callback failed for %s", delivery.chat_id)
+
+    def _prune_chats(self):
+        if len(self._chat_next_send) > 10000:
+            now = time.monotonic()
+            self._chat_next_send = {chat_id: t for chat_id, t in self._chat_next_send.items() if t > now}
+
+
+def _seconds(retry_after):
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+# 队列的 worker 属于创建它的事件循环
+_queues = weakref.WeakKeyDictionary()
+_shared_bot = None
+# 共用同一个 bot 发送消息的进程数
+_active_nodes = 1
+
+
+def set_active_nodes(nodes):
+    """
+    按进程数平分全局发送速率，由 coordination 在每次续约后调用。
+    """
+    global _active_nodes
+    nodes = max(1, nodes)
+    if nodes == _active_nodes:
+        return
+    _active_nodes = nodes
+    for queue in list(_queues.values()):
+        queue.set_active_nodes(nodes)
+
+
+def bind_bot(bot):
+    """
+    使用 Application 的 Bot 作为发送客户端，与命令处理共用连接。
+    """
+    global _shared_bot
+    _shared_bot = bot
+
+
+def get_delivery_queue():
+    loop = asyncio.get_running_loop()
+    queue = _queues.get(loop)
+    if queue is None:
+        queue = _queues[loop] = DeliveryQueue(bot=_shared_bot)
+    return queue
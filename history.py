@@ -0,0 +1,174 @@
+"""
+基金历史净值存储。
+
+每个基金每天一行，只追加新日期，按日期范围读取为 NumPy 数组。
+"""
+import asyncio
+import datetime
+import sys
+
+from sqlalchemy import func, insert, null, select, update
+
+from db import async_session, create_tables, upsert
+from models import FundDetail, FundNetWorth
+
+# 每条 INSERT 语句的行数：一批基金的历史净值可能有几十万行，一条语句会超出 SQLite 的变量数上限和 MySQL 的包大小
+INSERT_CHUNK = 500
+
+
+def parse_net_worth_data(net_worth_data):
+    """
+    解析基金详情接口返回的 netWorthData。
+
+    :param net_worth_data: [[日期, 净值, 涨幅, 分红说明], ...]
+    :return: [(日期, 净值, 涨幅), ...]，按日期升序
+    """
+    points = []
+    for item in net_worth_data or []:
+        try:
+            worth_date = datetime.datetime.strptime(item[0], "%Y-%m-%d").date()
+            net_worth = float(item[1])
+        except (IndexError, TypeError, ValueError):
+            continue
+        try:
+            day_growth = float(item[2])
+        except (IndexError, TypeError, ValueError):
+            day_growth = None
+        points.append((worth_date, net_worth, day_growth))
+    points.sort(key=lambda point: point[0])
+    return points
+
+
+async def latest_dates(session, codes):
+    """
+    :return: {基金代码: 已存储的最新日期}
+    """
+    result = await session.execute(
+        select(FundNetWorth.code, func.max(FundNetWorth.worth_date)).
+        where(FundNetWorth.code.in_(codes)).
+        group_by(FundNetWorth.code)
+    )
+    return dict(result.all())
+
+
+async def append_history(session, histories):
+    """
+    追加多个基金的历史净值，只写入比已存储日期更新的数据，不提交事务。
+
+    :param session: 数据库会话
+    :param histories: {基金代码: netWorthData}
+    :return: 写入的行数
+    """
+    if not histories:
+        return 0
+    latest = await latest_dates(session, list(histories))
+    rows = []
+    for code, net_worth_data in histories.items():
+        since = latest.get(code)
+        rows.extend(
+            {"code": code, "worth_date": worth_date, "net_worth": net_worth, "day_growth": day_growth}
+            for worth_date, net_worth, day_growth in parse_net_worth_data(net_worth_data)
+            if since is None or worth_date > since
+        )
+    if not rows:
+        return 0
+    written = 0
+    for i in range(0, len(rows), INSERT_CHUNK):
+        chunk = rows[i:i + INSERT_CHUNK]
+        # 同一基金可能同时被两个任务刷新（例如订阅时的拉取和晚间任务），已经写入的日期直接跳过
+        stmt = upsert(FundNetWorth, chunk, ["code", "worth_date"], update=False)
+        if stmt is None:
+            await session.execute(insert(FundNetWorth), chunk)
+            written += len(chunk)
+        else:
+            written += (await session.execute(stmt)).rowcount
+    return written
+
+
+async def load_history(code, start_date=None, end_date=None):
+    """
+    按日期范围读取基金的历史净值。
+
+    :param code: 基金代码
+    :param start_date: 开始日期（含，可选）
+    :param end_date: 结束日期（含，可选）
+    :return: (datetime64[D] 日期数组, float64 净值数组)
+    """
+    stmt = select(FundNetWorth.worth_date, FundNetWorth.net_worth).where(FundNetWorth.code == code)
+    if start_date:
+        stmt = stmt.where(FundNetWorth.worth_date >= start_date)
+    if end_date:
+        stmt = stmt.where(FundNetWorth.worth_date <= end_date)
+    async with async_session() as session:
+        result = await session.execute(stmt.order_by(FundNetWorth.worth_date))
+        rows = result.all()
+    import numpy as np
+
+    dates = np.array([row[0] for row in rows], dtype="datetime64[D]")
+    worth = np.array([row[1] for row in rows], dtype=np.float64)
+    return dates, worth
+
+
+async def load_histories(codes, start_date=None):
+    """
+    一次查询读取多个基金的历史净值。
+
+    :param codes: 基金代码列表
+    :param start_date: 开始日期（含，可选）
+    :return: {基金代码: (datetime64[D] 日期数组, float64 净值数组)}，没有历史的基金不在结果中
+    """
+    stmt = select(FundNetWorth.code, FundNetWorth.worth_date, FundNetWorth.net_worth).where(
+        FundNetWorth.code.in_(codes))
+    if start_date:
+        stmt = stmt.where(FundNetWorth.worth_date >= start_date)
+    async with async_session() as session:
+        result = await session.execute(stmt.order_by(FundNetWorth.code, FundNetWorth.worth_date))
+        rows = result.all()
+    import numpy as np
+
+    histories = {}
+    start = 0
+    for end in range(1, len(rows) + 1):
+        if end == len(rows) or rows[end][0] != rows[start][0]:
+            chunk = rows[start:end]
+            histories[rows[start][0]] = (np.array([row[1] for row in chunk], dtype="datetime64[D]"),
+                                         np.array([row[2] for row in chunk], dtype=np.float64))
+            start = end
+    return histories
+
+
+async def migrate_history_blobs(batch_size=100, clear=False):
+    """
+    一次性把 fund_details.history_data 中的 JSON 转存到历史净值表。
+
+    :param batch_size: 每批处理的基金数
+    :param clear: 转存后是否清空原来的 JSON 字段
+    :return: 写入的行数
+    """
+    await create_tables()
+    async with async_session() as session:
+        result = await session.execute(
+            select(FundDetail.code).where(FundDetail.history_data.is_not(None)).order_by(FundDetail.code))
+        codes = [row[0] for row in result]
+
+    total = 0
+    for i in range(0, len(codes), batch_size):
+        batch = codes[i:i + batch_size]
+        async with async_session() as session:
+            result = await session.execute(
+                select(FundDetail.code, FundDetail.history_data).where(FundDetail.code.in_(batch)))
+            total += await append_history(session, dict(result.all()))
+            if clear:
+                await session.execute(
+                    update(FundDetail).where(FundDetail.code.in_(batch)).values(history_data=null()))
+            await session.commit()
+        print(f"Migrated history for {min(i + batch_size, len(codes))}/{len(codes)} funds, {total} rows")
+    return total
+
+
+if __name__ == '__main__':
+    # python history.py migrate [--clear]
+    if sys.argv[1:2] == ["migrate"]:
+        asyncio.run(migrate_history_blobs(clear="--clear" in sys.argv))
+    else:
+        print("usage: python history.py migrate [--clear]")
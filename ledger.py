@@ -0,0 +1,357 @@
+"""
+交易流水、持仓累计值和定投计划。
+
+每笔买入、卖出、定投写入 fund_transactions，同一个事务中增量更新 fund_positions 的份数、持仓成本和已实现收益，
+并把份数同步到订阅表；总收益只需读取持仓累计值和最新净值，不需要回放流水。
+持仓成本按移动平均法计算：卖出时按平均成本结转，卖出所得与结转成本之差计入已实现收益。
+"""
+import asyncio
+import calendar
+import datetime
+from decimal import Decimal, InvalidOperation, ROUND_DOWN, ROUND_HALF_UP
+
+from sqlalchemy import select, tuple_, update
+
+from commands import fetch_and_update_fund_data, rebuild_report_snapshots
+from db import async_session
+from models import AutoInvestPlan, FundDetail, FundPosition, FundTransaction, UserFund
+
+CENT = Decimal("0.01")
+FOURTH = Decimal("0.0001")
+ZERO = Decimal(0)
+FREQUENCIES = {"daily": "每天", "weekly": "每周", "monthly": "每月"}
+KINDS = {"buy": "买入", "sell": "卖出", "auto_invest": "定投"}
+
+
+def parse_decimal(text):
+    """
+    :return: 正的 Decimal，格式不正确或不是正数时为 None
+    """
+    try:
+        value = Decimal(text)
+    except (InvalidOperation, TypeError):
+        return None
+    return value if value.is_finite() and value > 0 else None
+
+
+def purchase(amount, price, fee_rate):
+    """
+    按金额申购：净申购金额 = 金额 / (1 + 费率)，手续费 = 金额 - 净申购金额，份额 = 净申购金额 / 净值。
+
+    :return: (份额, 手续费)，份额向下取整到 0.01 份
+    """
+    net_amount = (amount / (1 + fee_rate)).quantize(CENT, rounding=ROUND_HALF_UP)
+    return (net_amount / price).quantize(CENT, rounding=ROUND_DOWN), amount - net_amount
+
+
+def apply_trade(position, kind, shares, amount):
+    """
+    把一笔交易累计到持仓上（原地修改）。
+
+    :return: 本笔交易的已实现收益，买入为 0
+    :raises ValueError: 卖出份数超过持有份数
+    """
+    if kind != "sell":
+        position.shares += shares
+        position.cost_basis += amount
+        return ZERO
+    if shares > position.shares:
+        raise ValueError(f"卖出份数超过持有份数 {position.shares}")
+    if shares == position.shares:
+        cost = position.cost_basis
+    else:
+        cost = (position.cost_basis * shares / position.shares).quantize(FOURTH, rounding=ROUND_HALF_UP)
+    realized = amount - cost
+    position.shares -= shares
+    position.cost_basis -= cost
+    position.realized_pnl += realized
+    return realized
+
+
+def first_run_date(frequency, day, start):
+    """
+    :return: start 当天或之后第一个符合定投周期的日期
+    """
+    if frequency == "daily":
+        return start
+    if frequency == "weekly":
+        return start + datetime.timedelta(days=(day - 1 - start.weekday()) % 7)
+    candidate = start.replace(day=min(day, calendar.monthrange(start.year, start.month)[1]))
+    return candidate if candidate >= start else next_run_date(frequency, day, start)
+
+
+def next_run_date(frequency, day, after):
+    """
+    :return: after 之后（不含）下一个符合定投周期的日期
+    """
+    if frequency != "monthly":
+        return first_run_date(frequency, day, after + datetime.timedelta(days=1))
+    year, month = (after.year + 1, 1) if after.month == 12 else (after.year, after.month + 1)
+    candidate = after.replace(day=min(day, calendar.monthrange(after.year, after.month)[1]))
+    if candidate > after:
+        return candidate
+    return datetime.date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+async def _apply_trades(session, trades):
+    """
+    在当前事务中写入一批交易，增量更新持仓并同步订阅份数，不提交事务。
+
+    持仓和订阅各用一次查询读出，同一个持仓的多笔交易按顺序累计。
+    第一次交易时持仓从有效订阅的份数开始（订阅时没有记录成本，按该笔交易的成交净值计入持仓成本），
+    之后订阅份数只加上本批交易的变化量，不覆盖用户用 /sub 修改过的份数。
+
+    :param trades: 交易字典列表，字段与 FundTransaction 相同
+    :return: {(用户ID, 基金代码): FundPosition}
+    """
+    keys = list({(trade["user_id"], trade["fund_code"]) for trade in trades})
+    result = await session.execute(
+        select(FundPosition).where(tuple_(FundPosition.user_id, FundPosition.fund_code).in_(keys)).with_for_update())
+    positions = {(position.user_id, position.fund_code): position for position in result.scalars()}
+    result = await session.execute(
+        select(UserFund).where(tuple_(UserFund.user_id, UserFund.fund_code).in_(keys)))
+    subscriptions = {}
+    for user_fund in result.scalars():
+        subscriptions.setdefault((user_fund.user_id, user_fund.fund_code), []).append(user_fund)
+
+    before = {key: position.shares for key, position in positions.items()}
+    for trade in trades:
+        key = (trade["user_id"], trade["fund_code"])
+        position = positions.get(key)
+        if position is None:
+            subscribed = sum((Decimal(str(user_fund.shares or 0)) for user_fund in subscriptions.get(key, ())
+                              if user_fund.unsubscribed_at is None), ZERO)
+            cost_basis = (subscribed * trade["price"]).quantize(FOURTH, rounding=ROUND_HALF_UP)
+            position = positions[key] = FundPosition(user_id=key[0], fund_code=key[1], shares=subscribed,
+                                                     cost_basis=cost_basis, realized_pnl=ZERO,
+                                                     first_trade_date=trade["trade_date"])
+            before[key] = subscribed
+            session.add(position)
+        trade["realized_pnl"] = apply_trade(position, trade["kind"], trade["shares"], trade["amount"])
+        position.first_trade_date = min(position.first_trade_date or trade["trade_date"], trade["trade_date"])
+        session.add(FundTransaction(**trade))
+
+    # 日报按订阅表中的份数计算，有交易的基金自动订阅
+    for key, position in positions.items():
+        user_funds = subscriptions.get(key)
+        if not user_funds:
+            session.add(UserFund(user_id=key[0], fund_code=key[1], shares=position.shares))
+            continue
+        for user_fund in user_funds:
+            if user_fund.unsubscribed_at is None:
+                user_fund.shares = Decimal(str(user_fund.shares or 0)) + position.shares - before[key]
+            else:
+                # 取消订阅时放弃了原来的份数，重新订阅后以持仓为准
+                user_fund.shares = position.shares
+                user_fund.unsubscribed_at = None
+    return positions
+
+
+async def record_trade(user_id, kind, args):
+    """
+    记录一笔手动买入或卖出。
+
+    :param kind: buy 或 sell
+    :param args: [基金代码, 份数, 成交净值（可选）, 成交日期 YYYY-MM-DD（可选）]
+    :return: 回复消息
+    """
+    fund_code = args[0]
+    shares = parse_decimal(args[1])
+    if shares is None:
+        return "份数必须是正数。"
+    price = parse_decimal(args[2]) if len(args) > 2 else None
+    if len(args) > 2 and price is None:
+        return "成交净值必须是正数。"
+    trade_date = None
+    if len(args) > 3:
+        try:
+            trade_date = datetime.datetime.strptime(args[3], "%Y-%m-%d").date()
+        except ValueError:
+            return "日期格式不正确，例如：2025-01-02"
+
+    async with async_session() as session:
+        result = await session.execute(
+            select(FundDetail.net_worth, FundDetail.worth_date).where(FundDetail.code == fund_code))
+        fund = result.first()
+        if fund is None:
+            # 交易的基金需要出现在 fund_details 中，日报和收益才能计算
+            asyncio.ensure_future(fetch_and_update_fund_data(fund_code))
+        if price is None:
+            if fund is None or not fund.net_worth:
+                return "暂时没有该基金的净值，请稍后再试或提供成交净值。"
+            price = Decimal(str(fund.net_worth))
+        if trade_date is None:
+            trade_date = fund.worth_date.date() if fund is not None and fund.worth_date else datetime.date.today()
+        trade = {"user_id": user_id, "fund_code": fund_code, "kind": kind, "trade_date": trade_date, "shares": shares,
+                 "price": price, "amount": (shares * price).quantize(FOURTH, rounding=ROUND_HALF_UP), "fee": ZERO}
+        try:
+            positions = await _apply_trades(session, [trade])
+        except ValueError as e:
+            return f"{e}。"
+        await session.commit()
+    await rebuild_report_snapshots(user_id)
+
+    position = positions[(user_id, fund_code)]
+    message = (f"已记录{KINDS[kind]} {fund_code} {shares} 份，净值 {price}，日期 {trade_date}。\n"
+               f"当前持有 {position.shares} 份，持仓成本 {position.cost_basis} 元")
+    if kind == "sell":
+        message += f"，本笔收益 {trade['realized_pnl']} 元"
+    return message + "。"
+
+
+async def get_total_return(user_id):
+    """
+    用持仓累计值和最新净值计算每个基金的持有收益和总收益。
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(FundPosition, FundDetail.name, FundDetail.net_worth).
+            outerjoin(FundDetail, FundDetail.code == FundPosition.fund_code).
+            where(FundPosition.user_id == user_id).
+            order_by(FundPosition.first_trade_date, FundPosition.fund_code)
+        )
+        rows = result.all()
+    if not rows:
+        return "您还没有记录任何交易，可以使用 /buy 记录买入。"
+
+    total_cost = total_value = total_realized = ZERO
+    message = "持仓收益：\n---------------------\n"
+    for position, name, net_worth in rows:
+        value = (position.shares * Decimal(str(net_worth or 0))).quantize(CENT, rounding=ROUND_HALF_UP)
+        cost = position.cost_basis.quantize(CENT, rounding=ROUND_HALF_UP)
+        realized = position.realized_pnl.quantize(CENT, rounding=ROUND_HALF_UP)
+        message += (
+            f"{name or position.fund_code}({position.fund_code}): \n"
+            f"持有份数={position.shares.normalize():f}, \n"
+            f"首次买入={position.first_trade_date}, \n"
+            f"持仓成本={cost}元, \n"
+            f"持仓市值={value}元, \n"
+            f"持有收益={value - cost}元, \n"
+            f"已实现收益={realized}元\n"
+            "---------------------\n"
+        )
+        total_cost += cost
+        total_value += value
+        total_realized += realized
+    message += f"总成本：{total_cost}元\n"
+    message += f"总市值：{total_value}元\n"
+    message += f"总收益：{total_value - total_cost + total_realized}元\n"
+    return message
+
+
+async def add_plan(user_id, args):
+    """
+    :param args: [基金代码, 每期金额, daily|weekly|monthly, 周几（1-7）或几号（1-31）]
+    :return: 回复消息
+    """
+    fund_code, amount, frequency = args[0], parse_decimal(args[1]), args[2].lower()
+    if amount is None:
+        return "定投金额必须是正数。"
+    if frequency not in FREQUENCIES:
+        return "定投周期只能是 daily、weekly 或 monthly。"
+    day = None
+    if frequency != "daily":
+        limit = 7 if frequency == "weekly" else 31
+        if len(args) < 4 or not args[3].isdigit() or not 1 <= int(args[3]) <= limit:
+            return "请提供定投日：每周为 1-7（周一到周日），每月为 1-31。"
+        day = int(args[3])
+    start = first_run_date(frequency, day, datetime.date.today())
+    async with async_session() as session:
+        plan = AutoInvestPlan(user_id=user_id, fund_code=fund_code, amount=amount.quantize(CENT),
+                              frequency=frequency, day=day, next_run_date=start)
+        session.add(plan)
+        await session.commit()
+        tracked = await session.execute(select(FundDetail.code).where(FundDetail.code == fund_code))
+        if not tracked.first():
+            asyncio.ensure_future(fetch_and_update_fund_data(fund_code))
+    return f"已添加定投计划 #{plan.id}：{describe_plan(plan)}，首次定投日 {start}。"
+
+
+def describe_plan(plan):
+    if plan.frequency == "weekly":
+        when = f"每周{'一二三四五六日'[plan.day - 1]}"
+    elif plan.frequency == "monthly":
+        when = f"每月{plan.day}日"
+    else:
+        when = FREQUENCIES[plan.frequency]
+    return f"{plan.fund_code} {when}定投 {plan.amount} 元"
+
+
+async def list_plans(user_id):
+    async with async_session() as session:
+        result = await session.execute(
+            select(AutoInvestPlan).
+            where(AutoInvestPlan.user_id == user_id, AutoInvestPlan.deleted_at.is_(None)).
+            order_by(AutoInvestPlan.id)
+        )
+        plans = result.scalars().all()
+    if not plans:
+        return "您当前没有定投计划。"
+    message = "您当前的定投计划：\n"
+    for plan in plans:
+        message += f"#{plan.id} {describe_plan(plan)}，下次定投日 {plan.next_run_date}\n"
+    return message
+
+
+async def remove_plan(user_id, plan_id):
+    async with async_session() as session:
+        result = await session.execute(
+            update(AutoInvestPlan).
+            where(AutoInvestPlan.id == plan_id, AutoInvestPlan.user_id == user_id,
+                  AutoInvestPlan.deleted_at.is_(None)).
+            values(deleted_at=datetime.datetime.now())
+        )
+        if result.rowcount == 0:
+            return f"未找到编号为 {plan_id} 的定投计划。"
+        await session.commit()
+    return f"已删除定投计划 #{plan_id}。"
+
+
+async def apply_auto_invest_plans():
+    """
+    批量执行到期的定投计划，所有计划在一个事务中成交并推进下次定投日，重复运行不会重复定投。
+
+    到期计划按定投日当天或之后第一个公布的净值成交（节假日顺延），净值尚未更新的计划留到下次运行；
+    申购费率取基金详情中的 buy_rate（百分比）。
+
+    :return: (成交的计划数, 等待净值的计划数)
+    """
+    today = datetime.date.today()
+    async with async_session() as session:
+        result = await session.execute(
+            select(AutoInvestPlan).
+            where(AutoInvestPlan.deleted_at.is_(None), AutoInvestPlan.next_run_date <= today).
+            with_for_update()
+        )
+        plans = result.scalars().all()
+        if not plans:
+            return 0, 0
+        result = await session.execute(
+            select(FundDetail.code, FundDetail.net_worth, FundDetail.worth_date, FundDetail.buy_rate).
+            where(FundDetail.code.in_({plan.fund_code for plan in plans}))
+        )
+        funds = {row.code: row for row in result}
+
+        trades = []
+        waiting = 0
+        for plan in plans:
+            fund = funds.get(plan.fund_code)
+            if fund is None or not fund.net_worth or fund.worth_date is None \
+                    or fund.worth_date.date() < plan.next_run_date:
+                waiting += 1
+                continue
+            trade_date = fund.worth_date.date()
+            price = Decimal(str(fund.net_worth))
+            shares, fee = purchase(plan.amount, price, Decimal(str(fund.buy_rate or 0)) / 100)
+            trades.append({"user_id": plan.user_id, "fund_code": plan.fund_code, "kind": "auto_invest",
+                           "trade_date": trade_date, "shares": shares, "price": price, "amount": plan.amount,
+                           "fee": fee, "plan_id": plan.id})
+            plan.last_run_date = trade_date
+            plan.next_run_date = next_run_date(plan.frequency, plan.day, trade_date)
+        if trades:
+            await _apply_trades(session, trades)
+        await session.commit()
+    if trades:
+        await rebuild_report_snapshots()
+    print(f"Applied {len(trades)} auto-invest plans at {datetime.datetime.now()}, {waiting} waiting for net worth")
+    return len(trades), waiting
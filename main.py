@@ -1,35 +1,53 @@
+# 必须最先导入，启动分析模式下才能统计后面所有模块的导入耗时
+import startup
+
+import asyncio
 import atexit
 import datetime
 import logging
+import sys
 
-import requests
-from apscheduler.schedulers.background import BackgroundScheduler
+import httpx
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 
-from commands import FundApi, get_daily_report, list_subscriptions_for_user, subscribe_user_fund, unsubscribe_user_fund
+import charts
+import migrations
+import resilience
+from alerts import add_alert, list_alerts, load_alerts, remove_alert
+from catalog import load_catalog_file, refresh_catalog, search_funds_locally
+from commands import (
+    AsyncFundApi, get_daily_report, list_subscriptions_for_user, subscribe_user_fund, unsubscribe_user_fund)
 from config import load_config
-from tasks import (
-    sync_send_daily_report_to_subscribers, sync_update_fund_details, sync_update_realtime_fund_details)
+from db import create_tables, db_config, latency_summary
+from delivery import bind_bot
+from ledger import add_plan, apply_auto_invest_plans, get_total_return, list_plans, record_trade, remove_plan
+from metrics import start_metrics_server, track_command
+from quotes import close_http_client
+from update_processor import OrderedUpdateProcessor
 
 config = load_config("config.yml")
 # Telegram bot配置
 bot_config = config['telegram_bot']
 TOKEN = bot_config['token']
 BASE_URL = config["fund_api"]["base_url"]
+METRICS_CONFIG = config.get("metrics", {})
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+startup.mark("imports finished")
 
 
+@track_command("daily_report")
 async def daily_report(update_ins: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update_ins.effective_user.id
     message, _ = await get_daily_report(user_id, False)
     await context.bot.send_message(chat_id=update_ins.effective_chat.id, text=message)
 
 
+@track_command("subscribe")
 async def subscribe(update_ins: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
         await context.bot.send_message(chat_id=update_ins.effective_chat.id, text="请提供基金代码和购买份数。")
@@ -41,23 +59,27 @@ async def subscribe(update_ins: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update_ins.effective_chat.id, text=message)
 
 
+@track_command("search")
 async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = ' '.join(context.args)
     if not query:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="请提供一个关键词进行搜索。")
         return
 
-    # 使用FundApi类搜索基金
     try:
-        funds = FundApi.search_funds(query)
-        matching_funds = funds["data"]
-        if not matching_funds:
+        # 优先在本地基金目录中搜索，目录尚未加载时再使用FundApi类搜索基金
+        fund_details = await search_funds_locally(query)
+        if fund_details is None:
+            fund_api = AsyncFundApi()
+            funds = await fund_api.search_funds(query)
+            # Get the codes of the matching funds
+            matching_codes = [fund[0] for fund in funds["data"]]
+            if matching_codes:
+                today = datetime.datetime.today().strftime("%Y/%m/%d")
+                fund_details = await fund_api.get_fund_details(matching_codes, start_date=today, end_date=today)
+        if not fund_details:
             await context.bot.send_message(chat_id=update.effective_chat.id, text="没有找到匹配的基金。")
             return
-        # Get the codes of the matching funds
-        matching_codes = [fund[0] for fund in matching_funds]
-        today = datetime.datetime.today().strftime("%Y/%m/%d")
-        fund_details = FundApi.get_fund_details(matching_codes, start_date=today, end_date=today)
         message = ""
         for fund in fund_details:
             message += f"名称：{fund['name']}\n"
@@ -71,17 +93,21 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
 
         # 处理并发送消息...
-    except requests.RequestException as e:
+    except resilience.UpstreamUnavailable:
+        await update.message.reply_text("抱歉，基金搜索服务暂时不可用，请稍后再试。")
+    except httpx.HTTPError as e:
         # 处理API调用中的错误...
         await update.message.reply_text(f"抱歉，搜索基金时出错：{str(e)}")
 
 
+@track_command("list")
 async def list_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     message = await list_subscriptions_for_user(user_id)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
 
 
+@track_command("unsubscribe")
 async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="请提供要取消订阅的基金代码。")
@@ -93,6 +119,95 @@ async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
 
 
+@track_command("alert")
+async def alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) < 2:
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text="请提供基金代码和预警条件，例如：/alert 000001 +3% 或 /alert 000001 <1.40")
+        return
+
+    fund_code, rule = context.args[:2]
+    message = await add_alert(update.effective_user.id, fund_code, rule)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+@track_command("alerts")
+async def alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = await list_alerts(update.effective_user.id)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+@track_command("unalert")
+async def unalert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or not context.args[0].lstrip("#").isdigit():
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="请提供要删除的预警编号。")
+        return
+
+    message = await remove_alert(update.effective_user.id, int(context.args[0].lstrip("#")))
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+async def _trade(update: Update, context: ContextTypes.DEFAULT_TYPE, kind):
+    if len(context.args) < 2:
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text="请提供基金代码和份数，可选成交净值和日期，例如：/buy 000001 100 1.2345 2025-01-02")
+        return
+
+    message = await record_trade(update.effective_user.id, kind, context.args)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+@track_command("buy")
+async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _trade(update, context, "buy")
+
+
+@track_command("sell")
+async def sell(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _trade(update, context, "sell")
+
+
+@track_command("pnl")
+async def pnl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = await get_total_return(update.effective_user.id)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+@track_command("invest")
+async def invest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        message = await list_plans(update.effective_user.id)
+    elif len(context.args) < 3:
+        message = "请提供基金代码、每期金额和周期，例如：/invest 000001 500 monthly 15 或 /invest 000001 200 weekly 1"
+    else:
+        message = await add_plan(update.effective_user.id, context.args)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+@track_command("uninvest")
+async def uninvest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or not context.args[0].lstrip("#").isdigit():
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="请提供要删除的定投计划编号。")
+        return
+
+    message = await remove_plan(update.effective_user.id, int(context.args[0].lstrip("#")))
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+@track_command("risk")
+async def risk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="请提供基金代码，例如：/risk 000001")
+        return
+
+    # 分析模块依赖 NumPy，第一次使用时才导入
+    from analytics import get_fund_risk
+
+    message = await get_fund_risk(context.args[0])
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+@track_command("help")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = (
         "/subscribe 或 /sub <fund_code> <shares> - 订阅一个基金并设置购买的份额。\n"
@@ -100,11 +215,21 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/list - 列出你当前订阅的所有基金。\n"
         "/search 或 /s <keyword> - 使用关键字搜索基金。\n"
         "/daily_report 或 /repo - 获取你订阅的基金的每日报告。\n"
+        "/alert <fund_code> <+3%|-2%|>1.52|<1.40> - 设置上涨、下跌预警。\n"
+        "/alerts - 列出你设置的预警。\n"
+        "/unalert <id> - 删除一个预警。\n"
+        "/buy <fund_code> <shares> [price] [date] - 记录一笔买入，份数计入订阅。\n"
+        "/sell <fund_code> <shares> [price] [date] - 记录一笔卖出。\n"
+        "/pnl - 查看持仓成本、市值和总收益。\n"
+        "/invest <fund_code> <amount> <daily|weekly|monthly> [day] - 添加定投计划，不带参数时列出定投计划。\n"
+        "/uninvest <id> - 删除一个定投计划。\n"
+        "/risk <fund_code> - 查看基金的最大回撤、收益回撤比、波动率和极限套牢。\n"
         "/help 或 /h - 显示这个帮助消息。"
     )
     await context.bot.send_message(chat_id=update.effective_chat.id, text=help_text)
 
 
+@track_command("start")
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome_text = (
         "欢迎使用我们的基金订阅Bot！🎉\n\n"
@@ -114,14 +239,182 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/list - 列出你当前订阅的所有基金。\n"
         "/search 或 /s <keyword> - 使用关键字搜索基金。\n"
         "/daily_report 或 / repo - 获取你订阅的基金的每日报告。\n"
+        "/alert <fund_code> <+3%|-2%|>1.52|<1.40> - 设置上涨、下跌预警。\n"
+        "/buy、/sell <fund_code> <shares> - 记录买入、卖出，/pnl 查看总收益。\n"
+        "/invest <fund_code> <amount> <daily|weekly|monthly> [day] - 添加定投计划。\n"
         "/help 或 /h - 显示帮助消息。\n\n"
         "如果你有任何问题或建议，随时告诉我们！"
     )
     await context.bot.send_message(chat_id=update.effective_chat.id, text=welcome_text)
 
 
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(TOKEN).build()
+def log_db_latency():
+    summary = latency_summary()
+    if summary:
+        logging.info("DB latency by command:\n%s", summary)
+
+
+def schedule_jobs():
+    # APScheduler 和定时任务模块在后台预热时才导入，不拖慢启动
+    import scheduler
+    from tasks import send_daily_report_to_subscribers, update_fund_details, update_realtime_fund_details
+
+    # 添加一个定时任务，工作日晚上7点到11点，每小时运行一次update_fund_details函数
+    scheduler.add_job("update_fund_details", update_fund_details, 'cron', day_of_week='mon-fri', hour='19-23',
+                      minute=0)
+    scheduler.add_job("update_realtime_fund_details", update_realtime_fund_details, 'cron', day_of_week='mon-fri',
+                      hour='9-16', minute=0)
+
+    # 添加一个定时任务，每天下午2点运行 send_daily_report_to_subscribers 函数
+    scheduler.add_job("send_daily_report_to_subscribers", send_daily_report_to_subscribers, 'cron', hour=14,
+                      minute=0)
+
+    # 工作日晚上基金详情刷新完成后，按当天净值执行到期的定投计划
+    scheduler.add_job("apply_auto_invest_plans", apply_auto_invest_plans, 'cron', day_of_week='mon-fri', hour=23,
+                      minute=30)
+
+    # 每天早上刷新一次本地基金目录
+    scheduler.add_job("refresh_catalog", refresh_catalog, 'cron', hour=7, minute=30)
+
+    # 定期输出各命令的数据库耗时 p50/p99
+    scheduler.add_job("log_db_latency", log_db_latency, 'interval', minutes=10)
+    scheduler.start()
+
+
+def start_scheduling():
+    """
+    单进程部署直接启动定时任务；打开 coordination 后只有持有 leader 租约的进程运行定时任务，
+    所有进程一起认领广播和基金详情刷新的批次。
+
+    :return: Coordinator，没有打开 coordination 时为 None
+    """
+    import coordination
+    if not coordination.ENABLED:
+        schedule_jobs()
+        return None
+    import scheduler
+    # 导入 tasks 时注册批次处理函数
+    import tasks  # noqa: F401
+
+    def on_elected():
+        if scheduler.scheduler.running:
+            scheduler.resume()
+        else:
+            schedule_jobs()
+
+    return coordination.Coordinator(on_elected, scheduler.pause).start()
+
+
+async def prepare_database():
+    """
+    建表并执行尚未执行的迁移，database.auto_migrate 关闭时只建表。
+    """
+    await create_tables()
+    if db_config.get("auto_migrate", True):
+        await migrations.upgrade()
+
+
+async def warm_up(application):
+    """
+    开始轮询后在后台完成的启动工作：加载预警和基金目录、启动定时任务和指标接口。
+    """
+    try:
+        await load_alerts()
+        startup.mark("alerts loaded")
+        # 本地基金目录：先读文件快速启动，文件不存在时在后台从上游拉取
+        if not load_catalog_file():
+            asyncio.ensure_future(refresh_catalog())
+        startup.mark("catalog loaded")
+        # 定时任务运行在 bot 的事件循环上，与命令处理共用连接池和客户端
+        application.bot_data["coordinator"] = start_scheduling()
+        startup.mark("scheduler started")
+        # Prometheus 文本格式的 /metrics 接口，与 bot 运行在同一个事件循环上
+        if METRICS_CONFIG.get("enabled", True):
+            application.bot_data["metrics_server"] = await start_metrics_server(
+                METRICS_CONFIG.get("host", "127.0.0.1"), METRICS_CONFIG.get("port", 9108))
+        startup.mark("warm-up finished")
+    except Exception:
+        logging.exception("Startup warm-up failed")
+    startup.report()
+
+
+async def post_init(application):
+    # 广播和通知复用 Application 的 Bot 客户端
+    bind_bot(application.bot)
+    startup.mark("application initialized")
+    # 命令处理依赖最新的表结构，建表和迁移完成后才开始接收更新，失败时直接退出
+    await prepare_database()
+    startup.mark("tables created")
+    # 其余启动工作不阻塞轮询
+    application.bot_data["warm_up"] = asyncio.ensure_future(warm_up(application))
+
+
+async def post_shutdown(application):
+    import scheduler
+
+    warm_up_task = application.bot_data.pop("warm_up", None)
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+    coordinator = application.bot_data.pop("coordinator", None)
+    if coordinator is not None:
+        await coordinator.stop()
+    scheduler.shutdown()
+    metrics_server = application.bot_data.pop("metrics_server", None)
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await close_http_client()
+
+
+async def run_worker():
+    """
+    不接收 Telegram 更新的后台进程，参与 leader 选举并和 bot 进程一起处理广播和基金详情刷新的批次。
+    """
+    import coordination
+    import scheduler
+
+    if not coordination.ENABLED:
+        raise SystemExit("Worker mode requires coordination.enabled in config.yml")
+    await prepare_database()
+    await load_alerts()
+    coordinator = start_scheduling()
+    logging.info("Worker %s started", coordination.NODE_ID)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await coordinator.stop()
+        scheduler.shutdown()
+        await close_http_client()
+
+
+def webhook_options(webhook_config):
+    """
+    :param webhook_config: telegram_bot.webhook 配置
+    :return: run_webhook 的参数
+    """
+    public_url = (webhook_config.get("url") or "").strip()
+    # 没有公网地址时 PTB 会把监听地址注册为 webhook，Telegram 无法回调，直接拒绝启动
+    if not public_url:
+        raise SystemExit("Webhook mode requires telegram_bot.webhook.url in config.yml")
+    path = webhook_config.get("path", "telegram").strip("/")
+    return {
+        "listen": webhook_config.get("listen", "0.0.0.0"),
+        "port": webhook_config.get("port", 8443),
+        "url_path": path,
+        "webhook_url": f"{public_url.rstrip('/')}/{path}",
+        "secret_token": webhook_config.get("secret_token") or None,
+        "max_connections": webhook_config.get("max_connections", 40),
+    }
+
+
+def main():
+    application = (
+        ApplicationBuilder().token(TOKEN).
+        # 不同用户的命令并发处理，慢的 /repo 不会挡住其他人
+        concurrent_updates(OrderedUpdateProcessor(bot_config.get("workers", 16),
+                                                  bot_config.get("max_pending_updates"))).
+        post_init(post_init).post_shutdown(post_shutdown).build()
+    )
     search_handler = CommandHandler(['search', 's'], search)
     subscribe_handler = CommandHandler(['subscribe', 'sub'], subscribe)
     daily_report_handler = CommandHandler(['daily_report', 'repo'], daily_report)
@@ -129,6 +422,15 @@ if __name__ == '__main__':
     unsubscribe_handler = CommandHandler(['unsubscribe', 'unsub'], unsubscribe)
     help_handler = CommandHandler(['help', 'h'], help_command)
     start_handler = CommandHandler('start', start_command)
+    alert_handler = CommandHandler('alert', alert)
+    alerts_handler = CommandHandler('alerts', alerts)
+    unalert_handler = CommandHandler('unalert', unalert)
+    buy_handler = CommandHandler('buy', buy)
+    sell_handler = CommandHandler('sell', sell)
+    pnl_handler = CommandHandler('pnl', pnl)
+    invest_handler = CommandHandler('invest', invest)
+    uninvest_handler = CommandHandler('uninvest', uninvest)
+    risk_handler = CommandHandler('risk', risk)
     application.add_handler(start_handler)
     application.add_handler(help_handler)
     application.add_handler(search_handler)
@@ -136,19 +438,31 @@ if __name__ == '__main__':
     application.add_handler(daily_report_handler)
     application.add_handler(list_subscriptions_handler)
     application.add_handler(unsubscribe_handler)
+    application.add_handler(alert_handler)
+    application.add_handler(alerts_handler)
+    application.add_handler(unalert_handler)
+    application.add_handler(buy_handler)
+    application.add_handler(sell_handler)
+    application.add_handler(pnl_handler)
+    application.add_handler(invest_handler)
+    application.add_handler(uninvest_handler)
+    application.add_handler(risk_handler)
+    startup.mark("application built")
 
-    # 使用APScheduler来运行定时任务
-    scheduler = BackgroundScheduler()
+    if bot_config.get("mode", "polling") == "webhook":
+        # 在负载均衡器后面接收 Telegram 推送的更新，需要安装 python-telegram-bot[webhooks]
+        application.run_webhook(**webhook_options(bot_config.get("webhook") or {}))
+    else:
+        application.run_polling()
 
-    # 添加一个定时任务，从早上9点到下午4点，每小时运行一次update_fund_details函数
-    scheduler.add_job(sync_update_fund_details, 'cron', day_of_week='mon-fri', hour='19-23', minute=0)
-    scheduler.add_job(sync_update_realtime_fund_details, 'cron', day_of_week='mon-fri', hour='9-16', minute=0)
 
-    # 添加一个定时任务，每天下午2点运行 send_daily_report_to_subscribers 函数
-    scheduler.add_job(sync_send_daily_report_to_subscribers, 'cron', hour=14, minute=00)
-
-    # 开始运行调度器
-    scheduler.start()
-
-    application.run_polling()
-    atexit.register(lambda: scheduler.shutdown())
+if __name__ == '__main__':
+    atexit.register(charts.shutdown)
+    if "--worker" in sys.argv:
+        # python main.py --worker
+        try:
+            asyncio.run(run_worker())
+        except KeyboardInterrupt:
+            pass
+    else:
+        main()
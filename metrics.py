@@ -0,0 +1,207 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+# 当前正在处理的 bot 命令或定时任务，用于给数据库等耗时指标打标签
+current_command = contextvars.ContextVar("current_command", default="-")
+
+logger = logging.getLogger(__name__)
+
+# 所有已创建的指标，按创建顺序导出
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def track_command(name):
+    """
+    装饰器：在处理函数执行期间把 current_command 设置为 name，并记录命令的次数和耗时。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_command.set(name)
+            try:
+                with timed(command_latency, name):
+                    return await func(*args, **kwargs)
+            finally:
+                current_command.reset(token)
+        return wrapper
+    return decorator
+
+
+class Counter:
+    """
+    按标签分组的累加计数器。
+    """
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def series(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(Counter):
+    """
+    可以任意设置的瞬时值。
+    """
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram:
+    """
+    按标签分组的固定分桶耗时直方图，分位数按桶内线性插值估算。
+    """
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # 最后一个桶对应 +Inf
+                series = self._series[label_values] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+
+    def quantile(self, q, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            counts = list(series["counts"]) if series else None
+        if not counts or not sum(counts):
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def series(self):
+        with self._lock:
+            return {labels: {"counts": list(s["counts"]), "sum": s["sum"]} for labels, s in self._series.items()}
+
+    def summary(self):
+        """
+        :return: {标签值: {"count": 次数, "p50": 秒, "p99": 秒}}
+        """
+        return {
+            labels: {"count": sum(s["counts"]), "p50": self.quantile(0.5, *labels), "p99": self.quantile(0.99, *labels)}
+            for labels, s in self.series().items()
+        }
+
+
+@contextlib.contextmanager
+def timed(histogram, *label_values):
+    """
+    记录代码块的耗时，histogram 的最后一个标签为结果（ok/error）。
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        histogram.observe(time.perf_counter() - started, *label_values, outcome)
+
+
+command_latency = Histogram("bot_command_seconds", "bot 命令处理耗时", ("command", "outcome"))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if not isinstance(value, int) else str(value)
+
+
+def render_prometheus():
+    """
+    以 Prometheus 文本格式导出所有指标。
+    """
+    lines = []
+    for metric in REGISTRY:
+        kind = "histogram" if isinstance(metric, Histogram) else "gauge" if isinstance(metric, Gauge) else "counter"
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+        for label_values, value in sorted(metric.series().items()):
+            if kind != "histogram":
+                lines.append(f"{metric.name}{_labels(metric.label_names, label_values)} {_number(value)}")
+                continue
+            # 直方图的桶是累计计数
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float("inf"),), value["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{metric.name}_bucket{_labels(metric.label_names, label_values, [('le', le)])} "
+                             f"{cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(metric.label_names, label_values)} {_number(value['sum'])}")
+            lines.append(f"{metric.name}_count{_labels(metric.label_names, label_values)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # 读完请求头
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status, body, content_type = "404 Not Found", b"not found\n", "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host="127.0.0.1", port=9108):
+    """
+    在当前事件循环上启动 /metrics 接口，只在 bot 进程内运行，不需要额外依赖。
+    """
+    server = await asyncio.start_server(_handle_scrape, host, port)
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,305 @@
+"""
+数据库结构的版本化迁移。
+
+create_tables 只会创建缺少的表、补上新增的可空列，已有列的类型、索引和约束的变化由这里的迁移完成。
+每个迁移有递增的版本号，执行后写入 schema_migrations 表，只执行一次。
+迁移先检查当前结构再修改：新建的数据库由 create_all 直接建成最新结构，迁移不做任何修改；
+MySQL 的 DDL 会隐式提交，迁移中途失败后重新执行也是安全的。
+
+python migrations.py upgrade   执行尚未执行的迁移
+python migrations.py status    列出所有迁移及执行时间
+python migrations.py check     检查常用查询的执行计划是否使用了预期的（覆盖）索引
+"""
+import asyncio
+import datetime
+import decimal
+import sys
+
+from sqlalchemy import delete, inspect, insert, select, text
+from sqlalchemy.types import String
+
+from db import create_tables, get_engine
+from models import FundDetail, ReportSnapshot, SchemaMigration, UserFund
+
+# [(版本号, 名称, 迁移函数(同步连接))]，按版本号顺序执行
+MIGRATIONS = []
+
+GROWTH_COLUMNS = ("expect_growth", "day_growth", "last_week_growth", "last_month_growth",
+                  "last_three_months_growth", "last_six_months_growth", "last_year_growth")
+# 旧版本中与 user_id 前缀相同的单列索引，已被 uq_user_funds_user_fund 取代
+OBSOLETE_INDEXES = {"user_funds": ("ix_user_funds_user_id",)}
+DELETE_CHUNK = 500
+# 迁移中的 DDL（修改列类型、删除索引）只为这些数据库编写
+SUPPORTED_DIALECTS = ("sqlite", "mysql", "postgresql")
+
+
+def migration(version, name):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+
+    return register
+
+
+def _columns(conn, table):
+    return {column["name"]: column for column in inspect(conn).get_columns(table)}
+
+
+def _index_names(conn, table):
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+def _create_missing_indexes(conn, table):
+    existing = _index_names(conn, table.name)
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+            print(f"Created index {index.name}")
+
+
+@migration(1, "report_snapshots.stale")
+def add_snapshot_stale(conn):
+    if "stale" in _columns(conn, ReportSnapshot.__tablename__):
+        return
+    column_type = ReportSnapshot.__table__.c.stale.type.compile(dialect=conn.dialect)
+    # 旧快照的 stale 为空，读出时当作 False，下一次重建时写入
+    conn.execute(text(f"ALTER TABLE report_snapshots ADD COLUMN stale {column_type}"))
+
+
+def _to_number(value):
+    try:
+        number = decimal.Decimal(str(value).strip())
+    except decimal.InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
+
+def _rebuild_sqlite_table(conn, table):
+    """
+    SQLite 不支持修改列类型：把旧表改名，按模型建新表，复制数据后删除旧表。
+
+    NUMERIC 亲和性的列在插入时会把数字字符串转换为数字。上一次重建中断时旧表还在，从旧表重新复制。
+    """
+    old = f"_{table.name}_old"
+    if old not in inspect(conn).get_table_names():
+        for name in _index_names(conn, table.name):
+            conn.execute(text(f"DROP INDEX {name}"))
+        conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old}"))
+        table.create(conn)
+    else:
+        conn.execute(delete(table))
+    columns = ", ".join(name for name in _columns(conn, old) if name in table.c)
+    conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old}"))
+    conn.execute(text(f"DROP TABLE {old}"))
+
+
+@migration(2, "fund_details growth columns to numeric")
+def numeric_growth_columns(conn):
+    table = FundDetail.__table__
+    columns = _columns(conn, table.name)
+    interrupted = f"_{table.name}_old" in inspect(conn).get_table_names()
+    if not interrupted and not any(isinstance(columns[name]["type"], String) for name in GROWTH_COLUMNS):
+        return
+
+    # 无法解析为数字的旧值（空串、"--" 等）置空，否则类型转换会失败
+    if not interrupted:
+        # 用原始 SQL 读出字符串，模型中的列已经是 Numeric
+        rows = conn.execute(text(f"SELECT code, {', '.join(GROWTH_COLUMNS)} FROM fund_details")).all()
+        cleared = 0
+        for row in rows:
+            names = [name for name in GROWTH_COLUMNS
+                     if getattr(row, name) is not None and _to_number(getattr(row, name)) is None]
+            if names:
+                conn.execute(text(f"UPDATE fund_details SET {', '.join(f'{name} = NULL' for name in names)} "
+                                  "WHERE code = :code"), {"code": row.code})
+                cleared += 1
+        if cleared:
+            print(f"Cleared non-numeric growth values of {cleared} funds")
+
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        _rebuild_sqlite_table(conn, table)
+        return
+    column_type = table.c.day_growth.type.compile(dialect=conn.dialect)
+    if dialect == "mysql":
+        changes = ", ".join(f"MODIFY COLUMN {name} {column_type} NULL" for name in GROWTH_COLUMNS)
+    else:
+        # upgrade 已经拒绝了 SUPPORTED_DIALECTS 以外的数据库
+        changes = ", ".join(f"ALTER COLUMN {name} TYPE {column_type} USING {name}::numeric" for name in GROWTH_COLUMNS)
+    conn.execute(text(f"ALTER TABLE fund_details {changes}"))
+
+
+@migration(3, "user_funds unique (user_id, fund_code)")
+def unique_user_fund(conn):
+    table = UserFund.__table__
+    if "uq_user_funds_user_fund" in _index_names(conn, table.name):
+        return
+    # 旧版本并发订阅可能写入了重复行：每个 (user_id, fund_code) 保留有效订阅中 id 最大的一行，没有时保留 id 最大的一行
+    keep = {}
+    duplicates = []
+    rows = conn.execute(select(table.c.id, table.c.user_id, table.c.fund_code, table.c.unsubscribed_at).
+                        order_by(table.c.id))
+    for row in rows:
+        key = (row.user_id, row.fund_code)
+        kept = keep.get(key)
+        if kept is not None and kept.unsubscribed_at is None and row.unsubscribed_at is not None:
+            duplicates.append(row.id)
+            continue
+        if kept is not None:
+            duplicates.append(kept.id)
+        keep[key] = row
+    for i in range(0, len(duplicates), DELETE_CHUNK):
+        conn.execute(delete(table).where(table.c.id.in_(duplicates[i:i + DELETE_CHUNK])))
+    if duplicates:
+        print(f"Removed {len(duplicates)} duplicate subscriptions")
+    next(index for index in table.indexes if index.name == "uq_user_funds_user_fund").create(conn)
+
+
+@migration(4, "covering indexes for user_funds and fund_details")
+def covering_indexes(conn):
+    for table in (UserFund.__table__, FundDetail.__table__):
+        for name in OBSOLETE_INDEXES.get(table.name, ()):
+            if name in _index_names(conn, table.name):
+                conn.execute(text(f"DROP INDEX {name}" if conn.dialect.name != "mysql"
+                                  else f"DROP INDEX {name} ON {table.name}"))
+                print(f"Dropped index {name}")
+        _create_missing_indexes(conn, table)
+
+
+async def applied_migrations():
+    """
+    :return: {版本号: 执行时间}
+    """
+    async with get_engine().connect() as conn:
+        result = await conn.execute(select(SchemaMigration.version, SchemaMigration.applied_at))
+        return dict(result.all())
+
+
+async def upgrade():
+    """
+    建表并依次执行尚未执行的迁移。
+
+    :return: 本次执行的迁移数
+    :raises SystemExit: 有尚未执行的迁移，但数据库不在 SUPPORTED_DIALECTS 中
+    """
+    await create_tables()
+    applied = await applied_migrations()
+    dialect = get_engine().dialect.name
+    pending = [version for version, _, _ in MIGRATIONS if version not in applied]
+    if pending and dialect not in SUPPORTED_DIALECTS:
+        # 启动时直接拒绝，不在迁移中途失败
+        raise SystemExit(f"Migrations {pending} do not support {dialect} databases (supported: "
+                         f"{', '.join(SUPPORTED_DIALECTS)}); set database.auto_migrate to false and migrate manually")
+    count = 0
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+        async with get_engine().begin() as conn:
+            await conn.run_sync(func)
+            await conn.execute(insert(SchemaMigration).values(version=version, name=name,
+                                                              applied_at=datetime.datetime.now()))
+        print(f"Applied migration {version}: {name}")
+        count += 1
+    return count
+
+
+def _plan_checks():
+    """
+    :return: 常用查询和预期的索引 [(说明, 语句, 表名, 索引名, 是否要求只读索引)]，日报和 /list 使用实际的查询
+    """
+    from commands import subscriptions_query, user_reports_query
+
+    return [
+        ("日报按用户读取有效订阅和基金详情", user_reports_query(1), "user_funds", "ix_user_funds_user_active", True),
+        ("/list 读取有效订阅", subscriptions_query(1), "user_funds", "ix_user_funds_user_active", True),
+        ("实时估值刷新判断基金是否有人订阅",
+         select(UserFund.id).where(UserFund.fund_code == "000001", UserFund.unsubscribed_at.is_(None)),
+         "user_funds", "ix_user_funds_fund_active", True),
+        ("订阅时查找已有订阅",
+         select(UserFund.id).where(UserFund.user_id == 1, UserFund.fund_code == "000001"),
+         "user_funds", "uq_user_funds_user_fund", True),
+        ("有效基金代码",
+         select(FundDetail.code).where(FundDetail.deleted_at.is_(None)),
+         "fund_details", "ix_fund_details_active", True),
+    ]
+
+
+def _explain(conn, sql, table):
+    """
+    :return: (执行计划文本, 使用的索引名, 是否只读索引)，不支持的数据库返回 None
+    """
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        details = [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+        plan = "; ".join(details)
+        for detail in details:
+            words = detail.split()
+            if len(words) > 1 and words[1] == table:
+                index = words[words.index("INDEX") + 1] if "INDEX" in words else None
+                return plan, index, "COVERING INDEX" in detail
+        return plan, None, False
+    if dialect == "mysql":
+        rows = conn.execute(text(f"EXPLAIN {sql}")).mappings().all()
+        plan = "; ".join(f"{row['table']}: key={row['key']} extra={row['Extra']}" for row in rows)
+        for row in rows:
+            if row["table"] == table:
+                return plan, row["key"], "Using index" in (row["Extra"] or "")
+        return plan, None, False
+    if dialect == "postgresql":
+        # 表很小时规划器总是选择顺序扫描，检查时关闭顺序扫描，只看索引能否被用上
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        lines = [row[0] for row in conn.execute(text(f"EXPLAIN {sql}"))]
+        plan = "; ".join(line.strip() for line in lines)
+        for line in lines:
+            if " using " in line and f" on {table}" in line:
+                index = line.split(" using ", 1)[1].split()[0]
+                return plan, index, "Index Only Scan" in line
+        return plan, None, False
+    return None
+
+
+def _check_plans(conn):
+    failures = 0
+    for description, stmt, table, expected, covering in _plan_checks():
+        sql = stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+        result = _explain(conn, sql, table)
+        if result is None:
+            print(f"Query plan checks are not supported on {conn.dialect.name}")
+            return 0
+        plan, index, index_only = result
+        ok = index == expected and (index_only or not covering)
+        failures += not ok
+        print(f"[{'ok' if ok else 'FAIL'}] {description}: expected {expected}"
+              f"{' (covering)' if covering else ''}, got {index or 'table scan'}"
+              f"{' (covering)' if index_only else ''}\n    {plan}")
+    return failures
+
+
+async def check():
+    """
+    打印常用查询的执行计划，检查是否使用了预期的索引。
+
+    :return: 不符合预期的查询数
+    """
+    async with get_engine().connect() as conn:
+        return await conn.run_sync(_check_plans)
+
+
+async def status():
+    await create_tables()
+    applied = await applied_migrations()
+    for version, name, _ in MIGRATIONS:
+        print(f"{version:>4} {name}: {applied.get(version) or 'pending'}")
+
+
+if __name__ == '__main__':
+    command = sys.argv[1:2]
+    if command == ["upgrade"]:
+        print(f"{asyncio.run(upgrade())} migrations applied")
+    elif command == ["status"]:
+        asyncio.run(status())
+    elif command == ["check"]:
+        sys.exit(1 if asyncio.run(check()) else 0)
+    else:
+        print("usage: python migrations.py upgrade|status|check")
@@ -1,6 +1,7 @@
 import datetime
 
-from sqlalchemy import Column, DateTime, Float, Integer, Numeric, String
+from sqlalchemy import (
+    BigInteger, Boolean, Column, Date, DateTime, Float, Index, Integer, Numeric, String, Text, UniqueConstraint)
 from sqlalchemy.types import JSON
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -9,19 +10,22 @@ Base = declarative_base()
 
 class FundDetail(Base):
     __tablename__ = 'fund_details'
+    # 覆盖按 deleted_at 筛选有效基金代码的查询
+    __table_args__ = (Index('ix_fund_details_active', 'deleted_at', 'code'),)
     code = Column(String(10), primary_key=True)
     name = Column(String(100))
     type = Column(String(20))
     net_worth = Column(Float)
     expect_worth = Column(Float)
     total_worth = Column(Float)
-    expect_growth = Column(String(10))
-    day_growth = Column(String(10))
-    last_week_growth = Column(String(10))
-    last_month_growth = Column(String(10))
-    last_three_months_growth = Column(String(10))
-    last_six_months_growth = Column(String(10))
-    last_year_growth = Column(String(10))
+    # 涨跌百分比，例如 1.25 表示 1.25%
+    expect_growth = Column(Numeric(10, 4))
+    day_growth = Column(Numeric(10, 4))
+    last_week_growth = Column(Numeric(10, 4))
+    last_month_growth = Column(Numeric(10, 4))
+    last_three_months_growth = Column(Numeric(10, 4))
+    last_six_months_growth = Column(Numeric(10, 4))
+    last_year_growth = Column(Numeric(10, 4))
     buy_min = Column(Float)
     buy_source_rate = Column(Float)
     buy_rate = Column(Float)
@@ -38,11 +42,190 @@ class FundDetail(Base):
 
 class UserFund(Base):
     __tablename__ = 'user_funds'
+    __table_args__ = (
+        # 每个用户每个基金只有一行，取消订阅后再订阅更新同一行
+        Index('uq_user_funds_user_fund', 'user_id', 'fund_code', unique=True),
+        # 覆盖按用户读取有效订阅的查询（日报、/list）
+        Index('ix_user_funds_user_active', 'user_id', 'unsubscribed_at', 'fund_code', 'shares'),
+        # 覆盖刷新实时估值时判断基金是否有人订阅的查询
+        Index('ix_user_funds_fund_active', 'fund_code', 'unsubscribed_at'),
+    )
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, index=True)  # 添加索引
+    user_id = Column(Integer)
     fund_code = Column(String(10))
-    created_at = Column(DateTime, default=datetime.datetime.now())
-    subscribed_at = Column(DateTime, index=True, default=datetime.datetime.now())
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    subscribed_at = Column(DateTime, index=True, default=datetime.datetime.now)
     unsubscribed_at = Column(DateTime, nullable=True, default=None)
     shares = Column(Numeric, default=0.00)
     fund_name = Column(String, nullable=True)
+
+
+class FundNetWorth(Base):
+    __tablename__ = 'fund_net_worth_history'
+    # 主键 (code, worth_date) 即按基金和日期范围查询的索引
+    code = Column(String(10), primary_key=True)
+    worth_date = Column(Date, primary_key=True)
+    net_worth = Column(Float)
+    day_growth = Column(Float)
+
+
+class PriceAlert(Base):
+    __tablename__ = 'price_alerts'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, index=True)
+    fund_code = Column(String(10), index=True)
+    # growth: 预估涨跌百分比，worth: 预估净值
+    kind = Column(String(10))
+    # above: 上涨到阈值，below: 下跌到阈值
+    direction = Column(String(10))
+    threshold = Column(Float)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    last_fired_at = Column(DateTime, nullable=True, default=None)
+    deleted_at = Column(DateTime, nullable=True, default=None)
+
+
+class DeliveryDeadLetter(Base):
+    __tablename__ = 'delivery_dead_letters'
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, index=True)
+    reason = Column(String(255))
+    message = Column(Text)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+
+
+class ReportSnapshot(Base):
+    __tablename__ = 'report_snapshots'
+    # 主键 (user_id, position) 即按用户读取快照的索引，position 保持报告中的基金顺序
+    user_id = Column(BigInteger, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    fund_code = Column(String(10))
+    fund_name = Column(String(100))
+    # 份数和金额按字符串保存，读出后还原为 Decimal，与现场计算的结果逐位一致
+    shares = Column(String(40))
+    change_amount = Column(String(40))
+    expect_change_amount = Column(String(40))
+    expect_growth = Column(String(40))
+    expect_worth = Column(String(20))
+    net_worth = Column(Float)
+    # 估值时间（实时估值的 gztime），以及快照生成时间
+    estimated_at = Column(DateTime, nullable=True)
+    # 估值来自过期缓存或熔断时数据库中的估值
+    stale = Column(Boolean, default=False)
+    built_at = Column(DateTime, index=True)
+
+
+class Lease(Base):
+    __tablename__ = 'coordination_leases'
+    # 租约名，例如 scheduler；holder 在 expires_at 之前持有该租约
+    name = Column(String(50), primary_key=True)
+    holder = Column(String(100))
+    expires_at = Column(DateTime)
+
+
+class WorkBatch(Base):
+    __tablename__ = 'work_batches'
+    # 同一次运行的批次序号唯一，重复创建同一次运行只会成功一次
+    __table_args__ = (UniqueConstraint('run_id', 'seq'),)
+    id = Column(Integer, primary_key=True)
+    run_id = Column(String(100), index=True)
+    job = Column(String(50))
+    seq = Column(Integer)
+    # 批次内容，例如用户ID列表或基金代码列表
+    payload = Column(JSON)
+    # pending: 待认领，claimed: 处理中，done: 已完成，failed: 超过最大尝试次数
+    status = Column(String(10), index=True, default='pending')
+    claimed_by = Column(String(100), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class DeliveryRecord(Base):
+    __tablename__ = 'delivery_records'
+    # 每次广播每个会话一行，批次被其他节点接手时跳过已经发送过的会话
+    run_id = Column(String(100), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    # sent: 已送达，dead_letter: 已放弃并写入死信表
+    outcome = Column(String(20))
+    delivered_at = Column(DateTime, default=datetime.datetime.now)
+
+
+class FundTransaction(Base):
+    __tablename__ = 'fund_transactions'
+    __table_args__ = (Index('ix_fund_transactions_user_fund', 'user_id', 'fund_code'),)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger)
+    fund_code = Column(String(10))
+    # buy: 买入，sell: 卖出，auto_invest: 定投
+    kind = Column(String(12))
+    trade_date = Column(Date)
+    shares = Column(Numeric(20, 4))
+    price = Column(Numeric(20, 4))
+    # 买入为支付的金额（含手续费），卖出为卖出所得（未扣手续费）
+    amount = Column(Numeric(20, 4))
+    fee = Column(Numeric(20, 4), default=0)
+    # 卖出时按平均成本结转的已实现收益
+    realized_pnl = Column(Numeric(20, 4), default=0)
+    plan_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+
+
+class FundPosition(Base):
+    __tablename__ = 'fund_positions'
+    # 交易流水的累计值，每笔交易写入时在同一个事务中增量更新
+    user_id = Column(BigInteger, primary_key=True)
+    fund_code = Column(String(10), primary_key=True)
+    shares = Column(Numeric(20, 4), default=0)
+    # 当前持有份额的成本（含手续费），卖出时按平均成本减少
+    cost_basis = Column(Numeric(20, 4), default=0)
+    realized_pnl = Column(Numeric(20, 4), default=0)
+    first_trade_date = Column(Date)
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+
+class AutoInvestPlan(Base):
+    __tablename__ = 'auto_invest_plans'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, index=True)
+    fund_code = Column(String(10))
+    amount = Column(Numeric(20, 2))
+    # daily: 每天，weekly: 每周 day（1-7 对应周一到周日），monthly: 每月 day 日（超过当月天数时取月末）
+    frequency = Column(String(10))
+    day = Column(Integer, nullable=True)
+    next_run_date = Column(Date, index=True)
+    last_run_date = Column(Date, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    deleted_at = Column(DateTime, nullable=True, default=None)
+
+
+class FundAnalytics(Base):
+    __tablename__ = 'fund_analytics'
+    # 每个基金一行，晚间任务按最新净值日期重新计算
+    code = Column(String(10), primary_key=True)
+    as_of = Column(Date)
+    start_date = Column(Date)
+    points = Column(Integer)
+    annual_return = Column(Float)
+    volatility = Column(Float)
+    max_drawdown = Column(Float)
+    drawdown_peak_date = Column(Date)
+    drawdown_trough_date = Column(Date)
+    drawdown_recovery_date = Column(Date, nullable=True)
+    return_drawdown_ratio = Column(Float, nullable=True)
+    # 最长的水下期：从前高到重新回到前高（或至今）的天数
+    underwater_days = Column(Integer)
+    underwater_start = Column(Date)
+    underwater_end = Column(Date, nullable=True)
+    # 极限套牢：{持有交易日数: [最差收益, 买入日期, 卖出日期]}
+    worst_holding = Column(JSON)
+    computed_at = Column(DateTime, default=datetime.datetime.now)
+
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    # 已执行的迁移，见 migrations.py
+    version = Column(Integer, primary_key=True)
+    name = Column(String(100))
+    applied_at = Column(DateTime, default=datetime.datetime.now)
@@ -0,0 +1,142 @@
+"""
+批量计算持仓涨跌金额的 NumPy 引擎。
+
+舍入规则：与 get_daily_report 中的 Decimal 算法逐条一致，每一步都截断（ROUND_DOWN，向零取整）到 4 位小数::
+
+    昨日净值 = trunc4(净值 / (1 + 涨幅))
+    每份涨跌 = trunc4(昨日净值 * 涨幅)
+    涨跌金额 = trunc4(份数 * 每份涨跌)
+
+为了做到逐位一致，所有数值都转换为 int64 定点数后用整数除法计算：净值、份数、金额按 10^4 缩放，
+涨幅百分比按 10^4 缩放（即涨幅小数按 10^6 缩放）。输入的小数位数超过对应精度时无法精确表示，
+这些行会在 exact 掩码中标记为 False，调用方应退回 Decimal 逐条计算。
+
+Decimal 会保留截断为零时的负号（显示为 -0.0000），这里通过符号位数组单独记录，to_decimals 会还原出相同的结果。
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+
+import numpy as np
+
+WORTH_SCALE = 10 ** 4
+GROWTH_SCALE = 10 ** 4
+SHARES_SCALE = 10 ** 4
+AMOUNT_SCALE = 10 ** 4
+# 涨幅百分比转为小数后的缩放倍数
+GROWTH_FRACTION_SCALE = GROWTH_SCALE * 100
+MAX_EXACT = 2 ** 53 / 1000
+
+
+def to_fixed(values, scale):
+    """
+    把数值（字符串、浮点数或 Decimal）转换为定点整数。
+
+    :return: (定点整数数组, 负号位数组, 能否精确表示的掩码)
+    """
+    floats = np.asarray([float(v) for v in values] if not isinstance(values, np.ndarray) else values,
+                        dtype=np.float64)
+    scaled = floats * scale
+    fixed = np.rint(scaled)
+    # 多出的小数位至少带来 0.1 的偏差，浮点误差在 2^53/1000 以内远小于 1e-3
+    exact = (np.abs(scaled - fixed) < 1e-3) & (np.abs(scaled) < MAX_EXACT)
+    return fixed.astype(np.int64), np.signbit(floats), exact
+
+
+def _trunc_div(numerator, denominator):
+    # numpy 的整数除法向下取整，这里改为向零取整以对应 ROUND_DOWN
+    quotient = np.abs(numerator) // np.abs(denominator)
+    return np.where((numerator < 0) != (denominator < 0), -quotient, quotient)
+
+
+def growth_values(worth, growth_pct):
+    """
+    计算每份涨跌。
+
+    :param worth: 净值定点数组（10^4）
+    :param growth_pct: 涨幅百分比定点数组（10^4）
+    :return: 每份涨跌定点数组（10^4）
+    """
+    yesterday_worth = _trunc_div(worth * GROWTH_FRACTION_SCALE, GROWTH_FRACTION_SCALE + growth_pct)
+    return _trunc_div(yesterday_worth * growth_pct, GROWTH_FRACTION_SCALE)
+
+
+def change_amounts(shares, growth_value):
+    """
+    计算涨跌金额。
+
+    :param shares: 份数定点数组（10^4）
+    :param growth_value: 每份涨跌定点数组（10^4）
+    :return: 涨跌金额定点数组（10^4）
+    """
+    return _trunc_div(shares * growth_value, SHARES_SCALE)
+
+
+def user_totals(user_ids, amounts):
+    """
+    按用户汇总金额。
+
+    :return: (去重后的用户ID数组, 对应的合计金额定点数组)
+    """
+    users, index = np.unique(np.asarray(user_ids), return_inverse=True)
+    totals = np.zeros(len(users), dtype=np.int64)
+    np.add.at(totals, index, amounts)
+    return users, totals
+
+
+def to_decimals(values, negative=None, scale=AMOUNT_SCALE):
+    """
+    把定点整数还原为 Decimal，与 Decimal.quantize(Decimal('0.0001')) 的结果相同。
+    """
+    exponent = -len(str(scale)) + 1
+    if negative is None:
+        negative = np.asarray(values) < 0
+    return [Decimal((int(sign), tuple(int(d) for d in str(abs(int(value)))), exponent))
+            for value, sign in zip(values, negative)]
+
+
+@dataclass
+class PortfolioResult:
+    change_amount: np.ndarray
+    change_negative: np.ndarray
+    expect_change_amount: np.ndarray
+    expect_change_negative: np.ndarray
+    exact: np.ndarray
+    user_ids: np.ndarray
+    total_amount: np.ndarray
+    total_expect_change_amount: np.ndarray
+
+
+def compute_portfolio(user_ids, shares, net_worth, day_growth, expect_worth, expect_growth):
+    """
+    一次计算所有 (用户, 基金) 持仓的实际和预估涨跌金额以及每个用户的合计。
+
+    :param user_ids: 每个持仓的用户ID
+    :param shares: 持有份数
+    :param net_worth: 实际净值
+    :param day_growth: 实际涨幅（百分比）
+    :param expect_worth: 预估净值
+    :param expect_growth: 预估涨幅（百分比）
+    :return: PortfolioResult，金额均为 10^4 定点整数
+    """
+    shares, shares_negative, shares_exact = to_fixed(shares, SHARES_SCALE)
+    net_worth, _, net_worth_exact = to_fixed(net_worth, WORTH_SCALE)
+    day_growth, day_growth_negative, day_growth_exact = to_fixed(day_growth, GROWTH_SCALE)
+    expect_worth, _, expect_worth_exact = to_fixed(expect_worth, WORTH_SCALE)
+    expect_growth, expect_growth_negative, expect_growth_exact = to_fixed(expect_growth, GROWTH_SCALE)
+
+    change_amount = change_amounts(shares, growth_values(net_worth, day_growth))
+    expect_change_amount = change_amounts(shares, growth_values(expect_worth, expect_growth))
+
+    users, total_amount = user_totals(user_ids, change_amount)
+    _, total_expect_change_amount = user_totals(user_ids, expect_change_amount)
+    return PortfolioResult(
+        change_amount=change_amount,
+        # 净值为正，结果的符号由份数和涨幅的符号决定
+        change_negative=shares_negative ^ day_growth_negative,
+        expect_change_amount=expect_change_amount,
+        expect_change_negative=shares_negative ^ expect_growth_negative,
+        exact=shares_exact & net_worth_exact & day_growth_exact & expect_worth_exact & expect_growth_exact,
+        user_ids=users,
+        total_amount=total_amount,
+        total_expect_change_amount=total_expect_change_amount,
+    )
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+
+import resilience
+from config import load_config
+from metrics import Counter, Histogram
+
+config = load_config("config.yml")
+QUOTE_CONFIG = config.get("realtime_quote", {})
+HTTP_CONFIG = config.get("http_client", {})
+
+REALTIME_URL = QUOTE_CONFIG.get("url", "http://fundgz.1234567.com.cn/js/{code}.js")
+# 浏览器头
+HEADERS = {'content-type': 'application/json',
+           'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:22.0) Gecko/20100101 Firefox/22.0'}
+
+JSONP_PREFIX = "jsonpgz("
+
+api_latency = Histogram("fund_api_request_seconds", "基金接口请求耗时", ("endpoint", "outcome"))
+# 命中率 = hit / (hit + stale_hit + miss + coalesced)
+cache_lookups = Counter("quote_cache_lookups_total", "实时估值缓存的查询次数", ("outcome",))
+
+
+def parse_jsonp(content):
+    """
+    解析天天基金实时估值接口返回的 JSONP 文本。
+
+    只做前缀判断和一次 rfind，不使用正则，空结果（``jsonpgz();``）返回 None。
+
+    :param content: 接口返回的文本
+    :return: 估值数据字典或 None
+    """
+    if not content.startswith(JSONP_PREFIX):
+        return None
+    end = content.rfind(")")
+    if end <= len(JSONP_PREFIX):
+        return None
+    return json.loads(content[len(JSONP_PREFIX):end])
+
+
+class RealtimeQuoteClient:
+    """
+    批量获取基金实时估值的异步客户端。
+
+    所有请求共用一个 keep-alive 连接池，并发数由信号量限制，每个请求都有超时。
+    传入 client 时复用外部的连接池，关闭时不会关闭它。
+    """
+
+    def __init__(self, concurrency=None, max_connections=None, timeout=None, client=None):
+        self.concurrency = concurrency or QUOTE_CONFIG.get("concurrency", 64)
+        max_connections = max_connections or QUOTE_CONFIG.get("max_connections", self.concurrency)
+        self.timeout = httpx.Timeout(timeout or QUOTE_CONFIG.get("timeout", 5))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._owns_client = client is None
+        self._client = client or httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        if self._owns_client:
+            await self._client.aclose()
+
+    async def _request(self, code):
+        response = await self._client.get(REALTIME_URL.format(code=code), headers=HEADERS, timeout=self.timeout)
+        if response.status_code >= 500:
+            # 服务端错误计入熔断器
+            response.raise_for_status()
+        return response
+
+    async def fetch(self, code):
+        """
+        获取单个基金的实时估值，经过 realtime 端点的截止时间、熔断和对冲请求。
+
+        :param code: 基金代码
+        :return: 估值数据字典，请求失败、熔断或无估值时返回 None
+        """
+        _, data = await self._fetch(code)
+        return data
+
+    async def _fetch(self, code):
+        """
+        :return: (结果, 估值数据字典或 None)，结果为 ok、empty（没有估值）、failed（请求失败）或 rejected（熔断）
+        """
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                response = await resilience.call("realtime", lambda: self._request(code))
+            except httpx.HTTPError as e:
+                api_latency.observe(time.perf_counter() - started, "realtime", "error")
+                return "rejected" if isinstance(e, resilience.CircuitOpen) else "failed", None
+        try:
+            data = parse_jsonp(response.text) if response.status_code == 200 else None
+        except ValueError:
+            data = None
+        api_latency.observe(time.perf_counter() - started, "realtime",
+                            "error" if response.status_code != 200 else "ok" if data else "empty")
+        if response.status_code != 200:
+            return "failed", None
+        return "ok" if data else "empty", data
+
+    async def _fetch_code(self, code):
+        return (code, *await self._fetch(code))
+
+    async def iter_quotes(self, codes, failures=None):
+        """
+        并发获取多个基金的实时估值，按返回先后顺序逐个产出。
+
+        :param codes: 基金代码列表
+        :param failures: 传入字典时按结果记录没有取到估值的代码，{empty|failed|rejected: [基金代码, ...]}
+        :return: 异步生成器，产出估值数据字典（失败的代码会被跳过）
+        """
+        tasks = [asyncio.ensure_future(self._fetch_code(code)) for code in codes]
+        try:
+            for future in asyncio.as_completed(tasks):
+                code, outcome, data = await future
+                if data:
+                    yield data
+                elif failures is not None:
+                    failures.setdefault(outcome, []).append(code)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fetch_many(self, codes):
+        return [data async for data in self.iter_quotes(codes)]
+
+
+# 每个事件循环共用一个 HTTP 连接池，连接池不能跨事件循环使用
+_http_clients = weakref.WeakKeyDictionary()
+_quote_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client():
+    """
+    获取当前事件循环共享的 httpx 客户端，基金接口和实时估值接口都通过它访问。
+    """
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        max_connections = HTTP_CONFIG.get("max_connections", 100)
+        client = _http_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_CONFIG.get("timeout", 10)),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=HTTP_CONFIG.get("max_keepalive", max_connections)),
+        )
+    return client
+
+
+async def close_http_client():
+    client = _http_clients.pop(asyncio.get_running_loop(), None)
+    _quote_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def get_quote_client():
+    """
+    获取当前事件循环共享的实时估值客户端。
+    """
+    loop = asyncio.get_running_loop()
+    client = _quote_clients.get(loop)
+    if client is None:
+        client = _quote_clients[loop] = RealtimeQuoteClient(client=get_http_client())
+    return client
+
+
+class QuoteCache:
+    """
+    进程内按基金代码缓存实时估值。
+
+    带 TTL 和 LRU 容量上限；同一代码的并发未命中合并为一次请求。
+    定时任务可以通过 prime 预先写入，报告就不必再访问上游接口。
+    过期不超过 stale_ttl 秒的估值仍会立即返回（标记 stale），同时在后台重新获取。
+    """
+
+    def __init__(self, ttl=None, maxsize=None, stale_ttl=None):
+        self.ttl = ttl if ttl is not None else QUOTE_CONFIG.get("cache_ttl", 600)
+        self.stale_ttl = stale_ttl if stale_ttl is not None else QUOTE_CONFIG.get("stale_ttl", 1800)
+        self.maxsize = maxsize or QUOTE_CONFIG.get("cache_size", 10000)
+        self._data = OrderedDict()
+        # 定时任务可能在其他线程里写入，存取都要加锁
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+
+    def peek(self, code):
+        """
+        只读缓存，不访问上游；没有或已过期时返回 None。
+        """
+        quote, fresh = self._lookup(code)
+        return quote if fresh else None
+
+    def _lookup(self, code):
+        """
+        :return: (估值, 是否未过期)，没有或过期超过 stale_ttl 时为 (None, False)
+        """
+        with self._lock:
+            entry = self._data.get(code)
+            if entry is None:
+                return None, False
+            expires_at, quote = entry
+            now = time.monotonic()
+            if expires_at + self.stale_ttl < now:
+                del self._data[code]
+                return None, False
+            self._data.move_to_end(code)
+            return quote, expires_at >= now
+
+    def put(self, quote):
+        with self._lock:
+            code = quote["fundcode"]
+            self._data[code] = (time.monotonic() + self.ttl, quote)
+            self._data.move_to_end(code)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def prime(self, quotes):
+        for quote in quotes:
+            self.put(quote)
+
+    def invalidate(self, code=None):
+        with self._lock:
+            if code is None:
+                self._data.clear()
+            else:
+                self._data.pop(code, None)
+
+    async def get(self, code):
+        """
+        获取基金实时估值，优先读缓存。
+
+        :param code: 基金代码
+        :return: 估值数据字典，上游没有数据时返回 None
+        """
+        quote, fresh = self._lookup(code)
+        if fresh:
+            self.hits += 1
+            cache_lookups.inc(1, "hit")
+            return quote
+        if quote is not None:
+            # 先返回过期的估值，后台重新获取，调用方不等待上游
+            self.stale_hits += 1
+            cache_lookups.inc(1, "stale_hit")
+            if code not in self._inflight:
+                asyncio.ensure_future(self._revalidate(code))
+            return {**quote, "stale": True}
+        return await self._fetch(code)
+
+    async def _revalidate(self, code):
+        try:
+            await self._fetch(code)
+        except Exception:
+            pass
+
+    async def _fetch(self, code):
+        loop = asyncio.get_running_loop()
+        future = self._inflight.get(code)
+        if future is not None and future.get_loop() is loop:
+            self.coalesced += 1
+            cache_lookups.inc(1, "coalesced")
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        cache_lookups.inc(1, "miss")
+        future = loop.create_future()
+        self._inflight[code] = future
+        try:
+            quote = await get_quote_client().fetch(code)
+            if quote:
+                self.put(quote)
+            future.set_result(quote)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            if self._inflight.get(code) is future:
+                del self._inflight[code]
+        return quote
+
+    async def get_many(self, codes):
+        quotes = await asyncio.gather(*(self.get(code) for code in codes))
+        return {code: quote for code, quote in zip(codes, quotes) if quote}
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "stale_hits": self.stale_hits,
+        }
+
+
+quote_cache = QuoteCache()
+
+
+class QuoteChangeTracker:
+    """
+    记录每个基金上一次写入的估值时间（gztime）和估值（gsz），用来跳过没有变化的写入。
+    """
+
+    def __init__(self):
+        self._seen = {}
+
+    @staticmethod
+    def _key(gztime, gsz):
+        try:
+            return gztime, float(gsz)
+        except (TypeError, ValueError):
+            # 没有估值或估值为 "--"
+            return gztime, None
+
+    def seed(self, code, gztime, gsz):
+        """
+        用数据库中已有的估值初始化，重启后第一次刷新也不会重复写入。
+        """
+        if gztime is not None and code not in self._seen:
+            self._seen[code] = self._key(gztime, gsz)
+
+    def changed(self, quote):
+        return self._seen.get(quote["fundcode"]) != self._key(quote.get("gztime"), quote.get("gsz"))
+
+    def mark(self, quote):
+        self._seen[quote["fundcode"]] = self._key(quote.get("gztime"), quote.get("gsz"))
+
+
+quote_tracker = QuoteChangeTracker()
@@ -0,0 +1,187 @@
+"""
+上游接口的截止时间、熔断和对冲请求。
+
+每个上游端点（realtime、search、all、detail）一个熔断器：最近 window 次调用中至少有 min_calls 次，
+且失败（含超时）或慢调用的比例达到 failure_rate 时打开。打开期间直接拒绝调用，调用方立即改用已保存的数据；
+open_seconds 秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则继续打开。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+import httpx
+
+from config import load_config
+from metrics import Counter, Gauge
+
+config = load_config("config.yml")
+RESILIENCE_CONFIG = config.get("resilience", {})
+ENDPOINTS = RESILIENCE_CONFIG.get("endpoints", {})
+
+logger = logging.getLogger(__name__)
+
+breaker_state = Gauge("upstream_breaker_state", "熔断器状态：0 关闭，1 半开，2 打开", ("endpoint",))
+breaker_rejections = Counter("upstream_breaker_rejections_total", "熔断器打开时被拒绝的调用数", ("endpoint",))
+deadline_exceeded = Counter("upstream_deadline_exceeded_total", "超过截止时间的调用数", ("endpoint",))
+hedged_requests = Counter("upstream_hedged_requests_total", "发出的对冲请求数", ("endpoint",))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+_BREAKER_OPTIONS = ("window", "min_calls", "failure_rate", "slow_call_seconds", "open_seconds")
+
+
+class UpstreamUnavailable(httpx.HTTPError):
+    """
+    调用没有得到结果：熔断器打开或超过截止时间。继承 httpx.HTTPError，原有的网络错误处理同样适用。
+    """
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    按最近调用的失败率和慢调用率打开的熔断器，只在事件循环线程中使用。
+    """
+
+    def __init__(self, name, window=20, min_calls=10, failure_rate=0.5, slow_call_seconds=None, open_seconds=30):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        # 最近的调用是否失败或过慢
+        self._calls = deque(maxlen=window)
+        self._opened_at = 0
+        self._probing = False
+        self.state = CLOSED
+        breaker_state.set(0, name)
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker %s %s -> %s", self.name, self.state, state)
+            self.state = state
+            breaker_state.set(_STATE_VALUES[state], self.name)
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self._set_state(OPEN)
+
+    @property
+    def is_open(self):
+        return self.state == OPEN and time.monotonic() - self._opened_at < self.open_seconds
+
+    def allow(self):
+        """
+        :return: 是否放行本次调用；半开状态同时只放行一个探测请求
+        """
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        breaker_rejections.inc(1, self.name)
+        return False
+
+    def record(self, ok, elapsed):
+        bad = not ok or (self.slow_call_seconds is not None and elapsed > self.slow_call_seconds)
+        if self.state == HALF_OPEN:
+            self._probing = False
+            if bad:
+                self._open()
+            else:
+                self._set_state(CLOSED)
+            return
+        if self.state == OPEN:
+            # 打开前发出的调用陆续返回，不再计入
+            return
+        self._calls.append(bad)
+        if len(self._calls) >= self.min_calls and sum(self._calls) >= self.failure_rate * len(self._calls):
+            self._open()
+
+    async def call(self, factory, deadline=None):
+        """
+        经过熔断器调用 factory()，超过 deadline 秒时取消并抛出 DeadlineExceeded。
+
+        :raises CircuitOpen: 熔断器打开，没有发出请求
+        """
+        if not self.allow():
+            raise CircuitOpen(f"{self.name}: circuit open")
+        started = time.perf_counter()
+        try:
+            result = await (asyncio.wait_for(factory(), deadline) if deadline else factory())
+        except asyncio.TimeoutError:
+            self.record(False, time.perf_counter() - started)
+            deadline_exceeded.inc(1, self.name)
+            raise DeadlineExceeded(f"{self.name}: no response within {deadline}s") from None
+        except asyncio.CancelledError:
+            # 被取消（例如对冲请求已经先返回）不代表上游有问题
+            if self.state == HALF_OPEN:
+                self._probing = False
+            raise
+        except Exception:
+            self.record(False, time.perf_counter() - started)
+            raise
+        self.record(True, time.perf_counter() - started)
+        return result
+
+
+async def hedged(factory, delay, endpoint=""):
+    """
+    delay 秒内没有返回时再发出一次相同的请求，取先成功的结果并取消另一个；delay 为空时不对冲。
+    """
+    if not delay:
+        return await factory()
+    first = asyncio.ensure_future(factory())
+    pending = {first}
+    error = None
+    # 调用方被取消时（包括等待第一个请求期间）取消所有未完成的请求
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+        hedged_requests.inc(1, endpoint)
+        pending.add(asyncio.ensure_future(factory()))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+_breakers = {}
+
+
+def get_breaker(endpoint):
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        options = dict(RESILIENCE_CONFIG.get("breaker", {}))
+        options.update((key, value) for key, value in ENDPOINTS.get(endpoint, {}).items() if key in _BREAKER_OPTIONS)
+        breaker = _breakers[endpoint] = CircuitBreaker(endpoint, **options)
+    return breaker
+
+
+async def call(endpoint, factory):
+    """
+    按 resilience.endpoints 中该端点的配置调用上游：截止时间、熔断，以及可选的对冲请求。
+
+    :param endpoint: 端点名
+    :param factory: 无参数的协程函数，每次调用发出一次请求
+    """
+    options = ENDPOINTS.get(endpoint, {})
+    breaker = get_breaker(endpoint)
+    return await hedged(lambda: breaker.call(factory, options.get("deadline")), options.get("hedge_after"), endpoint)
@@ -0,0 +1,119 @@
+"""
+在 bot 自己的事件循环上运行定时任务。
+
+任务与命令处理共用 httpx 连接池、数据库连接池和发送队列；同一个任务同时只运行一个实例，
+错过的多次触发合并为一次，超过 misfire_grace_time 的直接跳过。
+"""
+import functools
+import inspect
+import logging
+import time
+
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from config import load_config
+from metrics import Counter, Gauge, Histogram, current_command
+
+config = load_config("config.yml")
+SCHEDULER_CONFIG = config.get("scheduler", {})
+
+logger = logging.getLogger(__name__)
+
+job_duration = Histogram("scheduler_job_seconds", "定时任务执行耗时", ("job", "outcome"))
+job_lag = Histogram("scheduler_job_lag_seconds", "定时任务实际开始时间与计划时间的差", ("job",))
+job_runs = Counter("scheduler_job_runs_total", "定时任务按结果统计的次数", ("job", "outcome"))
+job_running = Gauge("scheduler_job_running", "正在运行的定时任务实例数", ("job",))
+job_last_duration = Gauge("scheduler_job_last_duration_seconds", "定时任务最近一次的执行耗时", ("job",))
+job_last_success = Gauge("scheduler_job_last_success_timestamp", "定时任务最近一次成功完成的时间戳", ("job",))
+
+scheduler = AsyncIOScheduler(job_defaults={
+    # 上一次还没跑完时跳过本次，避免慢任务叠加
+    "max_instances": 1,
+    # 错过的多次触发只补跑一次
+    "coalesce": True,
+    "misfire_grace_time": SCHEDULER_CONFIG.get("misfire_grace_time", 300),
+})
+
+
+def timed_job(name, func):
+    """
+    包装任务函数：设置 current_command 并记录耗时和结果，异常只记录日志不向调度器抛出。
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        current_command.set(f"job:{name}")
+        job_running.inc(1, name)
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            result = func(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            job_last_success.set(time.time(), name)
+            return result
+        except Exception:
+            outcome = "error"
+            logger.exception("Scheduled job %s failed", name)
+        finally:
+            elapsed = time.perf_counter() - started
+            job_running.inc(-1, name)
+            job_duration.observe(elapsed, name, outcome)
+            job_last_duration.set(elapsed, name)
+            job_runs.inc(1, name, outcome)
+            logger.info("Scheduled job %s finished in %.3fs (%s)", name, elapsed, outcome)
+    return wrapper
+
+
+def add_job(name, func, trigger, **trigger_args):
+    """
+    注册定时任务，任务 ID 即 name；cron 任务默认加上 scheduler.jitter 秒的随机抖动。
+
+    :param name: 任务名称，用作指标标签
+    :param func: 任务函数，可以是协程函数
+    :param trigger: APScheduler 触发器类型
+    """
+    if trigger == "cron":
+        trigger_args.setdefault("jitter", SCHEDULER_CONFIG.get("jitter", 30))
+    return scheduler.add_job(timed_job(name, func), trigger, id=name, name=name, replace_existing=True,
+                             **trigger_args)
+
+
+def _on_job_event(event):
+    if event.code == EVENT_JOB_SUBMITTED:
+        # 调度延迟：最早一次计划时间（含抖动）到提交执行的时间，合并的多次触发只记录一次
+        run_time = event.scheduled_run_times[0]
+        job_lag.observe(max(0.0, time.time() - run_time.timestamp()), event.job_id)
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        job_runs.inc(1, event.job_id, "skipped")
+        logger.warning("Skipped job %s: previous run still in progress", event.job_id)
+    elif event.code == EVENT_JOB_MISSED:
+        job_runs.inc(1, event.job_id, "missed")
+        logger.warning("Missed job %s scheduled at %s", event.job_id, event.scheduled_run_time)
+
+
+scheduler.add_listener(_on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
+
+
+def start():
+    """
+    在当前事件循环上启动调度器，需在 Application 的 post_init 中调用。
+    """
+    scheduler.start()
+
+
+def shutdown():
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+
+def pause():
+    """
+    暂停触发定时任务（失去 leader 租约时），正在运行的任务不受影响。
+    """
+    if scheduler.running:
+        scheduler.pause()
+
+
+def resume():
+    scheduler.resume()
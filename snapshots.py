@@ -0,0 +1,181 @@
+"""
+每个用户的日报快照。
+
+刷新任务结束后重新计算所有用户的持仓涨跌并整体替换，订阅变更时只替换该用户的快照；
+/repo 和每日广播直接读取快照，不再逐个基金查询和计算。
+"""
+import asyncio
+import datetime
+from decimal import Decimal
+
+from sqlalchemy import delete, distinct, func, insert, select
+
+from config import load_config
+from db import async_session
+from models import ReportSnapshot
+
+config = load_config("config.yml")
+SNAPSHOT_CONFIG = config.get("report_snapshot", {})
+
+INSERT_CHUNK = 500
+_DECIMAL_FIELDS = ("shares", "change_amount", "expect_change_amount", "expect_growth")
+
+# 只串行写入快照，计算报告不加锁，单个用户的重建不必等待全量重建计算完所有用户
+_write_lock = asyncio.Lock()
+# 重建开始的序号：单个用户最近一次重建开始时的序号，以及正在进行的全量重建开始时的序号
+_generation = 0
+_user_generations = {}
+_full_rebuilds = set()
+
+
+def _to_row(user_id, position, item, built_at):
+    row = {
+        "user_id": user_id,
+        "position": position,
+        "fund_code": item["fund_code"],
+        "fund_name": item["fund_name"],
+        "expect_worth": item["expect_worth"],
+        "net_worth": item["net_worth"],
+        "estimated_at": item.get("estimated_at"),
+        "stale": item.get("stale", False),
+        "built_at": built_at,
+    }
+    for field in _DECIMAL_FIELDS:
+        row[field] = str(item[field])
+    return row
+
+
+def _to_item(row):
+    item = {
+        "fund_code": row.fund_code,
+        "fund_name": row.fund_name,
+        "expect_worth": row.expect_worth,
+        "net_worth": row.net_worth,
+        "estimated_at": row.estimated_at,
+        "stale": bool(row.stale),
+    }
+    for field in _DECIMAL_FIELDS:
+        item[field] = Decimal(getattr(row, field))
+    return item
+
+
+def begin_rebuild(user_id=None):
+    """
+    在计算报告之前调用，记录重建开始的先后顺序。
+
+    :param user_id: 为空时表示全量重建
+    :return: 本次重建的序号，传给 replace_snapshots
+    """
+    global _generation
+    _generation += 1
+    if user_id is None:
+        _full_rebuilds.add(_generation)
+    else:
+        _user_generations[user_id] = _generation
+    return _generation
+
+
+async def replace_snapshots(reports, user_id=None, generation=None):
+    """
+    用新的报告替换快照，删除和写入在同一个事务中完成。
+
+    全量重建不覆盖在它开始之后单独重建过的用户，这些用户的报告是按更新的订阅计算的。
+
+    :param reports: 异步可迭代的 (用户ID, 报告条目列表)
+    :param user_id: 为空时替换所有用户的快照，否则只替换该用户的快照
+    :param generation: begin_rebuild 返回的序号，为空时不跳过任何用户
+    :return: 写入快照的用户数
+    """
+    try:
+        return await _replace(reports, user_id, generation)
+    finally:
+        if user_id is None and generation is not None:
+            _finish_full_rebuild(generation)
+
+
+async def _replace(reports, user_id, generation):
+    built_at = datetime.datetime.now()
+    report_users = set()
+    rows = []
+    async for report_user_id, report in reports:
+        report_users.add(report_user_id)
+        rows.extend(_to_row(report_user_id, position, item, built_at) for position, item in enumerate(report))
+
+    async with _write_lock:
+        skipped = set()
+        if user_id is None and generation is not None:
+            skipped = {key for key, value in _user_generations.items() if value > generation}
+        stmt = delete(ReportSnapshot)
+        if user_id is not None:
+            stmt = stmt.where(ReportSnapshot.user_id == user_id)
+        elif skipped:
+            stmt = stmt.where(ReportSnapshot.user_id.not_in(skipped))
+            rows = [row for row in rows if row["user_id"] not in skipped]
+        async with async_session() as session:
+            await session.execute(stmt)
+            for i in range(0, len(rows), INSERT_CHUNK):
+                await session.execute(insert(ReportSnapshot), rows[i:i + INSERT_CHUNK])
+            await session.commit()
+    return len(report_users - skipped)
+
+
+def _finish_full_rebuild(generation):
+    _full_rebuilds.discard(generation)
+    # 比所有进行中的全量重建都早的记录不会再被用到
+    oldest = min(_full_rebuilds, default=_generation)
+    for key in [key for key, value in _user_generations.items() if value <= oldest]:
+        del _user_generations[key]
+
+
+async def load_snapshot(user_id):
+    """
+    :return: 用户的报告条目列表，没有快照时为空列表
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(ReportSnapshot).where(ReportSnapshot.user_id == user_id).order_by(ReportSnapshot.position))
+        return [_to_item(row) for row in result.scalars()]
+
+
+async def snapshot_user_ids():
+    """
+    :return: 有快照的用户ID，升序
+    """
+    async with async_session() as session:
+        result = await session.execute(select(distinct(ReportSnapshot.user_id)).order_by(ReportSnapshot.user_id))
+        return result.scalars().all()
+
+
+async def iter_snapshots(user_ids=None):
+    """
+    按用户读取快照。
+
+    :param user_ids: 只读取这些用户，为空时读取所有用户
+    :return: 异步生成器，逐个产出 (用户ID, 报告条目列表)
+    """
+    stmt = select(ReportSnapshot).order_by(ReportSnapshot.user_id, ReportSnapshot.position)
+    if user_ids is not None:
+        stmt = stmt.where(ReportSnapshot.user_id.in_(user_ids))
+    # 先读出全部快照再逐个产出，广播渲染和发送期间不占用数据库连接
+    async with async_session() as session:
+        result = await session.execute(stmt)
+        rows = result.scalars().all()
+    user_id, report = None, []
+    for row in rows:
+        if report and row.user_id != user_id:
+            yield user_id, report
+            report = []
+        user_id = row.user_id
+        report.append(_to_item(row))
+    if report:
+        yield user_id, report
+
+
+async def is_stale():
+    """
+    最近一次生成的快照是否已超过 report_snapshot.max_age 秒，没有快照时也视为过期。
+    """
+    async with async_session() as session:
+        built_at = (await session.execute(select(func.max(ReportSnapshot.built_at)))).scalar()
+    max_age = SNAPSHOT_CONFIG.get("max_age", 900)
+    return built_at is None or (datetime.datetime.now() - built_at).total_seconds() > max_age
@@ -0,0 +1,62 @@
+"""
+启动耗时分析：python main.py --profile-startup 或设置环境变量 FUND_BOT_PROFILE_STARTUP=1 时启用。
+
+启用后记录每个模块第一次导入的耗时（含其依赖）以及启动各阶段距 main 开始执行的时间，
+后台预热完成后输出到日志。本模块需要在 main.py 中最先导入，才能统计到后面所有的导入。
+"""
+import builtins
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+STARTED = time.perf_counter()
+ENABLED = "--profile-startup" in sys.argv or os.environ.get("FUND_BOT_PROFILE_STARTUP", "") not in ("", "0")
+
+_stages = []
+# [(嵌套深度, 模块名, 耗时)]
+_imports = []
+_depth = 0
+_original_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    started = time.perf_counter()
+    _depth += 1
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        _imports.append((_depth, name, time.perf_counter() - started))
+
+
+if ENABLED:
+    builtins.__import__ = _timed_import
+
+
+def mark(stage):
+    """
+    记录一个启动阶段完成的时间点。
+    """
+    if ENABLED:
+        _stages.append((stage, time.perf_counter() - STARTED))
+
+
+def report(top=20):
+    """
+    输出启动阶段和最慢的导入，只统计前两层（main 直接导入的模块和它们的直接依赖）。
+    """
+    if not ENABLED:
+        return
+    builtins.__import__ = _original_import
+    lines = ["Startup profile (seconds since main started):"]
+    lines.extend(f"  {elapsed:8.3f}s  {stage}" for stage, elapsed in _stages)
+    lines.append(f"Slowest imports (top {top}, inclusive):")
+    slowest = sorted((item for item in _imports if item[0] <= 1), key=lambda item: item[2], reverse=True)[:top]
+    lines.extend(f"  {elapsed * 1000:8.1f}ms  {'  ' * depth}{name}" for depth, name, elapsed in slowest)
+    logger.info("\n".join(lines))
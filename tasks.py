@@ -1,50 +1,207 @@
 import asyncio
+import functools
 from datetime import datetime
 
+import charts
+import coordination
+from analytics import refresh_analytics
+from alerts import alert_index, load_alerts, notify_alerts
 from commands import (
-    FundApi, get_all_fund_codes_from_db, get_daily_report, get_subscribers, send_message_to_user,
-    update_fund_detail_in_db, update_fund_realtime_in_db)
+    AsyncFundApi, bulk_update_fund_details, bulk_update_fund_realtime, get_all_fund_codes_from_db,
+    get_realtime_targets, rebuild_report_snapshots, render_report)
+from config import load_config
+from delivery import get_delivery_queue
+from metrics import Gauge
+from quotes import QUOTE_CONFIG, get_quote_client, quote_cache, quote_tracker
+from snapshots import is_stale, iter_snapshots, snapshot_user_ids
+from trading_calendar import trading_calendar
 
+config = load_config("config.yml")
+BROADCAST_CONFIG = config.get("broadcast", {})
+# 没有订阅也没有预警的基金是否仍然刷新实时估值
+REFRESH_UNWATCHED = QUOTE_CONFIG.get("refresh_unwatched", False)
 
-# 你的数据库更新函数
-async def update_fund_details():
-    # 获取所有基金代码
-    fund_codes = await get_all_fund_codes_from_db()
+broadcast_progress = Gauge("broadcast_reports", "本次每日报告广播各阶段的用户数", ("stage",))
+broadcast_running = Gauge("broadcast_running", "每日报告广播是否正在进行")
 
-    # 假设你使用requests库来获取基金数据
-    data = FundApi().get_fund_details(fund_codes)
-    for fund in data:
-        await update_fund_detail_in_db(fund)
-    print(f"Updating fund details at {datetime.now()}")
-
-
-async def update_realtime_fund_details():
-    # 获取所有基金代码
-    fund_codes = await get_all_fund_codes_from_db()
 
-    data = FundApi().get_real_time_fund(fund_codes)
-    for fund in data:
-        await update_fund_realtime_in_db(fund)
-    print(f"Updating fund details at {datetime.now()}")
+async def fetch_fund_details(fund_codes):
+    # 分块并发拉取，每块返回后直接进入批量写入
+    api = AsyncFundApi()
+    await bulk_update_fund_details(api.iter_fund_details(fund_codes))
+    stats = api.batch_stats
+    print(f"Updating fund details at {datetime.now()}: {stats['funds']} funds, "
+          f"{stats['failed_chunks']}/{stats['chunks']} chunks failed, {stats['retries']} retries")
 
 
-def sync_update_realtime_fund_details():
-    asyncio.run(update_realtime_fund_details())
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 
-def sync_update_fund_details():
-    asyncio.run(update_fund_details())
+# 你的数据库更新函数
+async def update_fund_details():
+    # 获取所有基金代码
+    fund_codes = await get_all_fund_codes_from_db()
 
+    if coordination.ENABLED:
+        # 多进程部署时按基金代码拆成批次，由所有进程分担，每小时一次运行
+        run_id = f"fund_details:{datetime.now():%Y-%m-%dT%H}"
+        await coordination.create_run(run_id, "fund_details", _chunks(fund_codes, coordination.DETAILS_BATCH_SIZE))
+        status = await coordination.wait_run(run_id)
+        print(f"Fund details run {run_id} finished at {datetime.now()}: {status}")
+    else:
+        await fetch_fund_details(fund_codes)
+    users = await rebuild_report_snapshots()
+    print(f"Rebuilt report snapshots for {users} users")
+    # 净值日期有更新的基金重新计算风险指标，同一天多次运行只计算一次
+    await refresh_analytics()
 
-async def send_daily_report_to_subscribers():
-    # 获取所有订阅了 daily report 的用户
-    subscribers = await get_subscribers()
 
-    # 对每个用户发送 daily report
-    for user_id in subscribers:
-        message, image_path = await get_daily_report(user_id, True)
-        await send_message_to_user(user_id, message, image_path)  # 你可能需要实现这个函数
+async def update_realtime_fund_details():
+    # 休市日和午间休市不刷新
+    if not trading_calendar.is_open():
+        print(f"Market closed, skipping realtime update at {datetime.now()}")
+        return
+
+    if coordination.ENABLED:
+        # 预警可能是在其他进程上添加或删除的
+        await load_alerts()
+
+    # 有订阅的基金最先拉取，其次是只设置了预警的基金，没人关注的基金按配置决定是否刷新
+    watched_codes = alert_index.codes()
+    subscribed_codes, alerted_codes, unwatched_codes = [], [], []
+    for code, subscribed, expect_worth_date, expect_worth in await get_realtime_targets():
+        if expect_worth_date is not None:
+            quote_tracker.seed(code, expect_worth_date.strftime("%Y-%m-%d %H:%M"), expect_worth)
+        if subscribed:
+            subscribed_codes.append(code)
+        elif code in watched_codes:
+            alerted_codes.append(code)
+        elif REFRESH_UNWATCHED:
+            unwatched_codes.append(code)
+    fund_codes = subscribed_codes + alerted_codes + unwatched_codes
+
+    changed = []
+    counts = {"fetched": 0, "changed": 0, "skipped": 0}
+    failures = {}
+
+    async def changed_quotes(client):
+        async for fund in client.iter_quotes(fund_codes, failures):
+            counts["fetched"] += 1
+            # 预热进程内缓存，报告直接读取不再访问上游
+            quote_cache.put(fund)
+            # 估值时间和估值都没变的不再写库
+            if not quote_tracker.changed(fund):
+                counts["skipped"] += 1
+                continue
+            counts["changed"] += 1
+            changed.append(fund)
+            yield fund
+
+    # 并发拉取实时估值，有变化的按块批量写入
+    await bulk_update_fund_realtime(changed_quotes(get_quote_client()))
+    # 写入成功后才记下，失败时下次会重新写入
+    for fund in changed:
+        quote_tracker.mark(fund)
+    fired = await notify_alerts(changed)
+    # 估值已在进程内缓存中，重建快照不再访问上游
+    users = await rebuild_report_snapshots()
+    # 熔断或请求失败的基金本次没有刷新，和休市时没有估值（empty）区分开
+    missing = {outcome: len(failures.get(outcome, ())) for outcome in ("empty", "failed", "rejected")}
+    print(f"Realtime update at {datetime.now()}: {len(fund_codes)} targets, fetched={counts['fetched']} "
+          f"empty={missing['empty']} failed={missing['failed']} rejected={missing['rejected']} "
+          f"changed={counts['changed']} skipped={counts['skipped']}, fired {fired} price alerts, "
+          f"{users} report snapshots")
+    for outcome in ("failed", "rejected"):
+        if failures.get(outcome):
+            codes = failures[outcome]
+            print(f"Realtime quotes {outcome} for {len(codes)} funds: {', '.join(sorted(codes)[:20])}"
+                  f"{' ...' if len(codes) > 20 else ''}")
+
+
+async def send_reports(reports, run_id=None):
+    """
+    渲染报告并交给发送队列，等待全部发送完成。
+
+    :param reports: 异步可迭代的 (用户ID, 报告条目列表)
+    :param run_id: 多进程广播的运行ID，送达或放弃后记录到 delivery_records
+    """
+    batch_size = BROADCAST_CONFIG.get("batch_size", 20)
+    queue = get_delivery_queue()
+    counted = queue.sent
+
+    def count_sent():
+        nonlocal counted
+        broadcast_progress.inc(queue.sent - counted, "sent")
+        counted = queue.sent
+
+    async def enqueue_report(user_id, report):
+        # 图表在进程池中并发渲染，不阻塞命令处理
+        try:
+            image = await charts.render_fund_growth(report)
+        except Exception as e:
+            print(f"Failed to render chart for {user_id}: {e!r}")
+            broadcast_progress.inc(1, "render_failed")
+            image = None
+        on_done = functools.partial(coordination.record_delivery, run_id, user_id) if run_id else None
+        await queue.put(user_id, render_report(report), image, on_done)
+        broadcast_progress.inc(1, "queued")
+        count_sent()
+
+    try:
+        batch = []
+        async for report in reports:
+            broadcast_progress.inc(1, "prepared")
+            batch.append(report)
+            if len(batch) >= batch_size:
+                await asyncio.gather(*(enqueue_report(*item) for item in batch))
+                batch = []
+        if batch:
+            await asyncio.gather(*(enqueue_report(*item) for item in batch))
+        await queue.join()
+    finally:
+        count_sent()
+    print(f"Daily report delivery stats: {queue.stats()} at {datetime.now()}")
+
+
+async def send_report_batch(run_id, user_ids):
+    """
+    多进程广播的一个批次：跳过这次运行中已经处理过的用户，其余用户读取快照发送。
+    送达后才记录，批次被接手时尚未记录的用户会再发一次，个别用户可能收到重复的日报。
+    """
+    delivered = await coordination.delivered_chat_ids(run_id, user_ids)
+    pending = [user_id for user_id in user_ids if user_id not in delivered]
+    if delivered:
+        print(f"Resuming broadcast batch of {run_id}: {len(delivered)} already delivered, {len(pending)} pending")
+    if pending:
+        await send_reports(iter_snapshots(pending), run_id)
 
 
-def sync_send_daily_report_to_subscribers():
-    asyncio.run(send_daily_report_to_subscribers())
+async def send_daily_report_to_subscribers():
+    broadcast_running.set(1)
+    for stage in ("prepared", "render_failed", "queued", "sent"):
+        broadcast_progress.set(0, stage)
+
+    # 读取刷新任务生成的快照，分批渲染后交给发送队列；快照过旧或还没有时先重建
+    try:
+        if await is_stale():
+            await rebuild_report_snapshots()
+        if coordination.ENABLED:
+            # 多进程部署时按用户拆成批次，由所有进程分担；每天一次运行，重复触发不会重复发送
+            await coordination.prune_runs()
+            run_id = f"broadcast:{datetime.now().date()}"
+            user_ids = await snapshot_user_ids()
+            created = await coordination.create_run(
+                run_id, "broadcast", _chunks(user_ids, coordination.BROADCAST_BATCH_SIZE))
+            status = await coordination.wait_run(run_id)
+            print(f"Broadcast run {run_id} ({'created' if created else 'resumed'}) finished at {datetime.now()}: "
+                  f"{status}")
+        else:
+            await send_reports(iter_snapshots())
+    finally:
+        broadcast_running.set(0)
+    print(f"Quote cache stats: {quote_cache.stats()}")
+
+
+coordination.register_handler("fund_details", lambda run_id, fund_codes: fetch_fund_details(fund_codes))
+coordination.register_handler("broadcast", send_report_batch)
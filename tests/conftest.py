@@ -0,0 +1,59 @@
+"""
+测试使用临时目录中的 config.yml 和 SQLite 数据库。
+
+各模块在导入时读取当前目录下的 config.yml，所以要在导入任何项目模块之前切换目录。
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="fund-bot-tests-")
+
+with open(os.path.join(ROOT, "config.yml"), encoding="utf-8") as file:
+    _config = yaml.safe_load(file)
+_config["database"]["url"] = f"sqlite+aiosqlite:///{os.path.join(WORKDIR, 'test.db')}"
+_config["telegram_bot"]["token"] = "123456:test"
+_config["fund_api"]["base_url"] = "http://fund-api.invalid"
+_config.setdefault("metrics", {})["enabled"] = False
+_config.setdefault("trading_calendar", {})["holidays_path"] = os.path.join(ROOT, "trading_holidays.txt")
+with open(os.path.join(WORKDIR, "config.yml"), "w", encoding="utf-8") as file:
+    yaml.safe_dump(_config, file, allow_unicode=True)
+
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+
+
+async def _reset_database():
+    import db
+    from models import Base
+
+    async with db.get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    await db.get_engine().dispose()
+
+
+@pytest.fixture
+def run():
+    """
+    重建所有表，返回在新事件循环中运行协程的函数；每次运行结束时释放连接，连接不会跨事件循环复用。
+    """
+    import db
+
+    asyncio.run(_reset_database())
+
+    def run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await db.get_engine().dispose()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,68 @@
+import datetime
+
+import pytest
+
+import alerts
+from db import async_session
+from models import PriceAlert
+
+
+def quote(gszzl, gsz, code="000001", gztime="2026-10-16 14:30"):
+    return {"fundcode": code, "name": "测试基金", "gszzl": gszzl, "gsz": gsz, "gztime": gztime}
+
+
+@pytest.mark.parametrize("rule", ["nan%", "+inf%", "-inf%", ">inf", "<nan", "abc"])
+def test_parse_alert_rule_rejects_non_finite_thresholds(rule):
+    with pytest.raises(ValueError):
+        alerts.parse_alert_rule(rule)
+
+
+def test_evaluate_skips_malformed_quotes():
+    index = alerts.AlertIndex()
+    index.add(1, 10, "000001", "growth", "above", 1.0)
+    assert index.evaluate([quote("--", "1.2000"), quote("", ""), quote("2.00", None)]) == []
+    assert index.evaluate([quote("1.50", "1.2000")]) == [(1, 1.5)]
+
+
+def test_growth_restarts_each_trading_day():
+    index = alerts.AlertIndex()
+    index.add(1, 10, "000001", "growth", "above", 3.0)
+    index.add(2, 10, "000001", "worth", "above", 1.3)
+    assert index.evaluate([quote("3.50", "1.2000", gztime="2026-10-15 15:00")]) == [(1, 3.5)]
+    # 第二天的涨跌从 0 开始，再次达到 3% 时触发；净值没有穿过阈值，不触发
+    assert index.evaluate([quote("3.20", "1.2100", gztime="2026-10-16 09:35")]) == [(1, 3.2)]
+    assert index.evaluate([quote("3.30", "1.2200", gztime="2026-10-16 09:40")]) == []
+
+
+class FakeQueue:
+    def __init__(self):
+        self.sent = []
+
+    async def put(self, chat_id, text, image=None, on_done=None):
+        self.sent.append((chat_id, text))
+
+
+def test_cooldown_survives_reload(run, monkeypatch):
+    queue = FakeQueue()
+    monkeypatch.setattr(alerts, "get_delivery_queue", lambda: queue)
+    monkeypatch.setattr(alerts, "alert_index", alerts.AlertIndex())
+    monkeypatch.setattr(alerts, "_fired_at", {})
+    now = datetime.datetime.now()
+    cooldown = datetime.timedelta(seconds=alerts.ALERT_CONFIG.get("cooldown", 4 * 3600))
+
+    async def scenario():
+        async with async_session() as session:
+            session.add_all([
+                # 重启前刚触发过，仍在冷却时间内
+                PriceAlert(id=1, user_id=10, fund_code="000001", kind="growth", direction="above", threshold=1.0,
+                           last_fired_at=now - datetime.timedelta(minutes=5)),
+                # 上次触发已经超过冷却时间
+                PriceAlert(id=2, user_id=20, fund_code="000001", kind="growth", direction="above", threshold=1.0,
+                           last_fired_at=now - cooldown - datetime.timedelta(minutes=5)),
+            ])
+            await session.commit()
+        await alerts.load_alerts()
+        return await alerts.notify_alerts([quote("1.50", "1.2000")])
+
+    assert run(scenario()) == 1
+    assert [chat_id for chat_id, _ in queue.sent] == [20]
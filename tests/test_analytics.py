@@ -0,0 +1,45 @@
+import datetime
+
+import analytics
+import history
+from db import async_session
+
+
+# 分析窗口按今天计算，历史净值放在窗口之内
+START = datetime.date.today() - datetime.timedelta(days=30)
+
+
+def _history(days):
+    return [[(START + datetime.timedelta(days=day)).isoformat(), "1.0000", "0.00", ""] for day in range(days)]
+
+
+def test_short_history_is_not_recomputed_until_new_data(run, monkeypatch):
+    loads = []
+    load_histories = history.load_histories
+
+    async def counting_load_histories(codes, start_date=None):
+        loads.append(list(codes))
+        return await load_histories(codes, start_date)
+
+    async def append(days):
+        async with async_session() as session:
+            await history.append_history(session, {"000001": _history(days)})
+            await session.commit()
+
+    async def scenario():
+        await append(5)
+        results = [await analytics.refresh_analytics(), await analytics.refresh_analytics()]
+        message = await analytics.get_fund_risk("000001")
+        # 新的净值到达后重新计算
+        await append(6)
+        results.append(await analytics.refresh_analytics())
+        async with async_session() as session:
+            row = await session.get(analytics.FundAnalytics, "000001")
+        return results, message, row
+
+    monkeypatch.setattr(analytics.history, "load_histories", counting_load_histories)
+    results, message, row = run(scenario())
+    assert results == [0, 0, 0]
+    assert loads == [["000001"], ["000001"]]
+    assert "无法分析" in message
+    assert row.as_of == START + datetime.timedelta(days=5) and row.points == 6 and analytics.insufficient(row)
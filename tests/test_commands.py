@@ -0,0 +1,50 @@
+import datetime
+from decimal import Decimal
+
+import commands
+import snapshots
+from db import async_session
+from models import FundDetail, UserFund
+
+
+def test_rebuild_treats_missing_growth_as_zero(run, monkeypatch):
+    async def no_quotes(codes):
+        return {}
+
+    async def scenario():
+        async with async_session() as session:
+            # 上游返回 "--" 的涨跌保存为空
+            session.add_all([
+                FundDetail(code="000001", name="a", net_worth=1.1, expect_worth=1.2, expect_growth=None,
+                           day_growth=None, expect_worth_date=datetime.datetime(2026, 10, 16, 15)),
+                FundDetail(code="000002", name="b", net_worth=1.1, expect_worth=1.2, expect_growth=Decimal("2"),
+                           day_growth=Decimal("10"), expect_worth_date=datetime.datetime(2026, 10, 16, 15)),
+                UserFund(user_id=1, fund_code="000001", shares=100),
+                UserFund(user_id=2, fund_code="000002", shares=100),
+            ])
+            await session.commit()
+        users = await commands.rebuild_report_snapshots()
+        return users, await snapshots.load_snapshot(1), await snapshots.load_snapshot(2)
+
+    monkeypatch.setattr(commands.quote_cache, "get_many", no_quotes)
+    users, missing, other = run(scenario())
+    assert users == 2
+    assert missing[0]["change_amount"] == 0 and missing[0]["expect_change_amount"] == 0
+    assert other[0]["change_amount"] == Decimal("10")
+
+
+def test_list_subscriptions_reads_names_from_fund_details(run):
+    async def scenario():
+        async with async_session() as session:
+            session.add_all([
+                FundDetail(code="000002", name="b"),
+                UserFund(user_id=1, fund_code="000002", shares=100),
+                UserFund(user_id=1, fund_code="000001", shares=50),
+                UserFund(user_id=2, fund_code="000002", shares=10),
+            ])
+            await session.commit()
+        return await commands.list_subscriptions_for_user(1)
+
+    lines = run(scenario()).splitlines()
+    assert [line.split(", 份额")[0] for line in lines[1:]] == ["基金代码：000001, 基金名称：None",
+                                                              "基金代码：000002, 基金名称：b"]
@@ -0,0 +1,40 @@
+from sqlalchemy import select
+
+import coordination
+import delivery
+from db import async_session
+from models import Lease
+
+
+def test_lease_held_by_another_node(run):
+    async def scenario():
+        results = [await coordination.acquire_lease("scheduler", "a"),
+                   await coordination.acquire_lease("scheduler", "b"),
+                   await coordination.acquire_lease("scheduler", "a")]
+        async with async_session() as session:
+            holder = (await session.execute(select(Lease.holder).where(Lease.name == "scheduler"))).scalar()
+        return results, holder
+
+    assert run(scenario()) == ([True, False, True], "a")
+
+
+def test_expired_lease_is_taken_over(run):
+    async def scenario():
+        await coordination.acquire_lease("scheduler", "a", ttl=-1)
+        return await coordination.acquire_lease("scheduler", "b")
+
+    assert run(scenario()) is True
+
+
+def test_delivery_rate_is_shared_between_nodes(run, monkeypatch):
+    async def scenario():
+        await coordination.acquire_lease(coordination.NODE_LEASE, "a")
+        await coordination.acquire_lease(coordination.NODE_LEASE_PREFIX + "other", "b")
+        await coordination.acquire_lease(coordination.NODE_LEASE_PREFIX + "gone", "c", ttl=-1)
+        nodes = await coordination.count_active_nodes()
+        queue = delivery.get_delivery_queue()
+        delivery.set_active_nodes(nodes)
+        return nodes, queue._bucket.rate
+
+    monkeypatch.setattr(delivery, "_active_nodes", 1)
+    assert run(scenario()) == (2, 15)
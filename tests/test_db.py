@@ -0,0 +1,27 @@
+from sqlalchemy import inspect, text
+
+from db import create_tables, get_engine
+from snapshots import load_snapshot
+
+
+def test_create_tables_adds_new_nullable_columns(run):
+    async def scenario():
+        async with get_engine().begin() as conn:
+            # 增加 stale 列之前的快照表
+            await conn.execute(text("DROP TABLE report_snapshots"))
+            await conn.execute(text(
+                "CREATE TABLE report_snapshots (user_id BIGINT NOT NULL, position INTEGER NOT NULL, "
+                "fund_code VARCHAR(10), fund_name VARCHAR(100), shares VARCHAR(40), change_amount VARCHAR(40), "
+                "expect_change_amount VARCHAR(40), expect_growth VARCHAR(40), expect_worth VARCHAR(20), "
+                "net_worth FLOAT, estimated_at DATETIME, built_at DATETIME, PRIMARY KEY (user_id, position))"))
+            await conn.execute(text("INSERT INTO report_snapshots VALUES "
+                                    "(1, 0, '000001', 'a', '1', '0', '0', '0', '1.0', 1.0, NULL, NULL)"))
+        await create_tables()
+        async with get_engine().connect() as conn:
+            columns = await conn.run_sync(
+                lambda sync_conn: [column["name"] for column in inspect(sync_conn).get_columns("report_snapshots")])
+        return columns, await load_snapshot(1)
+
+    columns, report = run(scenario())
+    assert "stale" in columns
+    assert [item["stale"] for item in report] == [False]
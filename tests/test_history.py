@@ -0,0 +1,63 @@
+import datetime
+
+from sqlalchemy import func, select
+
+import history
+from db import async_session
+from models import FundNetWorth
+
+NET_WORTH_DATA = [["2026-10-14", "1.0100", "0.10", ""], ["2026-10-15", "1.0200", "0.99", ""]]
+
+
+def test_append_history_skips_stored_dates(run):
+    async def scenario():
+        async with async_session() as session:
+            first = await history.append_history(session, {"000001": NET_WORTH_DATA})
+            await session.commit()
+        async with async_session() as session:
+            second = await history.append_history(
+                session, {"000001": NET_WORTH_DATA + [["2026-10-16", "1.0300", "0.98", ""]]})
+            await session.commit()
+        return first, second
+
+    assert run(scenario()) == (2, 1)
+
+
+def test_append_history_ignores_rows_written_concurrently(run, monkeypatch):
+    async def stale_latest_dates(session, codes):
+        # 另一个任务在读取最新日期之后、写入之前已经写入了同样的日期
+        return {}
+
+    async def scenario():
+        async with async_session() as session:
+            await history.append_history(session, {"000001": NET_WORTH_DATA[:1]})
+            await session.commit()
+        monkeypatch.setattr(history, "latest_dates", stale_latest_dates)
+        async with async_session() as session:
+            written = await history.append_history(session, {"000001": NET_WORTH_DATA})
+            await session.commit()
+        async with async_session() as session:
+            result = await session.execute(
+                select(FundNetWorth.worth_date, func.count()).group_by(FundNetWorth.worth_date))
+            return written, dict(result.all())
+
+    written, counts = run(scenario())
+    assert written == 1
+    assert counts == {datetime.date(2026, 10, 14): 1, datetime.date(2026, 10, 15): 1}
+
+
+def test_append_history_with_years_of_data(run):
+    # 基金详情接口返回多年的历史净值，一批基金的行数远超 SQLite 单条语句的变量数上限
+    start = datetime.date(2019, 1, 1)
+    net_worth_data = [[(start + datetime.timedelta(days=day)).isoformat(), "1.0000", "0.00", ""]
+                      for day in range(2000)]
+
+    async def scenario():
+        async with async_session() as session:
+            written = await history.append_history(
+                session, {f"{code:06d}": net_worth_data for code in range(40)})
+            await session.commit()
+        async with async_session() as session:
+            return written, (await session.execute(select(func.count()).select_from(FundNetWorth))).scalar()
+
+    assert run(scenario()) == (80000, 80000)
@@ -0,0 +1,51 @@
+import datetime
+from decimal import Decimal
+
+from sqlalchemy import select, update
+
+import ledger
+from db import async_session
+from models import FundPosition, UserFund
+
+
+def _trade(kind, shares, price="1.5000"):
+    shares, price = Decimal(shares), Decimal(price)
+    return {"user_id": 1, "fund_code": "000001", "kind": kind, "trade_date": datetime.date(2026, 10, 15),
+            "shares": shares, "price": price, "amount": shares * price, "fee": Decimal(0)}
+
+
+async def _apply(trades):
+    async with async_session() as session:
+        await ledger._apply_trades(session, trades)
+        await session.commit()
+    async with async_session() as session:
+        position = (await session.execute(select(FundPosition))).scalar_one()
+        subscribed = (await session.execute(select(UserFund.shares))).scalar_one()
+    return position, Decimal(str(subscribed))
+
+
+def test_first_trade_starts_from_subscribed_shares(run):
+    async def scenario():
+        async with async_session() as session:
+            session.add(UserFund(user_id=1, fund_code="000001", shares=100))
+            await session.commit()
+        # 订阅时的 100 份可以卖出，不会被第一笔交易覆盖
+        return await _apply([_trade("sell", "40")])
+
+    position, subscribed = run(scenario())
+    assert position.shares == Decimal("60") and position.cost_basis == Decimal("90")
+    assert position.realized_pnl == Decimal("0")
+    assert subscribed == Decimal("60")
+
+
+def test_trade_adds_to_shares_changed_by_subscribe(run):
+    async def scenario():
+        await _apply([_trade("buy", "50")])
+        async with async_session() as session:
+            await session.execute(update(UserFund).values(shares=80))
+            await session.commit()
+        return await _apply([_trade("buy", "10")])
+
+    position, subscribed = run(scenario())
+    assert position.shares == Decimal("60")
+    assert subscribed == Decimal("90")
@@ -0,0 +1,36 @@
+import pytest
+
+import main
+import migrations
+from main import webhook_options
+
+
+def test_webhook_requires_public_url():
+    with pytest.raises(SystemExit):
+        webhook_options({"url": "", "path": "telegram"})
+    with pytest.raises(SystemExit):
+        webhook_options({})
+
+
+def test_webhook_url_includes_path():
+    options = webhook_options({"url": "https://bot.example.com/", "path": "/telegram/", "secret_token": ""})
+    assert options["webhook_url"] == "https://bot.example.com/telegram"
+    assert options["url_path"] == "telegram"
+    assert options["secret_token"] is None
+
+
+def test_migrations_finish_before_updates_are_received(run, monkeypatch):
+    class Application:
+        bot = None
+        bot_data = {}
+
+    async def warm_up(application):
+        pass
+
+    async def scenario():
+        await main.post_init(Application())
+        # post_init 返回后 PTB 才开始轮询或接收 webhook
+        return await migrations.applied_migrations()
+
+    monkeypatch.setattr(main, "warm_up", warm_up)
+    assert set(run(scenario())) == {version for version, _, _ in migrations.MIGRATIONS}
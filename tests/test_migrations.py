@@ -0,0 +1,20 @@
+import pytest
+
+import migrations
+
+
+def test_upgrade_refuses_unsupported_dialect(run, monkeypatch):
+    monkeypatch.setattr(migrations, "SUPPORTED_DIALECTS", ("mysql", "postgresql"))
+    with pytest.raises(SystemExit, match="auto_migrate"):
+        run(migrations.upgrade())
+    assert run(migrations.applied_migrations()) == {}
+
+
+def test_upgrade_is_idempotent(run):
+    assert run(migrations.upgrade()) == len(migrations.MIGRATIONS)
+    assert run(migrations.upgrade()) == 0
+
+
+def test_hot_queries_use_covering_indexes(run):
+    run(migrations.upgrade())
+    assert run(migrations.check()) == 0
@@ -0,0 +1,49 @@
+import asyncio
+
+import httpx
+
+import quotes
+import resilience
+from metrics import render_prometheus
+
+
+def test_cache_lookups_are_exported():
+    cache = quotes.QuoteCache(ttl=60)
+    hits = quotes.cache_lookups.value("hit")
+    cache.put({"fundcode": "000001", "gsz": "1.0000", "gszzl": "0.10", "gztime": "2026-10-16 15:00"})
+    quote = asyncio.run(cache.get("000001"))
+    assert quote["gsz"] == "1.0000"
+    assert quotes.cache_lookups.value("hit") == hits + 1
+    assert f'quote_cache_lookups_total{{outcome="hit"}} {hits + 1}' in render_prometheus()
+
+
+def _transport(request):
+    code = request.url.path.rsplit("/", 1)[-1].split(".")[0]
+    if code == "000001":
+        return httpx.Response(200, text='jsonpgz({"fundcode":"000001","gsz":"1.0000","gszzl":"0.10",'
+                                        '"gztime":"2026-10-16 15:00"});')
+    if code == "000002":
+        return httpx.Response(200, text="jsonpgz();")
+    return httpx.Response(500)
+
+
+def test_iter_quotes_reports_failed_and_rejected_codes(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(_transport)) as http_client:
+            client = quotes.RealtimeQuoteClient(client=http_client)
+            failures = {}
+            fetched = [quote["fundcode"] async for quote in client.iter_quotes(["000001", "000002", "000003"],
+                                                                               failures)]
+            # 熔断器打开后剩下的代码被拒绝，不发出请求
+            resilience.get_breaker("realtime")._open()
+            rejected = {}
+            async for _ in client.iter_quotes(["000001"], rejected):
+                pass
+            return fetched, failures, rejected
+
+    fetched, failures, rejected = asyncio.run(scenario())
+    assert fetched == ["000001"]
+    assert failures == {"empty": ["000002"], "failed": ["000003"]}
+    assert rejected == {"rejected": ["000001"]}
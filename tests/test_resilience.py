@@ -0,0 +1,34 @@
+import asyncio
+
+import resilience
+
+
+def test_hedged_cancels_requests_when_caller_is_cancelled():
+    started = []
+
+    async def request():
+        started.append(asyncio.current_task())
+        await asyncio.sleep(10)
+
+    async def scenario():
+        caller = asyncio.ensure_future(resilience.hedged(request, 5))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        await asyncio.sleep(0)
+        return [task.cancelled() for task in started]
+
+    assert asyncio.run(scenario()) == [True]
+
+
+def test_hedged_returns_first_success():
+    calls = []
+
+    async def request():
+        calls.append(1)
+        index = len(calls)
+        # 第一个请求很慢，对冲的第二个请求先返回
+        await asyncio.sleep(1 if index == 1 else 0)
+        return index
+
+    assert asyncio.run(resilience.hedged(request, 0.01)) == 2
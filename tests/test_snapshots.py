@@ -0,0 +1,43 @@
+import asyncio
+from decimal import Decimal
+
+import snapshots
+
+
+def _item(fund_code, shares):
+    return {"fund_code": fund_code, "fund_name": fund_code, "expect_worth": "1.0000", "net_worth": 1.0,
+            "shares": Decimal(shares), "change_amount": Decimal("0"), "expect_change_amount": Decimal("0"),
+            "expect_growth": Decimal("0")}
+
+
+def test_user_rebuild_does_not_wait_for_full_rebuild(run):
+    computing = asyncio.Event()
+    user_done = asyncio.Event()
+
+    async def full_reports():
+        # 全量重建计算到一半时，用户 1 变更了订阅
+        computing.set()
+        await user_done.wait()
+        yield 1, [_item("000001", "100")]
+        yield 2, [_item("000002", "200")]
+
+    async def user_reports():
+        yield 1, [_item("000001", "300")]
+
+    async def user_rebuild():
+        await computing.wait()
+        generation = snapshots.begin_rebuild(1)
+        await snapshots.replace_snapshots(user_reports(), 1, generation)
+        user_done.set()
+
+    async def scenario():
+        full = snapshots.replace_snapshots(full_reports(), generation=snapshots.begin_rebuild())
+        users, _ = await asyncio.wait_for(asyncio.gather(full, user_rebuild()), timeout=5)
+        return users, await snapshots.load_snapshot(1), await snapshots.load_snapshot(2)
+
+    users, user_1, user_2 = run(scenario())
+    # 全量重建没有用较早计算的报告覆盖用户 1
+    assert users == 1
+    assert [item["shares"] for item in user_1] == [Decimal("300")]
+    assert [item["shares"] for item in user_2] == [Decimal("200")]
+    assert not snapshots._user_generations and not snapshots._full_rebuilds
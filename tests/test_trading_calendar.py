@@ -0,0 +1,14 @@
+import datetime
+
+from trading_calendar import TradingCalendar
+
+
+def test_holiday_file_covers_published_years():
+    calendar = TradingCalendar.from_file()
+    assert calendar.covers(2025) and calendar.covers(2026)
+    assert not TradingCalendar([datetime.date(2025, 1, 1)]).covers(2026)
+
+
+def test_holidays_are_weekdays():
+    calendar = TradingCalendar.from_file()
+    assert all(day.weekday() < 5 for day in calendar.holidays)
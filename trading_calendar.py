@@ -0,0 +1,80 @@
+"""
+本地交易日历：节假日读取本地文件，交易时段读取配置，实时估值刷新据此跳过休市时间。
+
+节假日文件每行一个日期（YYYY-MM-DD），# 之后为注释；周末总是休市，不需要写入文件。
+交易所每年年底公布下一年的休市安排，届时需要把新的日期追加到文件中。
+"""
+import datetime
+import logging
+import os
+
+from config import load_config
+
+config = load_config("config.yml")
+CALENDAR_CONFIG = config.get("trading_calendar", {})
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_time(value):
+    hour, minute = value.split(":")
+    return datetime.time(int(hour), int(minute))
+
+
+class TradingCalendar:
+    """
+    判断某个时刻是否处于交易时段。
+    """
+
+    def __init__(self, holidays=(), sessions=None, grace_minutes=None):
+        self.holidays = set(holidays)
+        sessions = sessions or CALENDAR_CONFIG.get("sessions", ["09:30-11:30", "13:00-15:00"])
+        self.sessions = [tuple(_parse_time(part) for part in session.split("-")) for session in sessions]
+        # 时段两端的宽限时间，覆盖定时任务的抖动和收盘后最后一次估值
+        grace_minutes = grace_minutes if grace_minutes is not None else CALENDAR_CONFIG.get("grace_minutes", 5)
+        self.grace = datetime.timedelta(minutes=grace_minutes)
+
+    @classmethod
+    def from_file(cls, path=None):
+        path = path or CALENDAR_CONFIG.get("holidays_path", "trading_holidays.txt")
+        holidays = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        holidays.add(datetime.date.fromisoformat(line))
+        else:
+            logger.warning("Trading holiday file %s not found, only weekends are treated as closed", path)
+        calendar = cls(holidays)
+        year = datetime.date.today().year
+        if not calendar.covers(year):
+            logger.warning("Trading holiday file %s has no entries for %d", path, year)
+        return calendar
+
+    def covers(self, year):
+        """
+        :return: 休市日中是否有该年的日期，没有时说明还没有追加交易所当年的休市安排
+        """
+        return any(day.year == year for day in self.holidays)
+
+    def is_trading_day(self, day):
+        return day.weekday() < 5 and day not in self.holidays
+
+    def is_open(self, moment=None):
+        """
+        :param moment: 要判断的时间，默认为当前时间
+        :return: 是否为交易日且处于某个交易时段（含宽限时间）内
+        """
+        moment = moment or datetime.datetime.now()
+        if not self.is_trading_day(moment.date()):
+            return False
+        for start, end in self.sessions:
+            opens = datetime.datetime.combine(moment.date(), start) - self.grace
+            closes = datetime.datetime.combine(moment.date(), end) + self.grace
+            if opens <= moment <= closes:
+                return True
+        return False
+
+
+trading_calendar = TradingCalendar.from_file()
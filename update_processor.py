@@ -0,0 +1,68 @@
+"""
+并发处理 Telegram 更新，同一个用户的更新按到达顺序依次处理。
+"""
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import Gauge
+
+updates_in_flight = Gauge("bot_updates_in_flight", "正在处理的更新数")
+updates_waiting = Gauge("bot_updates_waiting", "等待空闲 worker 的更新数")
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    最多 workers 个更新同时处理；同一用户（或会话）的更新串行处理，/sub 和 /unsub 不会交错执行。
+
+    max_pending 是已接收但尚未处理完的更新上限（PTB 的信号量），排队等待同一用户的更新不占用 worker。
+    """
+
+    def __init__(self, workers, max_pending=None):
+        super().__init__(max(max_pending or workers * 32, workers))
+        self.workers = workers
+        self._worker_slots = None
+        # {用户ID: [锁, 引用计数]}，没有更新在等待时删除
+        self._locks = {}
+
+    async def initialize(self):
+        self._worker_slots = asyncio.Semaphore(self.workers)
+
+    async def shutdown(self):
+        self._locks.clear()
+
+    @staticmethod
+    def _ordering_key(update):
+        user = getattr(update, "effective_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, "effective_chat", None)
+        return chat.id if chat is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _run(self, coroutine):
+        updates_waiting.inc(1)
+        try:
+            await self._worker_slots.acquire()
+        finally:
+            updates_waiting.inc(-1)
+        updates_in_flight.inc(1)
+        try:
+            await coroutine
+        finally:
+            updates_in_flight.inc(-1)
+            self._worker_slots.release()